@@ -1,15 +1,25 @@
 # ml-service/app.py
 import os
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
 
 from models import db, Station, Charger
 from enhanced_ev_planner import EnhancedEVPlanner
+from services import admission, metrics, profiling, resilience, tracing
+from services import corridors, encoding, energy, routing, shared_stations, tiles
+from services.connectors import StationFilter
+from services.maps import MAP_RENDERER
+from services.nearest import NearestStations, parse_point
+from services.reachability import Reachability, vehicle_range
+from services.profiling import PROFILER
 
 load_dotenv()
 
+tracing.configure("route-service")
+tracing.instrument_sqlalchemy()
+
 def _pg_uri():
     host = os.getenv("POSTGRES_HOST", "localhost")
     port = os.getenv("POSTGRES_PORT", "5432")
@@ -31,9 +41,130 @@ def add_cors_headers(response):
     response.headers.add("Access-Control-Allow-Methods", "GET,POST,PUT,DELETE,OPTIONS")
     return response
 
+# -----------------------
+# Request metrics, tracing and profiling hooks
+# -----------------------
+def _endpoint_label() -> str:
+    # route template, not the raw path, so label cardinality stays bounded
+    return request.url_rule.rule if request.url_rule else "other"
+
+# endpoints that can be profiled on demand (services/profiling.py)
+PROFILED_ENDPOINTS = {"/api/route"}
+# end-to-end budget for outbound calls; callers may shorten it with X-Request-Deadline-Ms
+ROUTE_REQUEST_DEADLINE_SECONDS = float(os.getenv("ROUTE_REQUEST_DEADLINE_SECONDS", "15"))
+# concurrency limits + priority queue for the expensive endpoints (services/admission.py)
+ADMISSION = admission.AdmissionControl(admission.parse_limits(
+    os.getenv("ADMISSION_LIMITS"), {"/api/route": 16, "/api/reachable": 16, "/api/stations/nearest": 64}
+))
+
+@app.before_request
+def _metrics_start():
+    g.metrics_endpoint = _endpoint_label()
+    g.metrics_started = metrics.request_started(g.metrics_endpoint)
+    g.trace_span = tracing.start_span(
+        f"{request.method} {g.metrics_endpoint}", tracing.SERVER, request.headers.get(tracing.TRACEPARENT),
+        {"http.method": request.method, "http.route": g.metrics_endpoint},
+    )
+    if g.metrics_endpoint in PROFILED_ENDPOINTS:
+        g.profile = PROFILER.begin(g.metrics_endpoint, request.headers.get(profiling.HEADER))
+    g.deadline = resilience.start_deadline(
+        ROUTE_REQUEST_DEADLINE_SECONDS, request.headers.get(resilience.DEADLINE_HEADER)
+    )
+    try:
+        g.admission = ADMISSION.acquire(g.metrics_endpoint, request.headers.get(admission.PRIORITY_HEADER))
+    except admission.Shed as ex:
+        # answered here, before any work; after_request/teardown still run
+        return jsonify({"success": False, "error": str(ex)}), 503, {"Retry-After": str(int(ex.retry_after) + 1)}
+
+@app.after_request
+def _metrics_status(response):
+    g.metrics_status = response.status_code
+    # lets the frontend log the trace id next to its own timings
+    response.headers[tracing.TRACEPARENT] = g.trace_span.traceparent
+    if g.get("profile"):
+        response.headers[profiling.RESPONSE_HEADER] = g.profile.id
+    return response
+
+@app.teardown_request
+def _metrics_finish(exc):
+    if g.get("admission"):
+        g.admission.release()
+    if "deadline" in g:
+        resilience.end_deadline(g.deadline)
+    if "metrics_started" in g:
+        status = g.get("metrics_status", 500 if exc else 200)
+        if g.get("profile"):
+            PROFILER.end(g.profile, status)
+        g.trace_span.set("http.status_code", status)
+        if status >= 500 and not exc:
+            g.trace_span.error = f"HTTP {status}"
+        tracing.end_span(g.trace_span, exc)
+        metrics.request_finished(g.metrics_endpoint, request.method, status, g.metrics_started)
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# -----------------------
+# Profiling admin (requires X-Profile-Token)
+# -----------------------
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    if not PROFILER.authorized(request.headers.get(profiling.HEADER)):
+        return jsonify({"success": False, "error": "forbidden"}), 403
+    if request.method == "POST":
+        # {"endpoints": ["/api/route"], "sample_rate": 0.05}; sample_rate 0 disarms
+        data = request.get_json(force=True) or {}
+        PROFILER.configure(data.get("endpoints") or sorted(PROFILED_ENDPOINTS), float(data.get("sample_rate", 0)))
+    return jsonify(PROFILER.status())
+
+@app.get("/admin/profiles")
+def admin_profiles():
+    if not PROFILER.authorized(request.headers.get(profiling.HEADER)):
+        return jsonify({"success": False, "error": "forbidden"}), 403
+    return jsonify({"profiles": PROFILER.list()})
+
+@app.get("/admin/profiles/<profile_id>/<fmt>")
+def admin_profile_download(profile_id, fmt):
+    if not PROFILER.authorized(request.headers.get(profiling.HEADER)):
+        return jsonify({"success": False, "error": "forbidden"}), 403
+    path = PROFILER.artifact_path(profile_id, fmt)
+    if not path:
+        return jsonify({"success": False, "error": "profile not found"}), 404
+    return send_file(os.path.abspath(path), as_attachment=True)
+
 db.init_app(app)
 planner = EnhancedEVPlanner(max_station_distance_km=5)  # 5km band from route polyline
 
+def _load_stations():
+    # runs on request threads and on the snapshot's refresh thread
+    with app.app_context():
+        return planner.load_stations()
+
+# stations + charger aggregates, reloaded every STATION_SNAPSHOT_TTL_SECONDS instead of per request;
+# one copy shared by all workers when STATION_SHM_DIR is set (services/shared_stations.py)
+STATIONS = shared_stations.snapshot_source("route-service", _load_stations)
+STATION_TILES = tiles.StationTiles()
+STATIONS.on_change(STATION_TILES.rebuild)
+NEAREST = NearestStations()
+STATIONS.on_change(NEAREST.rebuild)
+REACH = Reachability(planner.get_table_from_osrm, NEAREST)
+# popular city pairs precomputed offline by build_corridors.py
+CORRIDORS = corridors.CorridorCache().load()
+
+class StationsUnavailable(Exception):
+    """No station snapshot to serve: the first load failed (later failures keep serving the last one)."""
+
+def current_stations():
+    try:
+        return STATIONS.get()
+    except Exception as ex:
+        raise StationsUnavailable(f"station data unavailable: {ex}") from ex
+
+@app.errorhandler(StationsUnavailable)
+def _stations_unavailable(ex):
+    return jsonify({"success": False, "error": str(ex)}), 503, {"Retry-After": "5"}
+
 @app.get("/api/health")
 def health():
     return {"ok": True, "time": datetime.utcnow().isoformat()}
@@ -45,8 +176,19 @@ def api_route():
     {
       "start": {"lat": <float>, "lng": <float>},
       "end": {"lat": <float>, "lng": <float>},
-      "stops": [ {"lat":..., "lng":...}, ... ]  # optional
+      "stops": [ {"lat":..., "lng":...}, ... ],  # optional
+      "optimize_stops": true,                    # optional: reorder stops by drive time (services/routing.py)
+      "connectors": ["CCS2", "CHAdeMO"],         # optional: stations with any of these
+      "min_power_kw": 50,                        # optional: on one of those connectors
+      "available_only": false,                   # optional: a free charger (of those connectors, of min_power_kw)
+      "map": true,                               # optional: render a Folium map in the background
+      "precision": 5,                            # optional: decimals kept in path coordinates (0-6)
+      "energy": {"soc": 80, "battery_kwh": 40,   # optional: start SOC + vehicle (services/energy.py)
+                 "mass_kg": 1700, "profile": true}  # profile: per-vertex elevation/kWh/SOC arrays
     }
+
+    Responds with MessagePack for `Accept: application/msgpack` and compresses
+    large bodies per Accept-Encoding (services/encoding.py).
     """
     data = request.get_json(force=True)
     start = data.get("start")
@@ -59,32 +201,240 @@ def api_route():
     s = (float(start["lat"]), float(start["lng"]))
     e = (float(end["lat"]), float(end["lng"]))
     waypoints = [(float(p["lat"]), float(p["lng"])) for p in stops if p and "lat" in p and "lng" in p]
+    if len(waypoints) > routing.ROUTE_MAX_STOPS:
+        return jsonify({"success": False, "error": f"at most {routing.ROUTE_MAX_STOPS} stops"}), 400
+    energy_opts = data.get("energy") or {}
+    try:
+        station_filter = StationFilter.from_params(
+            data.get("connectors"), data.get("min_power_kw"), bool(data.get("available_only"))
+        )
+        vehicle = energy.Vehicle.from_params(energy_opts)
+        soc = float(energy_opts["soc"]) if energy_opts.get("soc") is not None else None
+        precision = min(max(int(data.get("precision", encoding.ROUTE_COORD_PRECISION)), 0), 6)
+    except (AttributeError, TypeError, ValueError) as ex:
+        return jsonify({"success": False, "error": str(ex)}), 400
 
     try:
-        # 1) Routes via OSRM (with waypoints)
-        routes = planner.get_routes_from_osrm(s, e, waypoints=waypoints, alternatives=2)
+        # 0) Stop order from one (cached) OSRM duration matrix; the given order if that fails
+        stops_order = None
+        if len(waypoints) > 1 and data.get("optimize_stops", True):
+            try:
+                matrix, cached = routing.DURATION_MATRICES.get_or_fetch(
+                    "osrm", routing.route_points(s, e, waypoints), planner.get_matrix_from_osrm
+                )
+                waypoints, stops_order = routing.order_stops(waypoints, matrix, cached)
+            except Exception as ex:
+                print(f"⚠️ Stop ordering failed, keeping the given order: {ex}")
+
+        # 1) Routes from the corridor artifact for popular city pairs, else via OSRM (with waypoints)
+        corridor = CORRIDORS.lookup(s, e) if not waypoints else None
+        if corridor is not None:
+            routes = CORRIDORS.routes(corridor)
+        else:
+            routes = planner.get_routes_from_osrm(s, e, waypoints=waypoints, alternatives=2)
         if not routes:
             return jsonify({"success": False, "error": "No routes returned"}), 404
+        profiling.note(
+            waypoints=len(waypoints),
+            alternatives=len(routes),
+            route_points=len(routes[0]["path"]),
+            route_km=round(routes[0]["distance_km"], 1),
+            corridor=corridor.name if corridor is not None else None,
+        )
+
+        # 2) Stations from the in-memory snapshot, narrowed by the vehicle filter
+        #    (a cached numpy mask) and matched against the first (shortest) route
+        #    on the snapshot's lat/lon columns
+        with metrics.stage("station_load"):
+            snapshot = current_stations()
+        with metrics.stage("corridor_match"):
+            if corridor is not None:
+                near = CORRIDORS.stations(corridor, snapshot, station_filter, planner.stations_near_route)
+            else:
+                near = planner.stations_near_route(routes[0]["path"], snapshot, station_filter)
+        candidates = int(snapshot.mask(station_filter).sum()) if station_filter.active else len(snapshot.stations)
+        profiling.note(stations=candidates, nearby_stations=len(near))
 
-        # 2) Load stations once (from DB) and compute proximity to the first (shortest) route
-        stations = planner.load_stations()
-        near = planner.stations_near_route(routes[0]["path"], stations)
+        # 3) Optional: Folium map, rendered off the request path and fetched from /api/maps/<id>
+        map_info = None
+        if data.get("map"):
+            map_id = MAP_RENDERER.submit(s, e, routes, near, planner.build_map)
+            map_info = {"id": map_id, "status": MAP_RENDERER.status(map_id), "url": f"/api/maps/{map_id}"}
 
-        # 3) Optional: build a folium map file (commented by default)
-        # map_name = planner.build_map(s, e, routes, near)
+        # 4) Energy along each alternative (elevation from the local DEM, if present)
+        with metrics.stage("energy"):
+            energies = [
+                energy.energy_summary(
+                    energy.route_energy(r["path"], r["duration_min"], r.get("segment_seconds"), vehicle),
+                    soc, vehicle.battery_kwh, include_profile=bool(energy_opts.get("profile")),
+                )
+                for r in routes
+            ]
 
-        return jsonify({
+        payload = {
             "success": True,
             "routes": [{
                 "distance_km": round(r["distance_km"], 1),
                 "duration_min": round(r["duration_min"], 0),
-                "path": r["path"],  # [ [lat,lon], ... ]
-            } for r in routes],
+                "path": encoding.round_path(r["path"], precision),  # [ [lat,lon], ... ]
+                "energy": en,
+                "stale": r.get("stale", False),  # last good OSRM answer, served while OSRM is down
+            } for r, en in zip(routes, energies)],
             "nearby_stations": near[:60],
-            # "map_file": map_name
-        })
+            "stops_order": stops_order,
+            "map": map_info,
+        }
+        body, headers = encoding.encode(
+            payload, request.headers.get("Accept"), request.headers.get("Accept-Encoding")
+        )
+        if corridor is not None:
+            headers["X-Corridor"] = corridor.name
+        return Response(body, headers=headers)
+    except StationsUnavailable:
+        raise
     except Exception as ex:
-        return jsonify({"success": False, "error": str(ex)}), 500
+        # upstream trouble is 502/503/504 (retry later), not a bug in this service
+        status = resilience.http_status(ex)
+        headers = {}
+        if isinstance(ex, (resilience.CircuitOpen, resilience.RateLimited)):
+            headers["Retry-After"] = str(int(ex.retry_after) + 1)
+        return jsonify({"success": False, "error": str(ex)}), status, headers
+
+
+@app.get("/api/maps/<map_id>")
+def api_map(map_id):
+    """HTML map when ready; 202 while it is still rendering."""
+    if not MAP_RENDERER.valid_key(map_id):
+        return jsonify({"success": False, "error": "invalid map id"}), 400
+    status = MAP_RENDERER.status(map_id)
+    if status == "ready":
+        path = MAP_RENDERER.path_for_serving(map_id)
+        if path:
+            # content-addressed: the file behind an id never changes
+            response = send_file(path, mimetype="text/html", max_age=86400)
+            response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+            return response
+        status = "unknown"  # evicted between the two checks
+    if status == "pending":
+        return jsonify({"success": True, "status": status}), 202, {"Retry-After": "1"}
+    code = 500 if status == "failed" else 404
+    return jsonify({"success": False, "status": status}), code
+
+
+@app.get("/api/maps")
+def api_map_stats():
+    return jsonify(MAP_RENDERER.stats())
+
+
+# -----------------------
+# Station tiles (GeoJSON per z/x/y, clustered at low zoom)
+# -----------------------
+TILE_CACHE_CONTROL = "public, max-age=60, must-revalidate"
+
+@app.get("/api/stations/tiles.json")
+def api_station_tilejson():
+    return jsonify(STATION_TILES.tilejson(current_stations(), "/api/stations/tiles/{z}/{x}/{y}.geojson"))
+
+@app.get("/api/stations/tiles/<int:z>/<int:x>/<int:y>.geojson")
+def api_station_tile(z, x, y):
+    if not tiles.valid_tile(z, x, y):
+        return jsonify({"success": False, "error": "tile out of range"}), 400
+    body, etag = STATION_TILES.tile(current_stations(), z, x, y)
+    headers = {"ETag": etag, "Cache-Control": TILE_CACHE_CONTROL}
+    if tiles.etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers=headers)
+    return Response(body, content_type="application/geo+json", headers=headers)
+
+@app.get("/api/stations/snapshot")
+def api_station_snapshot():
+    return jsonify({**STATIONS.stats(), "nearest_index": NEAREST.stats()})
+
+
+@app.get("/api/stations/nearest")
+def api_station_nearest():
+    """
+    ?lat=..&lng=..&k=10                 k nearest stations
+    ?lat=..&lng=..&radius_km=25[&k=..]  everything within the radius (at most k if given)
+    plus the vehicle filters of /api/route: connectors=CCS2,CHAdeMO&min_power_kw=50&available_only=1
+    Distances are straight-line km.
+    """
+    args = request.args
+    try:
+        lat, lon = parse_point(args.get("lat"), args.get("lng"))
+        station_filter = StationFilter.from_params(
+            args.get("connectors"), args.get("min_power_kw", type=float),
+            args.get("available_only", "").lower() in ("1", "true", "yes"),
+        )
+        k = args.get("k", type=int)
+        radius_km = args.get("radius_km", type=float)
+    except (TypeError, ValueError) as ex:
+        return jsonify({"success": False, "error": str(ex)}), 400
+
+    snapshot = current_stations()
+    with metrics.stage("nearest_query"):
+        if radius_km is not None:
+            found = NEAREST.within(snapshot, lat, lon, radius_km, station_filter, limit=k)
+        else:
+            found = NEAREST.knn(snapshot, lat, lon, k or 10, station_filter)
+    return jsonify({"success": True, "version": snapshot.version, "stations": found})
+
+
+
+@app.get("/api/reachable")
+def api_reachable():
+    """
+    Stations reachable by road from the current SOC, plus a reachable-area polygon.
+    ?lat=..&lng=..&soc=..  and either battery_kwh=..&kwh_per_100km=.. or full_range_km=..
+    (default 150); reserve_soc (default 10) is never planned with. Vehicle filters as in
+    /api/stations/nearest. Answers are for the origin/SOC bucket the request falls in.
+    """
+    args = request.args
+    try:
+        lat, lon = parse_point(args.get("lat"), args.get("lng"))
+        soc = args.get("soc", type=float)
+        if soc is None or not 0 <= soc <= 100:
+            raise ValueError("soc (0-100) is required")
+        battery = vehicle_range(
+            args.get("battery_kwh", type=float), args.get("kwh_per_100km", type=float),
+            args.get("full_range_km", type=float), args.get("reserve_soc", 10.0, type=float),
+        )
+        station_filter = StationFilter.from_params(
+            args.get("connectors"), args.get("min_power_kw", type=float),
+            args.get("available_only", "").lower() in ("1", "true", "yes"),
+        )
+    except (TypeError, ValueError) as ex:
+        return jsonify({"success": False, "error": str(ex)}), 400
+
+    result, cached = REACH.reachable(current_stations(), lat, lon, soc, battery, station_filter)
+    body, headers = encoding.encode(
+        {"success": True, **result}, request.headers.get("Accept"), request.headers.get("Accept-Encoding")
+    )
+    headers["Cache-Control"] = "private, max-age=30"
+    headers["X-Cache"] = "hit" if cached else "miss"
+    return Response(body, headers=headers)
+
+
+@app.get("/api/reachable/stats")
+def api_reachable_stats():
+    return jsonify(REACH.stats())
+
+
+@app.get("/api/route/corridors/stats")
+def api_route_corridors_stats():
+    return jsonify(CORRIDORS.stats())
+
+
+@app.get("/api/route/matrix/stats")
+def api_route_matrix_stats():
+    return jsonify(routing.DURATION_MATRICES.stats())
+
+@app.get("/api/upstreams")
+def api_upstreams():
+    return jsonify(resilience.stats())
+
+@app.get("/api/admission")
+def api_admission():
+    return jsonify(ADMISSION.stats())
 
 
 if __name__ == "__main__":
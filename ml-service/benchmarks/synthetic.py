@@ -0,0 +1,83 @@
+"""Synthetic inputs for the benchmarks: station sets and route polylines over Sri Lanka."""
+import math
+import random
+from typing import Any, Dict, List, Tuple
+
+from services.connectors import summarize
+
+# rough land bounding box of Sri Lanka
+LAT_RANGE = (5.95, 9.80)
+LON_RANGE = (79.70, 81.85)
+
+COLOMBO = (6.9271, 79.8612)
+KANDY = (7.2906, 80.6337)
+JAFFNA = (9.6615, 80.0255)
+CONNECTOR_TYPES = ["CCS", "CHAdeMO", "Type 2"]
+POWER_LEVELS = [7.0, 22.0, 50.0, 60.0, 120.0]
+
+
+def make_stations(n: int, seed: int = 7) -> List[Dict[str, Any]]:
+    """Station dicts shaped like EnhancedEVPlanner.load_stations output."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        lat, lon = rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)
+        power, count = rng.choice(POWER_LEVELS), rng.randint(1, 6)
+        out.append({
+            "station_id": f"st-{i}",
+            "name": f"Station {i}",
+            "address": f"{i} Main Street",
+            "lat": lat,
+            "lon": lon,
+            # same chargers the sqlite load_stations benchmark inserts
+            **summarize((CONNECTOR_TYPES[k % 3], power, "Available") for k in range(count)),
+        })
+    return out
+
+
+def make_path(n_points: int, start=COLOMBO, end=JAFFNA, seed: int = 11) -> List[Tuple[float, float]]:
+    """Road-like path: straight line with smooth lateral wiggle, rounded like a decoded polyline."""
+    rng = random.Random(seed)
+    phase = [rng.uniform(0, math.tau) for _ in range(3)]
+    out = []
+    for i in range(n_points):
+        t = i / max(1, n_points - 1)
+        wiggle = sum(0.05 / (k + 1) * math.sin((k + 2) * math.pi * t + phase[k]) for k in range(3))
+        lat = start[0] + (end[0] - start[0]) * t + wiggle * (1 - t) * t * 4
+        lon = start[1] + (end[1] - start[1]) * t - wiggle * (1 - t) * t * 4
+        out.append((round(lat, 5), round(lon, 5)))
+    return out
+
+
+def encode_polyline5(points: List[Tuple[float, float]]) -> str:
+    """Google polyline encoding (precision 1e-5), the inverse of _decode_polyline5."""
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        ilat, ilng = int(round(lat * 1e5)), int(round(lng * 1e5))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(out)
+
+
+def make_matrix(n: int, seed: int = 3) -> Dict[str, Any]:
+    """Distance Matrix API response (one origin, n destinations)."""
+    rng = random.Random(seed)
+    elements = []
+    for _ in range(n):
+        if rng.random() < 0.03:
+            elements.append({"status": "ZERO_RESULTS"})
+            continue
+        seconds = rng.randint(120, 4 * 3600)
+        meters = int(seconds * rng.uniform(8, 20))
+        elements.append({
+            "status": "OK",
+            "duration": {"value": seconds, "text": f"{seconds // 60} mins"},
+            "distance": {"value": meters, "text": f"{meters / 1000:.1f} km"},
+        })
+    return {"status": "OK", "rows": [{"elements": elements}]}
@@ -0,0 +1,51 @@
+# ml-service/build_corridors.py
+"""
+Precompute routes and corridor stations between popular cities.
+
+    python build_corridors.py                      # every ordered pair of CORRIDOR_CITIES
+    python build_corridors.py --cities Colombo,Kandy,Galle --out corridors.npz
+
+Uses the same OSRM_BASE_URL / Postgres settings as app.py. Restart (or deploy)
+the route service afterwards; it loads CORRIDOR_FILE at start.
+"""
+import argparse
+import os
+from typing import List, Optional
+
+from services import corridors
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Build the city-pair corridor artifact for the route service.")
+    parser.add_argument("--out", default=corridors.CORRIDOR_FILE, help="artifact path (CORRIDOR_FILE)")
+    parser.add_argument("--cities", default=None,
+                        help="comma-separated subset of: " + ", ".join(corridors.CORRIDOR_CITIES))
+    parser.add_argument("--alternatives", type=int, default=2, help="alternatives requested from OSRM")
+    args = parser.parse_args(argv)
+
+    cities = corridors.CORRIDOR_CITIES
+    if args.cities:
+        names = [c.strip() for c in args.cities.split(",") if c.strip()]
+        unknown = [c for c in names if c not in cities]
+        if unknown:
+            raise SystemExit(f"❌ Unknown cities: {', '.join(unknown)}")
+        cities = {c: cities[c] for c in names}
+
+    # the app module owns the planner and the station snapshot loader
+    from app import STATIONS, planner
+
+    snapshot = STATIONS.get()
+    print(f"🚗 Routing {len(cities) * (len(cities) - 1)} city pairs against {len(snapshot.stations)} stations...")
+    meta = corridors.build(
+        cities,
+        lambda a, b: planner.get_routes_from_osrm(a, b, alternatives=args.alternatives),
+        snapshot,
+        planner.stations_near_route,
+        args.out,
+    )
+    size_kb = os.path.getsize(args.out) / 1024
+    print(f"📁 {len(meta['pairs'])} corridors saved: {args.out} ({size_kb:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import csv
+import os
 import random
 from datetime import datetime, timedelta
 
@@ -350,6 +351,8 @@ def generate_dataset(num_rows=2000):
 # ------------------------------------------------------------
 def save_to_csv(dataset, filename="ev_charging_activities.csv"):
     """Save dataset to CSV file"""
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
     with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
         fieldnames = ['free_time', 'station_name', 'time', 'city', 'label(s)']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
@@ -2,20 +2,59 @@
 import json
 import math
 import os
-from typing import List, Tuple, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple, Dict, Any, Union
 
-import requests
-from geopy.distance import geodesic
+import numpy as np
+from dotenv import load_dotenv
 from flask import current_app
-from sqlalchemy import func
 
 from models import db, Station, Charger
+from services import metrics, resilience, tracing
+from services.cache import SingleFlight
+from services.connectors import StationFilter
+from services.maps import MAPS_DIR, map_key
+from services.nearest import match_route
+from services.stations import Snapshot, build_stations
 
-OSRM_URL = "https://router.project-osrm.org/route/v1/driving"
+load_dotenv()
+
+# point at a self-hosted OSRM (or the load-test fake) with OSRM_BASE_URL
+OSRM_BASE_URL = os.getenv("OSRM_BASE_URL", "https://router.project-osrm.org").rstrip("/")
+# a second OSRM (e.g. the public server behind a self-hosted one), used while the first is failing
+OSRM_FALLBACK_BASE_URL = os.getenv("OSRM_FALLBACK_BASE_URL", "").rstrip("/")
+OSRM_TIMEOUT_SECONDS = float(os.getenv("OSRM_TIMEOUT_SECONDS", "8"))
+# coordinates per /table request (origin included); the public demo server allows 100
+OSRM_TABLE_MAX_COORDS = int(os.getenv("OSRM_TABLE_MAX_COORDS", "100"))
+
+# keep-alive session; calls are traced and carry traceparent
+_HTTP = tracing.traced_session("osrm")
+# concurrent requests for the same trip share one OSRM call
+_ROUTE_FLIGHTS = SingleFlight("osrm_route")
+# deadline / retry / hedge / breaker policy (services/resilience.py)
+_OSRM = resilience.upstream("osrm", timeout=OSRM_TIMEOUT_SECONDS)
+_OSRM_FALLBACK = resilience.upstream("osrm_fallback", timeout=OSRM_TIMEOUT_SECONDS)
+# last good routes per trip, served (marked stale) while OSRM is unavailable
+STALE_ROUTES_SIZE = 256
+_STALE_ROUTES: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+_STALE_LOCK = threading.Lock()
+
+
+def _osrm_json(path: str, params: Dict[str, str]) -> Dict[str, Any]:
+    """GET {OSRM_BASE_URL}/{path} under the osrm policy; OSRM_FALLBACK_BASE_URL once that gives up."""
+    def attempt(base: str):
+        def get(timeout: float) -> Dict[str, Any]:
+            r = _HTTP.get(f"{base}/{path}", params=params, timeout=timeout)
+            r.raise_for_status()
+            return r.json()
+        return get
+
+    fallback = None
+    if OSRM_FALLBACK_BASE_URL:
+        fallback = lambda: _OSRM_FALLBACK.call(attempt(OSRM_FALLBACK_BASE_URL))
+    return _OSRM.call(attempt(OSRM_BASE_URL), fallback=fallback)
 
-def _haversine_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
-  # quick haversine in km
-  return geodesic(a, b).km
 
 def _decode_polyline5(polyline_str: str) -> List[Tuple[float, float]]:
     # Polyline algorithm (Google, precision 1e-5)
@@ -46,15 +85,6 @@ def _decode_polyline5(polyline_str: str) -> List[Tuple[float, float]]:
         coordinates.append((lat / 1e5, lng / 1e5))
     return coordinates
 
-def _point_segment_distance_km(p: Tuple[float, float], a: Tuple[float, float], b: Tuple[float, float]) -> float:
-    # distance from point p to segment ab by sampling — use geodesic for accuracy
-    # project approximately by subdividing segment if very long; here direct min of endpoints + midpoint is fine for short polylines
-    d_pa = _haversine_km(p, a)
-    d_pb = _haversine_km(p, b)
-    mid = ((a[0] + b[0]) / 2.0, (a[1] + b[1]) / 2.0)
-    d_pm = _haversine_km(p, mid)
-    return min(d_pa, d_pb, d_pm)
-
 class EnhancedEVPlanner:
     def __init__(self, max_station_distance_km: float = 5.0):
         self.max_station_distance_km = max_station_distance_km
@@ -69,115 +99,157 @@ class EnhancedEVPlanner:
     ) -> List[Dict[str, Any]]:
         """
         Returns a list of alternative routes sorted by duration (ascending).
-        Each route: { distance_km, duration_min, path: [(lat,lon), ...] }
+        Each route: { distance_km, duration_min, path: [(lat,lon), ...], segment_seconds }
+        segment_seconds is OSRM's per-segment duration annotation (None if absent).
+        Identical concurrent calls share one request; treat the result as read-only.
+        While OSRM is unavailable the last good answer for the same trip is returned,
+        each route marked "stale": True.
         """
-        coords_chain = [f"{start[1]},{start[0]}"]
         waypoints = waypoints or []
+        key = (tuple(start), tuple(end), tuple(map(tuple, waypoints)), alternatives)
+        try:
+            routes = _ROUTE_FLIGHTS.do(key, self._fetch_routes_from_osrm, start, end, waypoints, alternatives)
+        except Exception as e:
+            if not (resilience.retryable(e) or isinstance(e, resilience.UpstreamError)):
+                raise
+            with _STALE_LOCK:
+                stale = _STALE_ROUTES.get(key)
+            if stale is None:
+                raise
+            print(f"⚠️ OSRM unavailable ({e}); serving the last good routes")
+            return [dict(r, stale=True) for r in stale]
+        if routes:
+            with _STALE_LOCK:
+                _STALE_ROUTES[key] = routes
+                _STALE_ROUTES.move_to_end(key)
+                while len(_STALE_ROUTES) > STALE_ROUTES_SIZE:
+                    _STALE_ROUTES.popitem(last=False)
+        return routes
+
+    def _fetch_routes_from_osrm(self, start, end, waypoints, alternatives) -> List[Dict[str, Any]]:
+        coords_chain = [f"{start[1]},{start[0]}"]
         for w in waypoints:
             coords_chain.append(f"{w[1]},{w[0]}")
         coords_chain.append(f"{end[1]},{end[0]}")
 
-        url = f"{OSRM_URL}/{';'.join(coords_chain)}"
+        path = f"route/v1/driving/{';'.join(coords_chain)}"
         params = {
             "overview": "full",
             "alternatives": str(alternatives).lower(),  # 'true' or 'false'
             "geometries": "polyline",
             "steps": "false",
-            "annotations": "false",
+            "annotations": "duration",  # per-segment speeds for the energy model
         }
 
         # NOTE: OSRM's 'alternatives' param accepts true/false. We emulate multiple by
         # requesting 'true' and OSRM returns up to 3. Set 'alternatives=true'.
         params["alternatives"] = "true" if alternatives and alternatives > 0 else "false"
 
-        r = requests.get(url, params=params, timeout=20)
-        r.raise_for_status()
-        data = r.json()
+        with metrics.stage("routing", upstream="osrm"):
+            data = _osrm_json(path, params)
         if data.get("code") != "Ok" or not data.get("routes"):
+            metrics.external_error("osrm", data.get("code") or "NoRoute")
             return []
 
         routes = []
         for rt in data["routes"]:
             dist_km = (rt["distance"] or 0) / 1000.0
             dur_min = (rt["duration"] or 0) / 60.0
-            path = _decode_polyline5(rt["geometry"])
+            with metrics.stage("polyline_decode"):
+                path = _decode_polyline5(rt["geometry"])
+            seconds = [t for leg in rt.get("legs") or [] for t in (leg.get("annotation") or {}).get("duration", [])]
             routes.append({
                 "distance_km": dist_km,
                 "duration_min": dur_min,
-                "path": path
+                "path": path,
+                "segment_seconds": seconds if len(seconds) == len(path) - 1 else None,
             })
 
         # Sort by duration ascending, shortest first
         routes.sort(key=lambda x: x["duration_min"])
         return routes
 
+    def get_table_from_osrm(
+        self,
+        origin: Tuple[float, float],
+        destinations: List[Tuple[float, float]],
+    ) -> List[Optional[Tuple[float, float]]]:
+        """
+        Road (distance_km, duration_min) from origin to each destination, None where
+        OSRM found no route. Split into requests of OSRM_TABLE_MAX_COORDS coordinates.
+        """
+        out: List[Optional[Tuple[float, float]]] = []
+        step = max(1, OSRM_TABLE_MAX_COORDS - 1)
+        for i in range(0, len(destinations), step):
+            chunk = destinations[i:i + step]
+            coords = ";".join(f"{lon},{lat}" for lat, lon in [origin, *chunk])
+            params = {"sources": "0", "annotations": "distance,duration"}
+            with metrics.stage("routing_table", upstream="osrm"):
+                data = _osrm_json(f"table/v1/driving/{coords}", params)
+            if data.get("code") != "Ok":
+                metrics.external_error("osrm", data.get("code") or "NoTable")
+                raise RuntimeError(f"OSRM table failed: {data.get('code')}")
+            distances, durations = data["distances"][0], data["durations"][0]
+            for j in range(1, len(chunk) + 1):
+                km, sec = distances[j], durations[j]
+                out.append((km / 1000.0, sec / 60.0) if km is not None and sec is not None else None)
+        return out
+
+    def get_matrix_from_osrm(self, points: List[Tuple[float, float]]) -> np.ndarray:
+        """All-pairs road duration in seconds (NaN where OSRM found no route), one table request."""
+        if len(points) > OSRM_TABLE_MAX_COORDS:
+            raise ValueError(f"at most {OSRM_TABLE_MAX_COORDS} points per duration matrix")
+        coords = ";".join(f"{lon},{lat}" for lat, lon in points)
+        with metrics.stage("routing_matrix", upstream="osrm"):
+            data = _osrm_json(f"table/v1/driving/{coords}", {"annotations": "duration"})
+        if data.get("code") != "Ok":
+            metrics.external_error("osrm", data.get("code") or "NoTable")
+            raise RuntimeError(f"OSRM table failed: {data.get('code')}")
+        return np.array([[np.nan if sec is None else sec for sec in row] for row in data["durations"]], dtype=float)
+
     # ---------- STATIONS ----------
     def load_stations(self) -> List[Dict[str, Any]]:
         """
-        Load all stations + their charger info (max power, status counts).
+        Load all stations + their charger info: max power, connector bitmask,
+        max power per connector type, charger and available counts.
         """
-        # Pull stations
-        stations = db.session.query(Station).all()
-
-        # Build map for chargers grouped by station
-        chargers = (
-            db.session.query(
-                Charger.station_id,
-                func.max(Charger.power_kw).label("max_power_kw"),
-                func.count(Charger.charger_id).label("charger_count")
-            )
-            .group_by(Charger.station_id)
-            .all()
-        )
-        chargers_by_station = {c.station_id: {"max_power_kw": float(c.max_power_kw or 0.0),
-                                              "charger_count": int(c.charger_count or 0)}
-                               for c in chargers}
-
-        out = []
-        for st in stations:
-            meta = chargers_by_station.get(st.station_id, {"max_power_kw": 0.0, "charger_count": 0})
-            out.append({
-                "station_id": st.station_id,
-                "name": st.name,
-                "address": st.address,
-                "lat": float(st.latitude),
-                "lon": float(st.longitude),
-                "max_power_kw": meta["max_power_kw"],
-                "charger_count": meta["charger_count"],
-            })
-        return out
+        stations = db.session.query(
+            Station.station_id, Station.name, Station.address,
+            Station.latitude.label("lat"), Station.longitude.label("lon"),
+        ).all()
+        chargers = db.session.query(Charger.station_id, Charger.type, Charger.power_kw, Charger.status).all()
+        return build_stations((st._asdict() for st in stations), chargers)
 
-    def stations_near_route(self, route_polyline: List[Tuple[float, float]], stations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def stations_near_route(self, route_polyline: List[Tuple[float, float]],
+                            stations: Union[Snapshot, Sequence[Dict[str, Any]]],
+                            station_filter: Optional[StationFilter] = None) -> List[Dict[str, Any]]:
         """
         Returns stations within self.max_station_distance_km from the route polyline.
         Adds distance_to_route_km to each matched station and sorts by it.
+        Pass the Snapshot rather than a station list where there is one: its numpy
+        columns and cached filter masks are used, and only matched stations are read.
+        `station_filter` (connectors / min power) is applied first.
         """
+        if isinstance(stations, Snapshot):
+            records, lats, lons = stations.stations, stations.arrays.lat, stations.arrays.lon
+            keep = stations.mask(station_filter) if station_filter is not None and station_filter.active else None
+        else:
+            records = station_filter.apply(stations) if station_filter is not None else stations
+            lats = np.fromiter((s["lat"] for s in records), dtype=np.float64, count=len(records))
+            lons = np.fromiter((s["lon"] for s in records), dtype=np.float64, count=len(records))
+            keep = None
         near = []
-        for s in stations:
-            p = (s["lat"], s["lon"])
-            # min distance to any route segment (sample endpoints + midpoint)
-            best = float("inf")
-            for i in range(len(route_polyline) - 1):
-                a = route_polyline[i]
-                b = route_polyline[i + 1]
-                d = _point_segment_distance_km(p, a, b)
-                if d < best:
-                    best = d
-                    if best <= self.max_station_distance_km:
-                        # small optimization: if already inside threshold and very close, break early
-                        if best < 0.1:
-                            break
-            if best <= self.max_station_distance_km:
-                s2 = dict(s)
-                s2["distance_to_route_km"] = round(best, 2)
-                near.append(s2)
-        near.sort(key=lambda x: x["distance_to_route_km"])
+        for i, dist in match_route(route_polyline, lats, lons, self.max_station_distance_km, keep):
+            s2 = dict(records[i])
+            s2["distance_to_route_km"] = dist
+            near.append(s2)
         return near
 
     # ---------- Optional map builder (Folium) ----------
-    def build_map(self, start, end, routes, stations, filename=None):
+    def build_map(self, start, end, routes, stations, filename=None, directory=MAPS_DIR):
         """
         If you want a shareable HTML map, enable Folium in your env and use this.
+        Requests render it in the background through services.maps.MAP_RENDERER.
         """
         try:
             import folium
@@ -211,8 +283,8 @@ class EnhancedEVPlanner:
                 tooltip=f'{s["name"]} • {s.get("max_power_kw",0)} kW',
             ).add_to(m)
 
-        os.makedirs("maps", exist_ok=True)
-        name = filename or f"route_{abs(hash((start, end))) % 10**8}.html"
-        path = os.path.join("maps", name)
+        os.makedirs(directory, exist_ok=True)
+        name = filename or f"route_{map_key(start, end, routes, stations)}.html"
+        path = os.path.join(directory, name)
         m.save(path)
         return name
@@ -5,16 +5,22 @@ from typing import Any, Dict, List, Tuple
 
 import async_lru
 import httpx
-from geopy.distance import geodesic
+import numpy as np
 from pydantic import BaseModel
 from sqlalchemy import Column, Float, Integer, String, create_engine, func
 from sqlalchemy.orm import Session, declarative_base
 
+from services import routing
+from services.nearest import match_route
+
+GOOGLE_MAPS_BASE_URL = os.getenv("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com").rstrip("/")
+
 # ---------------- Pydantic DTOs ----------------
 class RouteDTO(BaseModel):
     distance_km: float
     duration_min: float
     path: List[Tuple[float, float]]  # [(lat, lon), ...]
+    waypoint_order: List[int] | None = None  # indices into the requested waypoints
 
 class StationDTO(BaseModel):
     station_id: int
@@ -74,17 +80,6 @@ def _decode_polyline5(polyline_str: str) -> List[Tuple[float, float]]:
         coordinates.append((lat / 1e5, lng / 1e5))
     return coordinates
 
-def _haversine_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
-    return geodesic(a, b).km
-
-def _point_segment_distance_km(p: Tuple[float, float], a: Tuple[float, float], b: Tuple[float, float]) -> float:
-    # sample endpoints + midpoint (fast & accurate enough for overview polylines)
-    d_pa = _haversine_km(p, a)
-    d_pb = _haversine_km(p, b)
-    mid = ((a[0] + b[0]) / 2.0, (a[1] + b[1]) / 2.0)
-    d_pm = _haversine_km(p, mid)
-    return min(d_pa, d_pb, d_pm)
-
 # ---------------- Planner ----------------
 class GoogleEVPlanner:
     def __init__(self, google_api_key: str, max_station_distance_km: float = 5.0):
@@ -123,7 +118,7 @@ class GoogleEVPlanner:
         waypoints: Tuple[Tuple[float, float], ...],
         alternatives: bool,
     ) -> Dict[str, Any]:
-        base_url = "https://maps.googleapis.com/maps/api/directions/json"
+        base_url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/directions/json"
 
         origin_str = f"{origin[0]},{origin[1]}"
         dest_str = f"{destination[0]},{destination[1]}"
@@ -140,9 +135,45 @@ class GoogleEVPlanner:
             w = "|".join([f"{lat},{lng}" for (lat, lng) in waypoints])
             params["waypoints"] = w
 
-        r = await self._client.get(base_url, params=params)
-        r.raise_for_status()
-        return r.json()
+        async def get(timeout: float) -> Dict[str, Any]:
+            r = await self._client.get(base_url, params=params, timeout=httpx.Timeout(timeout, connect=min(timeout, 3.0)))
+            r.raise_for_status()
+            return r.json()
+
+        return await routing.GOOGLE.call_async(get)
+
+    # --------------- Waypoint order ---------------
+    async def _google_duration_matrix(self, points: List[Tuple[float, float]]) -> np.ndarray:
+        """All-pairs driving seconds via the Distance Matrix API (NaN = no route)."""
+        base_url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/distancematrix/json"
+        matrix = np.full((len(points), len(points)), np.nan)
+        for first_row, params in routing.google_matrix_requests(points):
+            async def get(timeout: float, params=params) -> Dict[str, Any]:
+                r = await self._client.get(base_url, params={**params, "key": self.google_api_key},
+                                           timeout=httpx.Timeout(timeout, connect=min(timeout, 3.0)))
+                r.raise_for_status()
+                return r.json()
+
+            routing.google_matrix_fill(matrix, first_row, await routing.GOOGLE.call_async(get))
+        return matrix
+
+    async def order_waypoints(
+        self,
+        start: Tuple[float, float],
+        end: Tuple[float, float],
+        waypoints: List[Tuple[float, float]],
+    ) -> Tuple[List[Tuple[float, float]], Dict[str, Any] | None]:
+        """Waypoints in drive-time order from a cached duration matrix; the given order if that fails."""
+        if len(waypoints) < 2:
+            return waypoints, None
+        points = routing.route_points(start, end, waypoints)
+        try:
+            # concurrent requests for the same stops share one Distance Matrix fetch
+            matrix, cached = await routing.DURATION_MATRICES.get_or_fetch_async("google", points, self._google_duration_matrix)
+        except (httpx.HTTPError, RuntimeError, TimeoutError) as e:
+            print(f"⚠️ Google distance matrix failed, keeping the given waypoint order: {e}")
+            return waypoints, None
+        return routing.order_stops(waypoints, matrix, cached)
 
     async def get_routes_from_google(
         self,
@@ -150,10 +181,16 @@ class GoogleEVPlanner:
         end: Tuple[float, float],
         waypoints: List[Tuple[float, float]] | None = None,
         alternatives: bool = True,
+        optimize_waypoints: bool = True,
     ) -> List[RouteDTO]:
 
+        waypoints = list(waypoints or [])
+        info = None
+        if optimize_waypoints:
+            waypoints, info = await self.order_waypoints(start, end, waypoints)
+
         data = await self._google_directions_cached(
-            start, end, tuple(waypoints or []), alternatives
+            start, end, tuple(waypoints), alternatives
         )
 
         if data.get("status") != "OK":
@@ -178,6 +215,7 @@ class GoogleEVPlanner:
                     distance_km=round(dist_m / 1000.0, 2),
                     duration_min=round(dur_s / 60.0, 1),
                     path=path,
+                    waypoint_order=info["order"] if info else None,
                 )
             )
 
@@ -232,31 +270,13 @@ class GoogleEVPlanner:
         stations: List[StationDTO],
     ) -> List[StationDTO]:
         """Return stations within threshold from the route polyline."""
+        lats = np.fromiter((st.lat for st in stations), dtype=np.float64, count=len(stations))
+        lons = np.fromiter((st.lon for st in stations), dtype=np.float64, count=len(stations))
         near: List[StationDTO] = []
-        n = len(route_polyline)
-
-        for st in stations:
-            p = (st.lat, st.lon)
-            best = float("inf")
-
-            # scan in coarse steps to reduce checks on long polylines
-            # but sample neighbors to maintain accuracy
-            step = 3 if n > 300 else 1
-            i = 0
-            while i < n - 1:
-                a = route_polyline[i]
-                b = route_polyline[i + 1]
-                d = _point_segment_distance_km(p, a, b)
-                if d < best:
-                    best = d
-                    if best < 0.15:  # ~150m early stop
-                        break
-                i += step
-
-            if best <= self.max_station_distance_km:
-                st_copy = st.copy()
-                st_copy.distance_to_route_km = round(best, 2)
-                near.append(st_copy)
+        for i, dist in match_route(route_polyline, lats, lons, self.max_station_distance_km):
+            st_copy = stations[i].copy()
+            st_copy.distance_to_route_km = dist
+            near.append(st_copy)
 
         near.sort(key=lambda s: (s.distance_to_route_km or 0.0, -s.max_power_kw))
         return near
@@ -0,0 +1,289 @@
+"""
+Load test for the route API (app.py, :8000) and the chat API (model/new_model, :8001).
+
+    # terminal 1: fake OSRM / Google / Groq (prints the env for the services)
+    python loadtest/fake_upstreams.py --latency-ms 150
+    # terminal 2/3: start app.py and the chat service with that env
+    # terminal 4:
+    python loadtest/run_loadtest.py --scenario route --concurrency 32 --duration 60
+    python loadtest/run_loadtest.py --scenario chat --rate 50 --duration 60 --json loadtest/results/chat.json
+
+--concurrency N runs a closed loop (N virtual users, each waits for its reply).
+--rate R runs an open loop: requests are scheduled at R/s regardless of how
+fast the server answers, and latency is measured from the scheduled send
+time, so queueing delay shows up in the percentiles instead of being hidden
+by slower senders. --with-fakes starts the fake upstreams in-process (the
+services still have to be started with service_env() pointing at them).
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
+
+import fake_upstreams  # noqa: E402
+
+TOWNS = fake_upstreams.TOWNS
+
+CHAT_TURNS = [
+    "Hi, I'm heading out with my family for the weekend",
+    "Which station is best?",
+    "How long will I wait there?",
+    "ok thanks",
+    "Anything to do nearby while charging?",
+]
+
+
+# -----------------------
+# Request generators: each returns (endpoint, method, url, json_body)
+# -----------------------
+def route_requests(base_url: str, rng: random.Random):
+    names = list(TOWNS)
+    while True:
+        a, b = rng.sample(names, 2)
+        body = {
+            "start": {"lat": TOWNS[a][0], "lng": TOWNS[a][1]},
+            "end": {"lat": TOWNS[b][0], "lng": TOWNS[b][1]},
+        }
+        if rng.random() < 0.2:
+            c = rng.choice([n for n in names if n not in (a, b)])
+            body["stops"] = [{"lat": TOWNS[c][0], "lng": TOWNS[c][1]}]
+        yield "/api/route", "POST", f"{base_url}/api/route", body
+
+
+def _stations_between(a: Tuple[float, float], b: Tuple[float, float], rng: random.Random, n: int = 8) -> List[dict]:
+    out = []
+    for i in range(n):
+        t = (i + 1) / (n + 1)
+        lat = a[0] + (b[0] - a[0]) * t + rng.uniform(-0.02, 0.02)
+        lng = a[1] + (b[1] - a[1]) * t + rng.uniform(-0.02, 0.02)
+        out.append({"name": f"LT Station {i}", "lat": round(lat, 5), "lng": round(lng, 5),
+                    "address": f"Load test road {i}", "status": "Available"})
+    return out
+
+
+def chat_requests(base_url: str, rng: random.Random):
+    """Conversations as the app sends them: full trip on the first turn, deltas afterwards."""
+    names = list(TOWNS)
+    url = f"{base_url}/chat"
+    while True:
+        a, b = rng.sample(names, 2)
+        conversation_id = f"lt-{uuid.uuid4().hex[:12]}"
+        first = {
+            "conversation_id": conversation_id,
+            "start_city": a,
+            "end_city": b,
+            "start_lat": TOWNS[a][0],
+            "start_lng": TOWNS[a][1],
+            "soc_level": rng.randrange(15, 90),
+            "user_text": CHAT_TURNS[0],
+            "stations": _stations_between(TOWNS[a], TOWNS[b], rng),
+        }
+        yield "/chat[first]", "POST", url, first
+        for text in CHAT_TURNS[1:rng.randrange(2, len(CHAT_TURNS) + 1)]:
+            yield "/chat[delta]", "POST", url, {"conversation_id": conversation_id, "user_text": text}
+
+
+def reachable_requests(base_url: str, rng: random.Random):
+    """Map-view range checks: drivers scattered a few km around towns, any SOC."""
+    names = list(TOWNS)
+    while True:
+        lat, lng = TOWNS[rng.choice(names)]
+        lat, lng = lat + rng.uniform(-0.05, 0.05), lng + rng.uniform(-0.05, 0.05)
+        url = (f"{base_url}/api/reachable?lat={lat:.5f}&lng={lng:.5f}&soc={rng.randrange(10, 95)}"
+               f"&battery_kwh=40&kwh_per_100km={rng.choice([15, 17, 20])}")
+        yield "/api/reachable", "GET", url, None
+
+
+SCENARIOS: Dict[str, Callable] = {"route": route_requests, "chat": chat_requests, "reachable": reachable_requests}
+
+
+# -----------------------
+# Recording
+# -----------------------
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+
+    def record(self, endpoint: str, seconds: float, error: Optional[str]):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if error:
+                bucket = self.errors.setdefault(endpoint, {})
+                bucket[error] = bucket.get(error, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        out = {}
+        with self.lock:
+            for endpoint, values in sorted(self.samples.items()):
+                values = sorted(values)
+                n = len(values)
+                errors = sum(self.errors.get(endpoint, {}).values())
+
+                def pct(p):
+                    return round(values[min(n - 1, int(p * n))] * 1000, 1)
+
+                out[endpoint] = {
+                    "requests": n,
+                    "errors": errors,
+                    "error_kinds": dict(self.errors.get(endpoint, {})),
+                    "throughput_rps": round(n / elapsed, 2) if elapsed else 0.0,
+                    "p50_ms": pct(0.50),
+                    "p95_ms": pct(0.95),
+                    "p99_ms": pct(0.99),
+                    "max_ms": round(values[-1] * 1000, 1),
+                }
+        return out
+
+
+_LOCAL = threading.local()
+
+
+def _local_session() -> requests.Session:
+    if not hasattr(_LOCAL, "session"):
+        _LOCAL.session = requests.Session()
+    return _LOCAL.session
+
+
+def send(recorder: Recorder, item, started_at: float, timeout: float):
+    endpoint, method, url, body = item
+    error = None
+    try:
+        res = _local_session().request(method, url, json=body, timeout=timeout)
+        if res.status_code >= 400:
+            error = f"http_{res.status_code}"
+        elif endpoint in ("/api/route", "/api/reachable") and not res.json().get("success"):
+            error = "success_false"
+    except requests.Timeout:
+        error = "timeout"
+    except requests.RequestException as ex:
+        error = type(ex).__name__
+    recorder.record(endpoint, time.perf_counter() - started_at, error)
+
+
+# -----------------------
+# Drivers
+# -----------------------
+def run_closed(gen_factory: Callable, concurrency: int, duration: float, timeout: float, seed: int) -> Recorder:
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def user(i: int):
+        # every virtual user walks its own stream (chat turns must stay in order per conversation)
+        for item in gen_factory(random.Random(seed * 1000 + i)):
+            if time.perf_counter() >= deadline:
+                return
+            send(recorder, item, time.perf_counter(), timeout)
+
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder
+
+
+def run_open(gen_factory: Callable, rate: float, duration: float, timeout: float, seed: int,
+             max_in_flight: int) -> Recorder:
+    recorder = Recorder()
+    items = gen_factory(random.Random(seed))
+    interval = 1.0 / rate
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for k in itertools.count():
+            scheduled = start + k * interval
+            if scheduled - start >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # latency counts from `scheduled`, including time spent waiting for a free worker
+            pool.submit(send, recorder, next(items), scheduled, timeout)
+    return recorder
+
+
+def print_summary(summary: Dict[str, dict]):
+    print(f"\n{'endpoint':<16}{'reqs':>8}{'err':>6}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for endpoint, s in summary.items():
+        print(f"{endpoint:<16}{s['requests']:>8}{s['errors']:>6}{s['throughput_rps']:>9.1f}"
+              f"{s['p50_ms']:>8.1f}ms{s['p95_ms']:>8.1f}ms{s['p99_ms']:>8.1f}ms{s['max_ms']:>8.1f}ms")
+        if s["error_kinds"]:
+            print(f"{'':<16}errors: {s['error_kinds']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Load test the route and chat APIs.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="route")
+    parser.add_argument("--route-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--chat-url", default="http://127.0.0.1:8001")
+    parser.add_argument("--concurrency", type=int, default=16, help="closed loop: virtual users")
+    parser.add_argument("--rate", type=float, default=None, help="open loop: requests per second")
+    parser.add_argument("--max-in-flight", type=int, default=512, help="open loop: sender threads")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", default=None, help="write the summary to this file")
+    parser.add_argument("--with-fakes", action="store_true", help="start fake upstreams in this process")
+    fake_upstreams.add_profile_args(parser)
+    args = parser.parse_args(argv)
+
+    if args.with_fakes:
+        urls, _, fake_stats = fake_upstreams.start_fakes(fake_upstreams.profiles_from_args(args))
+        print("Fake upstreams running; services must be started with:")
+        for key, value in fake_upstreams.service_env(urls).items():
+            print(f"  export {key}={value}")
+
+    base_url = args.chat_url if args.scenario == "chat" else args.route_url
+    scenario = SCENARIOS[args.scenario]
+
+    def gen_factory(rng):
+        return scenario(base_url, rng)
+
+    mode = f"open loop @ {args.rate}/s" if args.rate else f"closed loop x{args.concurrency}"
+    print(f"Running {args.scenario} ({mode}) for {args.duration:.0f}s against {base_url}...")
+    started = time.perf_counter()
+    if args.rate:
+        recorder = run_open(gen_factory, args.rate, args.duration, args.timeout, args.seed, args.max_in_flight)
+    else:
+        recorder = run_closed(gen_factory, args.concurrency, args.duration, args.timeout, args.seed)
+    elapsed = time.perf_counter() - started
+
+    summary = recorder.summary(elapsed)
+    print_summary(summary)
+
+    if args.json:
+        report = {
+            "scenario": args.scenario,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": None if args.rate else args.concurrency,
+            "duration_s": round(elapsed, 2),
+            "endpoints": summary,
+        }
+        if args.with_fakes:
+            report["upstream_calls"] = dict(fake_stats.counts)
+        out_dir = os.path.dirname(args.json)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n📁 Results saved: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
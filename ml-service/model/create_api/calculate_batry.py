@@ -1,7 +1,14 @@
 class BatteryRange:
-    def __init__(self, full_range_km=150):
+    def __init__(self, full_range_km=150, reserve_soc=0):
         self.full_range = full_range_km
+        self.reserve_soc = reserve_soc  # % kept in hand, never planned with
+
+    @classmethod
+    def from_consumption(cls, battery_kwh, kwh_per_100km, reserve_soc=0):
+        return cls(battery_kwh / kwh_per_100km * 100, reserve_soc)
 
     def get_range(self, soc):
-        return (soc / 100) * self.full_range
+        return (max(0, soc - self.reserve_soc) / 100) * self.full_range
 
+    def soc_after(self, soc, km):
+        return soc - km / self.full_range * 100
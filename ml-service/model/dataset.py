@@ -1,117 +1,202 @@
-import csv
-import random
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
 
 # Configuration
 NUM_ROWS = 20000
-OUTPUT_FILE = "ev_activity_data_v2.csv"
+CHUNK_SIZE = 250_000
+OUTPUT_FILE = "ev_activity_data_v3.csv"
+DEFAULT_SEED = 42
 
 # Metadata
 cities = ["Colombo", "Kandy", "Galle", "Negombo", "Katunayake", "Matara", "Kurunegala", "Anuradhapura"]
 months = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November",
           "December"]
 days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+# Model-side user types (see ml_predictor.app_user_to_model_user)
+user_types = ["Office_Worker", "Tourist", "Delivery_Driver", "Casual_User"]
+charging_times = [15, 30, 45, 60, 75, 90]
+
+COLUMNS = ["user_type", "charging_time", "time", "day", "month", "is_festival", "is_weekend", "city", "label"]
+
+# One bit per activity; a row's label is the bitmask looked up in LABEL_TABLE
+ACTIVITIES = ["breakfast", "lunch", "dinner", "tea/coffee shop", "shopping", "visit beautiful place"]
+BREAKFAST, LUNCH, DINNER, TEA, SHOPPING, VISIT = (np.uint8(1 << i) for i in range(len(ACTIVITIES)))
+LABEL_TABLE = np.array(
+    [", ".join(a for i, a in enumerate(ACTIVITIES) if mask >> i & 1) or "none" for mask in range(1 << len(ACTIVITIES))],
+    dtype=object,
+)
+
+_TIME_TABLE = np.array([f"{h:02d}:{m:02d}" for h in range(24) for m in (0, 15, 30, 45)], dtype=object)
+_FESTIVAL_MONTHS = np.isin(np.arange(12), [months.index("April"), months.index("December")])
+_WEEKEND_DAYS = np.isin(np.arange(7), [days.index("Saturday"), days.index("Sunday")])
 
 
-def generate_label(charging_time, hour, is_festival, is_weekend):
+def _between(hour: np.ndarray, lo: int, hi: int) -> np.ndarray:
+    return (hour >= lo) & (hour <= hi)
+
+
+def generate_labels(rng: np.random.Generator, charging_time, hour, is_festival, is_weekend) -> np.ndarray:
     """
-    ML Logic Engine: Probabilistic Rule-Based Labeling
+    ML Logic Engine: Probabilistic Rule-Based Labeling, evaluated as array masks.
     Gaps are removed by checking hour ranges continuously.
     """
-    labels = []
-
-    # Probability Factor for Overfitting Prevention (Noise)
-    if random.random() < 0.05:
-        return "none"
+    n = len(charging_time)
+    bits = np.zeros(n, dtype=np.uint8)
+    roll = rng.random(n)
+    fest = is_festival.astype(bool)
+    wknd = is_weekend.astype(bool)
 
     # --- Rule 1: 15 Minutes ---
-    if charging_time == 15:
-        if is_festival or random.random() < 0.15:
-            labels.append("shopping")
-        else:
-            labels.append("none")
+    m = charging_time == 15
+    bits[m & (fest | (roll < 0.15))] |= SHOPPING
 
     # --- Rule 2: 30 Minutes ---
-    elif charging_time == 30:
-        if (6 <= hour <= 9) or (15 <= hour <= 18) or (21 <= hour <= 23):
-            labels.append("tea/coffee shop")
-        if is_festival or (is_weekend and random.random() < 0.4):
-            labels.append("shopping")
-        if not labels: labels.append("none")
-
-    # --- Rule 3: 45 Minutes ---
-    elif charging_time == 45:
-        if 7 <= hour <= 9:
-            labels.append("breakfast")
-        elif 12 <= hour <= 14:
-            labels.append("lunch")
-        elif 19 <= hour <= 21:
-            labels.append("dinner")
-        else:
-            labels.append("tea/coffee shop")
-
-        if is_festival or random.random() < 0.5:
-            labels.append("shopping")
-
-    # --- Rule 4: 60 Minutes ---
-    elif charging_time == 60:
-        if 7 <= hour <= 9:
-            labels.append("breakfast")
-        elif 12 <= hour <= 14:
-            labels.append("lunch")
-        elif 19 <= hour <= 21:
-            labels.append("dinner")
-
-        labels.append("shopping")  # High probability for shopping in 1 hour
-        if is_weekend: labels.append("visit beautiful place")
+    m = charging_time == 30
+    tea_hours = _between(hour, 6, 9) | _between(hour, 15, 18) | _between(hour, 21, 23)
+    bits[m & tea_hours] |= TEA
+    bits[m & (fest | (wknd & (roll < 0.4)))] |= SHOPPING
+
+    # --- Rule 3 & 4: 45 / 60 Minutes share the meal windows ---
+    m45, m60 = charging_time == 45, charging_time == 60
+    meal = m45 | m60
+    breakfast, lunch, dinner = _between(hour, 7, 9), _between(hour, 12, 14), _between(hour, 19, 21)
+    bits[meal & breakfast] |= BREAKFAST
+    bits[meal & lunch] |= LUNCH
+    bits[meal & dinner] |= DINNER
+    bits[m45 & ~(breakfast | lunch | dinner)] |= TEA
+    bits[m45 & (fest | (roll < 0.5))] |= SHOPPING
+    bits[m60] |= SHOPPING  # High probability for shopping in 1 hour
+    bits[m60 & wknd] |= VISIT
 
     # --- Rule 5: 75 & 90 Minutes ---
-    elif charging_time >= 75:
-        # Meals are high priority
-        if 7 <= hour <= 10:
-            labels.append("breakfast")
-        elif 11 <= hour <= 15:
-            labels.append("lunch")
-        elif 18 <= hour <= 22:
-            labels.append("dinner")
-
-        # Leisure activities
-        if is_weekend or random.random() < 0.6:
-            labels.append("visit beautiful place")
-
-        labels.append("shopping")
-
-    # Cleanup and format
-    unique_labels = list(set(labels))
-    if len(unique_labels) > 1 and "none" in unique_labels:
-        unique_labels.remove("none")
+    m = charging_time >= 75
+    bits[m & _between(hour, 7, 10)] |= BREAKFAST
+    bits[m & _between(hour, 11, 15)] |= LUNCH
+    bits[m & _between(hour, 18, 22)] |= DINNER
+    bits[m & (wknd | (roll < 0.6))] |= VISIT
+    bits[m] |= SHOPPING
 
-    return ", ".join(unique_labels) if unique_labels else "none"
+    # Probability Factor for Overfitting Prevention (Noise)
+    bits[rng.random(n) < 0.05] = 0
 
+    return LABEL_TABLE[bits]
 
-# --- Main Generation Loop ---
-dataset = []
-for _ in range(NUM_ROWS):
-    city = random.choice(cities)
-    month = random.choice(months)
-    day = random.choice(days)
-    charging_time = random.choice([15, 30, 45, 60, 75, 90])
 
-    hour = random.randint(0, 23)
-    minute = random.choice([0, 15, 30, 45])
-    time_str = f"{hour:02d}:{minute:02d}"
+def generate_chunk(num_rows: int, seed: np.random.SeedSequence) -> pd.DataFrame:
+    """One chunk of rows drawn from its own child seed (independent of worker count)."""
+    rng = np.random.default_rng(seed)
 
-    is_festival = 1 if month in ["April", "December"] else 0
-    is_weekend = 1 if day in ["Saturday", "Sunday"] else 0
+    charging_time = rng.choice(np.array(charging_times), size=num_rows)
+    hour = rng.integers(0, 24, size=num_rows)
+    quarter = rng.integers(0, 4, size=num_rows)
+    day_idx = rng.integers(0, len(days), size=num_rows)
+    month_idx = rng.integers(0, len(months), size=num_rows)
 
-    label = generate_label(charging_time, hour, is_festival, is_weekend)
+    is_festival = _FESTIVAL_MONTHS[month_idx].astype(np.int8)
+    is_weekend = _WEEKEND_DAYS[day_idx].astype(np.int8)
 
-    dataset.append([charging_time, time_str, day, month, is_festival, is_weekend, city, label])
+    return pd.DataFrame({
+        "user_type": np.array(user_types, dtype=object)[rng.integers(0, len(user_types), size=num_rows)],
+        "charging_time": charging_time,
+        "time": _TIME_TABLE[hour * 4 + quarter],
+        "day": np.array(days, dtype=object)[day_idx],
+        "month": np.array(months, dtype=object)[month_idx],
+        "is_festival": is_festival,
+        "is_weekend": is_weekend,
+        "city": np.array(cities, dtype=object)[rng.integers(0, len(cities), size=num_rows)],
+        "label": generate_labels(rng, charging_time, hour, is_festival, is_weekend),
+    }, columns=COLUMNS)
 
-# --- Save to CSV ---
-header = ["charging_time", "time", "day", "month", "is_festival", "is_weekend", "city", "label"]
-with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as f:
-    writer = csv.writer(f)
-    writer.writerow(header)
-    writer.writerows(dataset)
 
-print(f"Dataset generated successfully: {OUTPUT_FILE} (20,000 rows)")
\ No newline at end of file
+def iter_chunks(num_rows: int, chunk_size: int = CHUNK_SIZE, seed: int = DEFAULT_SEED,
+                workers: int = 1) -> Iterator[pd.DataFrame]:
+    """
+    Yield the dataset chunk by chunk, in order. With workers > 1 chunks are built in a
+    process pool with a bounded look-ahead so memory stays at ~2 chunks per worker.
+    Output is identical for any worker count given the same seed and chunk_size.
+    """
+    sizes = [min(chunk_size, num_rows - start) for start in range(0, num_rows, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    if workers <= 1:
+        for size, ss in zip(sizes, seeds):
+            yield generate_chunk(size, ss)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        jobs = iter(zip(sizes, seeds))
+        for size, ss in jobs:
+            pending.append(pool.submit(generate_chunk, size, ss))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            chunk = pending.pop(0).result()
+            nxt = next(jobs, None)
+            if nxt is not None:
+                pending.append(pool.submit(generate_chunk, *nxt))
+            yield chunk
+
+
+def write_dataset(path: str, chunks: Iterator[pd.DataFrame], fmt: Optional[str] = None) -> int:
+    """Stream chunks to CSV or Parquet; returns the number of rows written."""
+    fmt = fmt or ("parquet" if path.endswith(".parquet") else "csv")
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+
+    total = 0
+    if fmt == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, header=(i == 0), index=False)
+                total += len(chunk)
+        return total
+
+    if fmt != "parquet":
+        raise ValueError(f"unsupported format: {fmt}")
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)") from e
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression="zstd")
+            writer.write_table(table)
+            total += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return total
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate the synthetic EV activity dataset.")
+    parser.add_argument("--rows", type=int, default=NUM_ROWS)
+    parser.add_argument("--output", default=OUTPUT_FILE, help=".csv or .parquet")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--workers", type=int, default=1, help="processes generating chunks")
+    args = parser.parse_args(argv)
+
+    total = write_dataset(
+        args.output,
+        iter_chunks(args.rows, args.chunk_size, args.seed, args.workers),
+        args.format,
+    )
+    print(f"Dataset generated successfully: {args.output} ({total:,} rows)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "600"))
+CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "2048"))
+CACHE_MAX_PER_CONTEXT = int(os.getenv("CHAT_CACHE_MAX_PER_CONTEXT", "32"))
+CACHE_MIN_SIMILARITY = float(os.getenv("CHAT_CACHE_MIN_SIMILARITY", "0.82"))
+
+# thresholds reported in stats so the cut-off can be tuned from real traffic
+_TUNING_THRESHOLDS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0)
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+# -----------------------
+# Text normalization
+# -----------------------
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents/emoji/punctuation and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", text or "").lower()
+    return " ".join(_WORD_RE.findall(text))
+
+
+def _terms(normalized: str) -> List[str]:
+    words = normalized.split()
+    # unigrams + bigrams: "which station" and "station which" should not match
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+def _station_name(s: Optional[dict]) -> str:
+    return (s or {}).get("name") or ""
+
+
+def build_context_key(
+    user_type: str,
+    best: dict,
+    sorted_list: list,
+    activities: str,
+    start_city: str,
+    end_city: str,
+    charging_minutes: Optional[int] = None,
+) -> Tuple:
+    """
+    Everything a reply depends on apart from the user text itself.
+    Two turns with the same context and similar text get the same answer.
+    """
+    alternatives = tuple(
+        _station_name(s) for s in sorted_list if _station_name(s) != _station_name(best)
+    )[:2]
+    return (
+        normalize_text(start_city),
+        normalize_text(end_city),
+        user_type or "",
+        _station_name(best),
+        alternatives,
+        activities or "",
+        # the reply quotes the charging time, so it is part of the answer
+        charging_minutes,
+    )
+
+
+# -----------------------
+# Cache
+# -----------------------
+class _Entry:
+    __slots__ = ("normalized", "tf", "assistant_text", "created_at")
+
+    def __init__(self, normalized: str, tf: Counter, assistant_text: str):
+        self.normalized = normalized
+        self.tf = tf
+        self.assistant_text = assistant_text
+        self.created_at = time.monotonic()
+
+
+class ChatResponseCache:
+    """
+    TTL + size bounded cache of assistant replies.
+
+    Entries are grouped by context (see build_context_key). Inside a context,
+    the incoming message is compared to cached messages with TF-IDF cosine
+    similarity; exact normalized matches short-circuit the comparison.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = CACHE_TTL_SECONDS,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_per_context: int = CACHE_MAX_PER_CONTEXT,
+        min_similarity: float = CACHE_MIN_SIMILARITY,
+    ):
+        self.ttl = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.max_per_context = max(1, max_per_context)
+        self.min_similarity = min_similarity
+
+        self._lock = threading.Lock()
+        # context -> OrderedDict[normalized_text -> _Entry] (LRU order)
+        self._contexts: "OrderedDict[Tuple, OrderedDict[str, _Entry]]" = OrderedDict()
+        self._size = 0
+        # document frequency of terms over all live entries (for IDF)
+        self._df: Counter = Counter()
+
+        self._stats = Counter()
+        self._best_similarity = Counter()  # rounded best similarity -> lookups
+
+    # ---------- internals (lock held) ----------
+    def _idf(self, term: str) -> float:
+        return math.log((1 + self._size) / (1 + self._df.get(term, 0))) + 1.0
+
+    def _cosine(self, a: Counter, b: Counter) -> float:
+        dot = 0.0
+        for term, count in a.items():
+            if term in b:
+                w = self._idf(term)
+                dot += (count * w) * (b[term] * w)
+        if dot == 0.0:
+            return 0.0
+        na = math.sqrt(sum((c * self._idf(t)) ** 2 for t, c in a.items()))
+        nb = math.sqrt(sum((c * self._idf(t)) ** 2 for t, c in b.items()))
+        return dot / (na * nb) if na and nb else 0.0
+
+    def _drop(self, context: Tuple, normalized: str, reason: str):
+        bucket = self._contexts.get(context)
+        if not bucket or normalized not in bucket:
+            return
+        entry = bucket.pop(normalized)
+        for term in entry.tf:
+            left = self._df[term] - 1
+            if left > 0:
+                self._df[term] = left
+            else:
+                del self._df[term]
+        self._size -= 1
+        self._stats[reason] += 1
+        if not bucket:
+            self._contexts.pop(context, None)
+
+    def _expire(self, context: Tuple):
+        bucket = self._contexts.get(context)
+        if not bucket:
+            return
+        now = time.monotonic()
+        for normalized in [k for k, e in bucket.items() if now - e.created_at > self.ttl]:
+            self._drop(context, normalized, "expirations")
+
+    # ---------- public API ----------
+    def lookup(self, context: Tuple, user_text: str, last_reply: Optional[str] = None) -> Optional[str]:
+        """
+        Return a cached reply for a similar message in the same context, or None.
+        `last_reply` is the previous assistant message of the conversation; a cached
+        reply equal to it is not served again (the prompt asks not to repeat).
+        """
+        normalized = normalize_text(user_text)
+        tf = Counter(_terms(normalized))
+
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._expire(context)
+            bucket = self._contexts.get(context)
+
+            best_entry, best_sim = None, 0.0
+            if bucket:
+                if normalized in bucket:
+                    best_entry, best_sim = bucket[normalized], 1.0
+                elif tf:
+                    for entry in bucket.values():
+                        sim = self._cosine(tf, entry.tf)
+                        if sim > best_sim:
+                            best_entry, best_sim = entry, sim
+
+            self._best_similarity[round(best_sim, 2)] += 1
+
+            if best_entry is None or best_sim < self.min_similarity:
+                self._stats["misses"] += 1
+                return None
+
+            if last_reply is not None and best_entry.assistant_text == last_reply:
+                self._stats["misses"] += 1
+                self._stats["repeat_skips"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            self._stats["exact_hits" if best_sim == 1.0 else "similar_hits"] += 1
+            bucket.move_to_end(best_entry.normalized)
+            self._contexts.move_to_end(context)
+            return best_entry.assistant_text
+
+    def store(self, context: Tuple, user_text: str, assistant_text: str):
+        normalized = normalize_text(user_text)
+        if not normalized or not assistant_text:
+            return
+
+        with self._lock:
+            self._drop(context, normalized, "replacements")
+            bucket = self._contexts.setdefault(context, OrderedDict())
+            self._contexts.move_to_end(context)
+
+            entry = _Entry(normalized, Counter(_terms(normalized)), assistant_text)
+            bucket[normalized] = entry
+            self._df.update(entry.tf.keys())
+            self._size += 1
+            self._stats["stores"] += 1
+
+            while len(bucket) > self.max_per_context:
+                self._drop(context, next(iter(bucket)), "evictions")
+
+            while self._size > self.max_entries and self._contexts:
+                oldest_ctx = next(iter(self._contexts))
+                self._drop(oldest_ctx, next(iter(self._contexts[oldest_ctx])), "evictions")
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+            self._df.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["lookups"]
+            hits = self._stats["hits"]
+            would_hit = {
+                f"{t:.2f}": round(
+                    sum(n for s, n in self._best_similarity.items() if s >= t) / lookups, 4
+                ) if lookups else 0.0
+                for t in _TUNING_THRESHOLDS
+            }
+            return {
+                "entries": self._size,
+                "contexts": len(self._contexts),
+                "min_similarity": self.min_similarity,
+                "ttl_seconds": self.ttl,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                # upper bound of the hit rate each threshold would have given
+                "hit_rate_at_threshold": would_hit,
+                **{k: self._stats[k] for k in (
+                    "lookups", "hits", "exact_hits", "similar_hits", "misses",
+                    "repeat_skips", "stores", "replacements", "evictions", "expirations",
+                )},
+            }
@@ -0,0 +1,180 @@
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", "3600"))
+MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "5000"))
+# Re-run the Distance Matrix ranking only when the driver moved this far ...
+REANALYZE_DISTANCE_KM = float(os.getenv("CHAT_REANALYZE_DISTANCE_KM", "2.0"))
+# ... or the ranking is this old (queue estimates depend on drive time)
+RANKING_MAX_AGE_SECONDS = float(os.getenv("CHAT_RANKING_MAX_AGE_SECONDS", "600"))
+# ... or the SOC (and so the reachable range) changed by this many points
+REANALYZE_SOC_POINTS = int(os.getenv("CHAT_REANALYZE_SOC_POINTS", "10"))
+# charging times (minutes) a session gets one of when the client sends none
+CHARGING_MINUTES_CHOICES = (30, 60, 90, 120, 150, 180, 210)
+
+Origin = Union[Tuple[float, float], str]
+
+
+def _haversine_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0088 * math.asin(math.sqrt(h))
+
+
+def stations_fingerprint(stations: List[dict]) -> str:
+    """Order-independent hash of the fields analyze_stations_logic depends on."""
+    keys = sorted(
+        f"{s.get('name', '')}|{round(float(s['lat']), 5)}|{round(float(s['lng']), 5)}"
+        for s in stations
+    )
+    return hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ChatSession:
+    """Trip context, computed ranking and message history of one conversation."""
+
+    conversation_id: str
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    user_type: Optional[str] = None
+
+    start_city: Optional[str] = None
+    end_city: Optional[str] = None
+    origin: Optional[Origin] = None
+    soc_level: Optional[int] = None
+    stations: List[dict] = field(default_factory=list)
+    stations_hash: str = ""
+    # services.connectors.StationFilter of the driver's vehicle (connectors / min power)
+    vehicle_filter: Optional[Any] = None
+    # planned charging time; fixed per session so cached replies (keyed on it) can be reused
+    charging_minutes: Optional[int] = None
+
+    # last ranking + the inputs it was computed from
+    best: Optional[dict] = None
+    sorted_list: List[dict] = field(default_factory=list)
+    analyzed_origin: Optional[Origin] = None
+    analyzed_stations_hash: str = ""
+    analyzed_vehicle_key: str = ""
+    analyzed_soc: Optional[int] = None
+    analyzed_at: float = 0.0
+
+    last_seen: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def apply_update(
+        self,
+        start_city: Optional[str] = None,
+        end_city: Optional[str] = None,
+        origin: Optional[Origin] = None,
+        soc_level: Optional[int] = None,
+        stations: Optional[List[dict]] = None,
+        vehicle_filter: Optional[Any] = None,
+        charging_minutes: Optional[int] = None,
+    ):
+        """Merge a client delta; fields left as None keep their stored value."""
+        if start_city is not None:
+            self.start_city = start_city
+        if end_city is not None:
+            self.end_city = end_city
+        if origin is not None:
+            self.origin = origin
+        elif self.origin is None or (isinstance(self.origin, str) and start_city is not None):
+            # no coordinates yet: the start city is the origin
+            self.origin = self.start_city
+        if soc_level is not None:
+            self.soc_level = soc_level
+        if stations is not None:
+            self.stations = stations
+            self.stations_hash = stations_fingerprint(stations)
+        if vehicle_filter is not None:
+            self.vehicle_filter = vehicle_filter
+        if charging_minutes is not None:
+            self.charging_minutes = charging_minutes
+        self.last_seen = time.monotonic()
+
+    def charging_time(self) -> int:
+        """Charging minutes: the client's, else one drawn on the first turn and kept for the session."""
+        if self.charging_minutes is None:
+            self.charging_minutes = random.choice(CHARGING_MINUTES_CHOICES)
+        return self.charging_minutes
+
+    def vehicle_key(self) -> str:
+        return self.vehicle_filter.key() if self.vehicle_filter is not None else ""
+
+    def reanalysis_reason(self) -> Optional[str]:
+        """Why the stored ranking can't be reused, or None if it still holds."""
+        if self.best is None:
+            return "no_ranking"
+        if self.stations_hash != self.analyzed_stations_hash:
+            return "stations_changed"
+        if self.vehicle_key() != self.analyzed_vehicle_key:
+            return "vehicle_changed"
+        if time.monotonic() - self.analyzed_at > RANKING_MAX_AGE_SECONDS:
+            return "ranking_expired"
+        if self.soc_level != self.analyzed_soc and (
+            self.soc_level is None or self.analyzed_soc is None
+            or abs(self.soc_level - self.analyzed_soc) >= REANALYZE_SOC_POINTS
+        ):
+            return "soc_changed"
+
+        prev, cur = self.analyzed_origin, self.origin
+        if isinstance(prev, tuple) and isinstance(cur, tuple):
+            if _haversine_km(prev, cur) >= REANALYZE_DISTANCE_KM:
+                return "origin_moved"
+        elif prev != cur:
+            return "origin_changed"
+        return None
+
+    def record_analysis(self, best: Optional[dict], sorted_list: List[dict]):
+        self.best = best
+        self.sorted_list = sorted_list
+        self.analyzed_origin = self.origin
+        self.analyzed_stations_hash = self.stations_hash
+        self.analyzed_vehicle_key = self.vehicle_key()
+        self.analyzed_soc = self.soc_level
+        self.analyzed_at = time.monotonic()
+
+
+class SessionStore:
+    """In-process session table, LRU-bounded with idle expiry."""
+
+    def __init__(self, ttl_seconds: float = SESSION_TTL_SECONDS, max_sessions: int = MAX_SESSIONS):
+        self.ttl = ttl_seconds
+        self.max_sessions = max(1, max_sessions)
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def get_or_create(self, conversation_id: str) -> ChatSession:
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is not None and now - session.last_seen > self.ttl:
+                session = None
+            if session is None:
+                session = ChatSession(conversation_id=conversation_id)
+                self._sessions[conversation_id] = session
+            self._sessions.move_to_end(conversation_id)
+            session.last_seen = now
+
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            # drop idle sessions from the cold end
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if now - oldest.last_seen <= self.ttl:
+                    break
+                self._sessions.popitem(last=False)
+            return session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self), "ttl_seconds": self.ttl, "max_sessions": self.max_sessions}
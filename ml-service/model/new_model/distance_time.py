@@ -3,16 +3,38 @@ import random
 import googlemaps
 from dotenv import load_dotenv
 
+from services import admission, metrics, resilience, tracing
+from services.cache import SingleFlight
+
 load_dotenv()
 
 GMAPS_API_KEY = os.getenv("GMAPS_API_KEY")
 if not GMAPS_API_KEY:
     raise RuntimeError("GMAPS_API_KEY missing in .env")
 
-gmaps_client = googlemaps.Client(key=GMAPS_API_KEY)
+# GOOGLE_MAPS_BASE_URL lets load tests point the client at a local stand-in
+GOOGLE_MAPS_BASE_URL = os.getenv("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com").rstrip("/")
+
+# the client can't take a per-call timeout, so attempts are capped here and the request
+# deadline is checked before each one; its own retry loop gets one second (it gives up
+# with Timeout after that), retries beyond it are the policy's
+GOOGLE_MAPS_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_MAPS_TIMEOUT_SECONDS", "5"))
+
+gmaps_client = googlemaps.Client(
+    key=GMAPS_API_KEY,
+    base_url=GOOGLE_MAPS_BASE_URL,
+    requests_session=tracing.traced_session("google_maps"),
+    timeout=GOOGLE_MAPS_TIMEOUT_SECONDS,
+    retry_timeout=1,
+)
+# same key, same quota as the planners' Directions / Distance Matrix calls
+GOOGLE_MAPS = resilience.upstream("google_maps", timeout=GOOGLE_MAPS_TIMEOUT_SECONDS, bucket=admission.bucket("google"))
 
+# chats ranking the same stations from the same origin at the same time share one call
+_MATRIX_FLIGHTS = SingleFlight("google_distance_matrix")
 
-def analyze_stations_logic(origin, stations_list, min_wait_hours: float = 0.01):
+
+def analyze_stations_logic(origin, stations_list, min_wait_hours: float = 0.01, max_distance_km=None):
     """
     Returns:
       best_station: dict | None
@@ -25,6 +47,9 @@ def analyze_stations_logic(origin, stations_list, min_wait_hours: float = 0.01):
     min_wait_hours:
       - stations with wait_at_arrival < min_wait_hours are ignored
       - use 0.01 to avoid float rounding issues showing "0.0"
+
+    max_distance_km:
+      - stations farther than this by road are ignored (battery range at the current SOC)
     """
     if not stations_list:
         return None, []
@@ -32,14 +57,16 @@ def analyze_stations_logic(origin, stations_list, min_wait_hours: float = 0.01):
     dest_coords = [(float(s["lat"]), float(s["lng"])) for s in stations_list]
 
     try:
-        matrix = gmaps_client.distance_matrix(
-            origins=[origin],
-            destinations=dest_coords,
-            mode="driving",
-        )
+        with metrics.stage("distance_matrix", upstream="google_distance_matrix"):
+            matrix = _MATRIX_FLIGHTS.do(
+                (origin, tuple(dest_coords)),
+                GOOGLE_MAPS.call,
+                lambda timeout: gmaps_client.distance_matrix(origins=[origin], destinations=dest_coords, mode="driving"),
+            )
 
         rows = matrix.get("rows") or []
         if not rows:
+            metrics.external_error("google_distance_matrix", matrix.get("status") or "NoRows")
             return None, []
 
         elements = rows[0].get("elements") or []
@@ -55,6 +82,8 @@ def analyze_stations_logic(origin, stations_list, min_wait_hours: float = 0.01):
 
             duration_sec = el["duration"]["value"]
             distance_m = el["distance"]["value"]
+            if max_distance_km is not None and distance_m > max_distance_km * 1000:
+                continue
             trip_time_hrs = duration_sec / 3600.0
 
             # Stable pseudo queue per station (demo until you have real queues)
@@ -0,0 +1,291 @@
+"""
+Compiled inference for the activity recommendation pipeline.
+
+sklearn's Pipeline.predict on a one-row DataFrame costs milliseconds, almost
+all of it pandas/validation overhead. compile_pipeline() flattens the fitted
+estimator into NumPy arrays once and evaluates a plain feature tuple:
+
+- hashed linear models (train.py): per-token weight columns are resolved once
+  and summed per call;
+- tree ensembles (v4 RandomForest from model.ipynb): every tree of every output
+  is packed into one node table and traversed for all trees at once.
+
+Results are memoized per input tuple. Parity against sklearn and a latency
+micro-benchmark are available from the command line:
+
+    python fast_predictor.py models/ev_recommendation_model_v4.pkl
+"""
+import abc
+import argparse
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import features
+
+# (user_type, charging_time, time, day, month, is_festival, is_weekend) — features.FEATURE_COLUMNS order
+Record = Tuple[str, int, str, str, str, int, int]
+
+MEMO_SIZE = 4096
+
+
+def legacy_feature_values(record: Record) -> Dict[str, float]:
+    """Columns features.transform_features produces, computed without pandas."""
+    user_type, charging_time, time_str, day, month, is_festival, is_weekend = record
+    hh, mm = str(time_str).split(":", 1)
+    return {
+        "charging_time": charging_time,
+        "is_festival": is_festival,
+        "is_weekend": is_weekend,
+        "total_minutes": int(hh) * 60 + int(mm),
+        "user_type_code": features.USER_TYPE_CODES.get(user_type, np.nan),
+        "day_code": features.DAY_CODES.get(day, np.nan),
+        "month_code": features.MONTH_CODES.get(month, np.nan),
+    }
+
+
+LEGACY_COLUMNS = list(legacy_feature_values(("Tourist", 0, "00:00", "Monday", "January", 0, 0)))
+
+
+class CompiledPredictor(abc.ABC):
+    """Memoized predict() over _predict(record) -> 0/1 array per output."""
+
+    kind = "compiled"
+
+    def __init__(self, memo_size: int = MEMO_SIZE):
+        self._memo: "OrderedDict[Record, np.ndarray]" = OrderedDict()
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _predict(self, record: Record) -> np.ndarray:
+        ...
+
+    def predict(self, record: Record) -> np.ndarray:
+        with self._lock:
+            hit = self._memo.get(record)
+            if hit is not None:
+                self._memo.move_to_end(record)
+                return hit
+        out = self._predict(record)
+        out.setflags(write=False)
+        with self._lock:
+            self._memo[record] = out
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return out
+
+
+class HashedLinearPredictor(CompiledPredictor):
+    kind = "hashed_linear"
+
+    def __init__(self, estimators: Sequence, memo_size: int = MEMO_SIZE):
+        super().__init__(memo_size)
+        self._weights = np.vstack([e.coef_[0] for e in estimators])  # (outputs, n_features)
+        self._intercept = np.array([e.intercept_[0] for e in estimators])
+        self._classes = np.vstack([e.classes_ for e in estimators])  # (outputs, 2)
+        self._columns: Dict[str, np.ndarray] = {}
+        self._rows = np.arange(len(estimators))
+
+    def _column(self, token: str) -> np.ndarray:
+        col = self._columns.get(token)
+        if col is None:
+            idx = features._HASHER.transform([[token]]).indices[0]
+            col = self._columns[token] = self._weights[:, idx].copy()
+        return col
+
+    def _predict(self, record: Record) -> np.ndarray:
+        score = self._intercept.copy()
+        for token in features.feature_tokens(*record):
+            score += self._column(token)
+        return self._classes[self._rows, (score > 0).astype(np.intp)]
+
+
+class TreeEnsemblePredictor(CompiledPredictor):
+    kind = "tree_ensemble"
+
+    def __init__(self, estimators: Sequence, feature_names: List[str], memo_size: int = MEMO_SIZE):
+        super().__init__(memo_size)
+        self._feature_names = feature_names
+        self._classes = [np.asarray(e.classes_) for e in estimators]
+        k_max = max(len(c) for c in self._classes)
+
+        feature, threshold, left, right, values, roots, groups = [], [], [], [], [], [], []
+        offset = 0
+        depth = 0
+        for est in estimators:
+            trees = getattr(est, "estimators_", None) or [est]
+            groups.append((len(roots), len(roots) + len(trees)))
+            for tree in trees:
+                t = tree.tree_
+                n = t.node_count
+                is_leaf = t.children_left == -1
+                ids = np.arange(n)
+                feature.append(np.where(is_leaf, 0, t.feature))
+                threshold.append(np.where(is_leaf, np.inf, t.threshold))
+                left.append(np.where(is_leaf, ids, t.children_left) + offset)
+                right.append(np.where(is_leaf, ids, t.children_right) + offset)
+                v = t.value[:, 0, :].astype(np.float64)
+                v = v / np.maximum(v.sum(axis=1, keepdims=True), 1e-300)
+                values.append(np.pad(v, ((0, 0), (0, k_max - v.shape[1]))))
+                roots.append(offset)
+                offset += n
+                depth = max(depth, t.max_depth)
+
+        self._feature = np.concatenate(feature).astype(np.intp)
+        self._threshold = np.concatenate(threshold)
+        # children interleaved so one gather picks the branch: child[2 * node + went_right]
+        self._children = np.empty(2 * offset, dtype=np.intp)
+        self._children[0::2] = np.concatenate(left)
+        self._children[1::2] = np.concatenate(right)
+        self._values = np.concatenate(values)
+        self._roots = np.array(roots, dtype=np.intp)
+        self._groups = groups
+        self._group_starts = np.array([start for start, _ in groups], dtype=np.intp)
+        self._depth = depth
+
+    def _predict(self, record: Record) -> np.ndarray:
+        vals = legacy_feature_values(record)
+        # sklearn trees compare float32 inputs against float64 thresholds
+        x = np.array([vals[name] for name in self._feature_names], dtype=np.float32).astype(np.float64)
+
+        # all trees of all outputs advance one level per step; leaves point at themselves
+        node = self._roots
+        for _ in range(self._depth):
+            node = self._children.take((node << 1) | (x.take(self._feature.take(node)) > self._threshold.take(node)))
+
+        proba = np.add.reduceat(self._values.take(node, axis=0), self._group_starts, axis=0)
+        out = np.empty(len(self._groups), dtype=self._classes[0].dtype)
+        for i, classes in enumerate(self._classes):
+            out[i] = classes[int(np.argmax(proba[i, : len(classes)]))]
+        return out
+
+
+def _transformer_func(pipeline) -> Optional[Callable]:
+    return getattr(pipeline.steps[0][1], "func", None) if len(pipeline.steps) > 1 else None
+
+
+def compile_pipeline(pipeline) -> Optional[CompiledPredictor]:
+    """Compiled evaluator for a supported pipeline, or None (caller keeps using sklearn)."""
+    func = _transformer_func(pipeline)
+    estimators = getattr(pipeline.steps[-1][1], "estimators_", None)
+    if func is None or not estimators:
+        return None
+    name = getattr(func, "__name__", "")
+
+    if name == "encode_features":
+        if all(hasattr(e, "coef_") and e.coef_.shape[0] == 1 for e in estimators):
+            return HashedLinearPredictor(estimators)
+        return None
+
+    if name == "transform_features":
+        def is_tree(m):
+            return hasattr(m, "tree_")
+
+        if all(is_tree(e) or (getattr(e, "estimators_", None) and all(is_tree(t) for t in e.estimators_))
+               for e in estimators):
+            names = getattr(estimators[0], "feature_names_in_", None)
+            names = list(names) if names is not None else LEGACY_COLUMNS
+            if set(names) <= set(LEGACY_COLUMNS):
+                return TreeEnsemblePredictor(estimators, names)
+    return None
+
+
+# -----------------------
+# Parity + benchmark
+# -----------------------
+def random_records(n: int, seed: int = 0) -> List[Record]:
+    rng = random.Random(seed)
+    days = list(features.DAY_CODES)
+    months = list(features.MONTH_CODES)
+    out = []
+    for _ in range(n):
+        day = rng.choice(days)
+        month = rng.choice(months)
+        out.append((
+            rng.choice(list(features.USER_TYPE_CODES)),
+            rng.choice([15, 30, 45, 60, 75, 90, 120, 150, 180, 210]),
+            f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+            day,
+            month,
+            int(month in ("April", "December")),
+            int(day in ("Saturday", "Sunday")),
+        ))
+    return out
+
+
+def _frame(records: Sequence[Record]):
+    import pandas as pd
+
+    return pd.DataFrame(list(records), columns=features.FEATURE_COLUMNS)
+
+
+def verify_parity(pipeline, compiled: CompiledPredictor, records: Sequence[Record]) -> int:
+    """Number of records where the compiled output differs from pipeline.predict."""
+    expected = np.asarray(pipeline.predict(_frame(records)))
+    return sum(
+        0 if np.array_equal(compiled._predict(rec), expected[i]) else 1
+        for i, rec in enumerate(records)
+    )
+
+
+def benchmark(pipeline, compiled: CompiledPredictor, records: Sequence[Record]) -> Dict[str, float]:
+    frames = [_frame([r]) for r in records[:200]]
+    t0 = time.perf_counter()
+    for f in frames:
+        pipeline.predict(f)
+    sklearn_us = (time.perf_counter() - t0) / len(frames) * 1e6
+
+    t0 = time.perf_counter()
+    for r in records:
+        compiled._predict(r)
+    cold_us = (time.perf_counter() - t0) / len(records) * 1e6
+
+    warm = records[:256]
+    for r in warm:
+        compiled.predict(r)
+    t0 = time.perf_counter()
+    for _ in range(20):
+        for r in warm:
+            compiled.predict(r)
+    warm_us = (time.perf_counter() - t0) / (20 * len(warm)) * 1e6
+
+    return {
+        "sklearn_us_per_call": round(sklearn_us, 1),
+        "compiled_us_per_call": round(cold_us, 1),
+        "memoized_us_per_call": round(warm_us, 2),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    import joblib
+
+    import __main__
+    __main__.transform_features = features.transform_features  # v4 pickle
+
+    parser = argparse.ArgumentParser(description="Parity check and latency benchmark for compiled inference.")
+    parser.add_argument("model", help="model package (.pkl)")
+    parser.add_argument("--records", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    pipeline = joblib.load(args.model)["pipeline"]
+    compiled = compile_pipeline(pipeline)
+    if compiled is None:
+        raise SystemExit("❌ Unsupported pipeline for compiled inference")
+
+    records = random_records(args.records)
+    mismatches = verify_parity(pipeline, compiled, records)
+    print(f"Backend: {compiled.kind}")
+    print(f"Parity: {len(records) - mismatches}/{len(records)} identical")
+    for key, value in benchmark(pipeline, compiled, records).items():
+        print(f"  {key}: {value}")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
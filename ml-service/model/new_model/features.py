@@ -0,0 +1,83 @@
+from typing import List
+
+import pandas as pd
+from sklearn.feature_extraction import FeatureHasher
+
+USER_TYPE_CODES = {
+    "Office_Worker": 0,
+    "Tourist": 1,
+    "Delivery_Driver": 2,
+    "Casual_User": 3,
+}
+DAY_CODES = {
+    "Monday": 0,
+    "Tuesday": 1,
+    "Wednesday": 2,
+    "Thursday": 3,
+    "Friday": 4,
+    "Saturday": 5,
+    "Sunday": 6,
+}
+MONTH_CODES = {
+    "January": 0, "February": 1, "March": 2, "April": 3,
+    "May": 4, "June": 5, "July": 6, "August": 7,
+    "September": 8, "October": 9, "November": 10, "December": 11,
+}
+
+FEATURE_COLUMNS = ["user_type", "charging_time", "time", "day", "month", "is_festival", "is_weekend"]
+HASH_N_FEATURES = 2 ** 14
+
+
+# -----------------------
+# v4: ordinal codes (RandomForest pipeline from model.ipynb)
+# -----------------------
+def transform_features(X_df: pd.DataFrame) -> pd.DataFrame:
+    X_copy = X_df.copy()
+
+    time_split = X_copy["time"].str.split(":", expand=True).astype(int)
+    X_copy["total_minutes"] = (time_split[0] * 60) + time_split[1]
+
+    X_copy["user_type_code"] = X_copy["user_type"].map(USER_TYPE_CODES)
+    X_copy["day_code"] = X_copy["day"].map(DAY_CODES)
+    X_copy["month_code"] = X_copy["month"].map(MONTH_CODES)
+
+    return X_copy.drop(["time", "day", "month", "user_type"], axis=1)
+
+
+# -----------------------
+# v5: hashed, crossed tokens (stateless, so it works chunk by chunk)
+# -----------------------
+def _charging_bucket(charging_time: int) -> str:
+    # the labeling rules treat every session of 75+ minutes the same way
+    return "75+" if charging_time >= 75 else str(charging_time)
+
+
+def feature_tokens(user_type, charging_time, time, day, month, is_festival, is_weekend) -> List[str]:
+    """Categorical + crossed tokens for one row; the hasher turns them into columns."""
+    hour = int(str(time).split(":", 1)[0])
+    ct = _charging_bucket(int(charging_time))
+    fest = int(is_festival)
+    wknd = int(is_weekend)
+    return [
+        f"ut={user_type}",
+        f"ct={ct}",
+        f"h={hour}",
+        f"d={day}",
+        f"m={month}",
+        f"fest={fest}",
+        f"wknd={wknd}",
+        f"ct={ct}|h={hour}",
+        f"ct={ct}|fest={fest}",
+        f"ct={ct}|wknd={wknd}",
+        f"ct={ct}|fest={fest}|wknd={wknd}",
+        f"ut={user_type}|ct={ct}",
+    ]
+
+
+_HASHER = FeatureHasher(n_features=HASH_N_FEATURES, input_type="string", alternate_sign=False)
+
+
+def encode_features(X_df: pd.DataFrame):
+    """Sparse hashed feature matrix for a frame with FEATURE_COLUMNS."""
+    rows = zip(*(X_df[c].tolist() for c in FEATURE_COLUMNS))
+    return _HASHER.transform(feature_tokens(*row) for row in rows)
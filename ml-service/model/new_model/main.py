@@ -1,49 +1,19 @@
 import os
+import sys
 import json
-import random
+import asyncio
 import traceback
 from typing import Optional, List, Dict, Any
 
-import pandas as pd
 from dotenv import load_dotenv
+import numpy as np
 
 # =========================================================
 # ✅ CRITICAL: function must exist BEFORE joblib.load() runs
-# because your saved model references __main__.transform_features
+# because the v4 model references __main__.transform_features
+# (models from train.py reference features.encode_features instead)
 # =========================================================
-def transform_features(X_df: pd.DataFrame) -> pd.DataFrame:
-    X_copy = X_df.copy()
-
-    time_split = X_copy["time"].str.split(":", expand=True).astype(int)
-    X_copy["total_minutes"] = (time_split[0] * 60) + time_split[1]
-
-    user_mapping = {
-        "Office_Worker": 0,
-        "Tourist": 1,
-        "Delivery_Driver": 2,
-        "Casual_User": 3,
-    }
-    day_mapping = {
-        "Monday": 0,
-        "Tuesday": 1,
-        "Wednesday": 2,
-        "Thursday": 3,
-        "Friday": 4,
-        "Saturday": 5,
-        "Sunday": 6,
-    }
-    month_mapping = {
-        "January": 0, "February": 1, "March": 2, "April": 3,
-        "May": 4, "June": 5, "July": 6, "August": 7,
-        "September": 8, "October": 9, "November": 10, "December": 11,
-    }
-
-    X_copy["user_type_code"] = X_copy["user_type"].map(user_mapping)
-    X_copy["day_code"] = X_copy["day"].map(day_mapping)
-    X_copy["month_code"] = X_copy["month"].map(month_mapping)
-
-    return X_copy.drop(["time", "day", "month", "user_type"], axis=1)
-
+from features import transform_features  # noqa: E402
 
 # ✅ Bind into __main__ so pickle can resolve __main__.transform_features
 import __main__  # noqa: E402
@@ -52,16 +22,33 @@ __main__.transform_features = transform_features
 # ✅ Load .env early
 load_dotenv()
 
-from fastapi import FastAPI  # noqa: E402
+from fastapi import FastAPI, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect  # noqa: E402
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse  # noqa: E402
 from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
 from pydantic import BaseModel, Field  # noqa: E402
 
 from groq import Groq  # noqa: E402
 from psycopg2.extras import RealDictCursor  # noqa: E402
 
+# shared infra (services/metrics.py, ...) lives in the ml-service root
+ML_SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ML_SERVICE_ROOT not in sys.path:
+    sys.path.append(ML_SERVICE_ROOT)
+
+from services import admission, metrics, profiling, resilience, shared_stations, tracing  # noqa: E402
+from services.charger_status import ChargerStatusHub, PostgresChargerSource, parse_filter  # noqa: E402
+from services.connectors import StationFilter  # noqa: E402
+from services.nearest import NearestStations  # noqa: E402
+from services.reachability import vehicle_range  # noqa: E402
+from services.stations import build_stations  # noqa: E402
+from services.profiling import PROFILER  # noqa: E402
+
+from chat_cache import ChatResponseCache, build_context_key  # noqa: E402
+from chat_sessions import SessionStore  # noqa: E402
 from database import get_db_connection  # noqa: E402
 from distance_time import analyze_stations_logic  # noqa: E402
 from ml_predictor import load_model, predict_activities  # noqa: E402
+from prompt_builder import LLMUsage, PromptBuilder  # noqa: E402
 
 
 # ✅ Load ML model AFTER transform_features exists
@@ -70,7 +57,15 @@ try:
 except Exception as e:
     print(f"⚠️ ML model load failed: {e}")
 
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+tracing.configure("chat-service")
+
+# GROQ_BASE_URL (optional) points the client at a local stand-in for load tests.
+# The SDK's own retries are off: services/resilience.py retries within the request deadline
+# and opens a breaker, so a Groq outage costs a fast fallback reply, not a minute per chat.
+groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"), base_url=os.getenv("GROQ_BASE_URL") or None, max_retries=0)
+GROQ = resilience.upstream(
+    "groq", timeout=float(os.getenv("GROQ_TIMEOUT_SECONDS", "10")), retries=1, bucket=admission.bucket("groq")
+)
 
 
 app = FastAPI()
@@ -85,11 +80,111 @@ app.add_middleware(
 # -----------------------
 # Chat memory per trip
 # -----------------------
-CHAT_STORE: Dict[str, Dict[str, Any]] = {}
-# { conversation_id: { "messages": [{"role":"user/ai","text":"..."}], "user_type": "Tourist" } }
+# conversation_id -> ChatSession (messages, user type, trip context, last station ranking)
+SESSIONS = SessionStore()
 
 APP_USER_TYPES = ["Delivery_Driver", "Business_Man", "Casual_Driver", "Tourist"]
 
+# Near-identical turns ("ok", "which station is best?") for the same decision reuse the reply
+REPLY_CACHE = ChatResponseCache()
+
+# Static instructions go in a fixed system prompt; the per-turn part is kept under a token budget
+PROMPTS = PromptBuilder()
+LLM_USAGE = LLMUsage()
+
+metrics.register_hit_ratio("chat_reply", lambda: REPLY_CACHE.stats()["hit_rate"])
+
+
+def _load_stations() -> List[Dict[str, Any]]:
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            sql = "SELECT station_id, name, address, latitude AS lat, longitude AS lon, status FROM station"
+            with tracing.db_span(sql):
+                cur.execute(sql)
+                stations = cur.fetchall()
+        with conn.cursor() as cur:
+            sql = "SELECT station_id, type, power_kw, status FROM charger"
+            with tracing.db_span(sql):
+                cur.execute(sql)
+                chargers = cur.fetchall()
+    finally:
+        conn.close()
+    return build_stations(stations, chargers)
+
+
+# stations + connector/power aggregates (services/stations.py), for vehicle filters;
+# one copy shared by all workers when STATION_SHM_DIR is set (services/shared_stations.py)
+STATION_SNAPSHOT = shared_stations.snapshot_source("chat-service", _load_stations)
+# k-nearest candidates when the client sends no station list (services/nearest.py)
+NEAREST = NearestStations()
+STATION_SNAPSHOT.on_change(NEAREST.rebuild)
+CHAT_CANDIDATE_STATIONS = int(os.getenv("CHAT_CANDIDATE_STATIONS", "10"))
+# stations beyond the range left at the driver's SOC are not ranked (the client sends no vehicle size)
+CHAT_BATTERY = vehicle_range(full_range_km=float(os.getenv("CHAT_VEHICLE_RANGE_KM", "150")))
+
+
+# -----------------------
+# Request metrics, tracing and profiling hooks
+# -----------------------
+ROUTE_PATHS = set()
+# endpoints that can be profiled on demand (services/profiling.py)
+PROFILED_ENDPOINTS = {"/chat"}
+# end-to-end budget for outbound calls; callers may shorten it with X-Request-Deadline-Ms
+CHAT_REQUEST_DEADLINE_SECONDS = float(os.getenv("CHAT_REQUEST_DEADLINE_SECONDS", "25"))
+# concurrency limits + priority queue for the expensive endpoints (services/admission.py)
+ADMISSION = admission.AdmissionControl(admission.parse_limits(
+    os.getenv("ADMISSION_LIMITS"), {"/chat": 16, "/get-nearby-stations": 32}
+))
+
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    if not ROUTE_PATHS:
+        ROUTE_PATHS.update(getattr(r, "path", None) for r in app.routes)
+    # unknown paths share one label so scanners can't blow up cardinality
+    endpoint = request.url.path if request.url.path in ROUTE_PATHS else "other"
+    started = metrics.request_started(endpoint)
+    span = tracing.start_span(
+        f"{request.method} {endpoint}", tracing.SERVER, request.headers.get(tracing.TRACEPARENT),
+        {"http.method": request.method, "http.route": endpoint},
+    )
+    capture = None
+    if endpoint in PROFILED_ENDPOINTS:
+        # only the handler's worker thread (thread_capture in /chat), never the event loop
+        capture = PROFILER.begin(endpoint, request.headers.get(profiling.HEADER), threads_only=True)
+    # set before call_next so the endpoint (and its threadpool) inherit it
+    deadline = resilience.start_deadline(CHAT_REQUEST_DEADLINE_SECONDS, request.headers.get(resilience.DEADLINE_HEADER))
+    ticket = None
+    status = 500
+    try:
+        try:
+            ticket = await ADMISSION.acquire_async(endpoint, request.headers.get(admission.PRIORITY_HEADER))
+        except admission.Shed as e:
+            # answered before any work is done
+            status = 503
+            return JSONResponse({"detail": str(e)}, status_code=503, headers={
+                "Retry-After": str(int(e.retry_after) + 1), tracing.TRACEPARENT: span.traceparent,
+            })
+        response = await call_next(request)
+        status = response.status_code
+        if capture:
+            response.headers[profiling.RESPONSE_HEADER] = capture.id
+        response.headers[tracing.TRACEPARENT] = span.traceparent
+        return response
+    finally:
+        if ticket:
+            ticket.release()
+        resilience.end_deadline(deadline)
+        if capture:
+            PROFILER.end(capture, status, background=True)
+        span.set("http.status_code", status)
+        if status >= 500:
+            span.error = f"HTTP {status}"
+        tracing.end_span(span)
+        metrics.request_finished(endpoint, request.method, status, started)
+
+
 # -----------------------
 # Request/Response models
 # -----------------------
@@ -101,20 +196,40 @@ class Station(BaseModel):
     status: Optional[str] = None
 
 
-class NearbyStationsRequest(BaseModel):
+class VehicleFilter(BaseModel):
+    """Which stations the vehicle can use; all fields optional."""
+    connectors: Optional[List[str]] = Field(None, description='e.g. ["CCS2", "Type 2"]; any of them')
+    min_power_kw: Optional[float] = Field(None, description="on one of the requested connectors")
+    available_only: bool = False
+
+    def station_filter(self) -> StationFilter:
+        return StationFilter.from_params(self.connectors, self.min_power_kw, self.available_only)
+
+
+class NearbyStationsRequest(VehicleFilter):
     path_points: List[dict]
     buffer_km: float = 5.0
 
 
 class ChatRequest(BaseModel):
+    """
+    Only conversation_id and user_text are required after the first turn;
+    omitted trip fields keep the values stored in the session.
+    """
     conversation_id: str = Field(..., description="Trip/chat id")
-    start_city: str
-    end_city: str
+    start_city: Optional[str] = None
+    end_city: Optional[str] = None
     start_lat: Optional[float] = None
     start_lng: Optional[float] = None
-    soc_level: int = 50
+    soc_level: Optional[int] = Field(None, ge=0, le=100, description="Battery %; limits ranking to reachable stations")
     user_text: str
-    stations: List[Station] = []
+    stations: Optional[List[Station]] = Field(
+        None, description="Omit to reuse the session's stations; never sent = nearest to start_lat/lng"
+    )
+    vehicle: Optional[VehicleFilter] = Field(None, description="Omit to keep the session's vehicle filter")
+    charging_minutes: Optional[int] = Field(
+        None, ge=1, le=600, description="Planned charging time; omit to keep the session's (one is picked if never sent)"
+    )
 
 
 class ChatResponse(BaseModel):
@@ -123,6 +238,7 @@ class ChatResponse(BaseModel):
     user_type: str
     best_station: Optional[dict] = None
     sorted_stations: List[dict] = []
+    reanalyzed: bool = False
 
 
 # -----------------------
@@ -131,39 +247,71 @@ class ChatResponse(BaseModel):
 def get_origin(req: ChatRequest):
     if req.start_lat is not None and req.start_lng is not None:
         return (req.start_lat, req.start_lng)
-    return req.start_city
-
-
-def infer_user_type_llm(user_text: str, recent_messages: List[dict], start_city: str, end_city: str) -> str:
-    history_text = "\n".join([f"{m['role']}: {m['text']}" for m in recent_messages[-8:]])
-
-    prompt = f"""
-Classify the user into exactly ONE type:
-- Delivery_Driver
-- Business_Man
-- Casual_Driver
-- Tourist
+    return None
 
-Trip: {start_city} -> {end_city}
 
-Conversation:
-{history_text}
+def compatible_stations(stations: List[dict], station_filter: Optional[StationFilter]) -> List[dict]:
+    """
+    Drop client-sent stations the vehicle can't use, before any Distance Matrix
+    work. Stations are matched to the snapshot by coordinates; ones it doesn't
+    know are kept, since nothing says they are incompatible.
+    """
+    if station_filter is None or not station_filter.active or not stations:
+        return stations
+    try:
+        snapshot = STATION_SNAPSHOT.get()
+    except Exception as e:
+        print(f"⚠️ Station snapshot unavailable, vehicle filter skipped: {e}")
+        return stations
+    passes = snapshot.mask(station_filter)
+    out = []
+    for s in stations:
+        i = snapshot.index_of(s["lat"], s["lng"])
+        if i is None or passes[i]:
+            out.append(s)
+    return out
+
+
+def nearest_candidates(origin, station_filter: Optional[StationFilter]) -> List[dict]:
+    """
+    The CHAT_CANDIDATE_STATIONS stations nearest to a coordinate origin, in the
+    client's station shape, for sessions that never sent a station list.
+    """
+    if not isinstance(origin, tuple):
+        return []
+    try:
+        snapshot = STATION_SNAPSHOT.get()
+    except Exception as e:
+        print(f"⚠️ Station snapshot unavailable, no candidate stations: {e}")
+        return []
+    with metrics.stage("candidate_knn"):
+        near = NEAREST.knn(snapshot, origin[0], origin[1], k=CHAT_CANDIDATE_STATIONS, station_filter=station_filter)
+    return [
+        {"name": s["name"], "lat": s["lat"], "lng": s["lon"], "address": s["address"], "status": s.get("status")}
+        for s in near
+    ]
 
-User message:
-{user_text}
 
-Return ONLY JSON:
-{{"user_type":"Casual_Driver"}}
-"""
+def infer_user_type_llm(user_text: str, recent_messages: List[dict], start_city: str, end_city: str) -> str:
+    # the current message is passed separately; don't send it twice
+    history = recent_messages[:-1] if recent_messages and recent_messages[-1]["text"] == user_text else recent_messages
+    messages = PROMPTS.user_type_messages(user_text, start_city, end_city, history=history)
     try:
-        res = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="llama-3.1-8b-instant",
-            response_format={"type": "json_object"},
-        )
+        with metrics.stage("user_type_inference", upstream="groq"):
+            res = GROQ.call(lambda timeout: groq_client.chat.completions.create(
+                messages=messages,
+                model="llama-3.1-8b-instant",
+                response_format={"type": "json_object"},
+                extra_headers=tracing.inject(),
+                timeout=timeout,
+            ))
+        LLM_USAGE.record("user_type", messages, res)
         data = json.loads(res.choices[0].message.content)
         ut = data.get("user_type", "Casual_Driver")
         return ut if ut in APP_USER_TYPES else "Casual_Driver"
+    except (resilience.CircuitOpen, resilience.RateLimited):
+        # refused before calling Groq: the client retries, don't settle on a guess
+        raise
     except Exception:
         return "Casual_Driver"
 
@@ -176,81 +324,34 @@ def generate_chatbot_reply_llm(
     activities: str,
     charging_minutes: int,
     start_city: str,
-    end_city: str
+    end_city: str,
+    history: Optional[List[dict]] = None,
 ) -> str:
-    alternatives = [s for s in sorted_list if s["name"] != best["name"]][:2]
-    alt_text = "\n".join(
-        [f"- {a['name']}: wait {a['wait']}h, drive {a['travel_time']}, distance {a['distance']}"
-         for a in alternatives]
-    ) or "No strong alternatives found."
-
-    prompt = f"""
-You are AMPORA ⚡, a friendly and reliable EV travel assistant. Be clear, natural, and practical.
-
-User type: {user_type}
-Trip: {start_city} -> {end_city}
-User message: "{user_text}"
-
-IMPORTANT CONSTRAINT:
-- The station decision is already computed. Do NOT change the best station.
-
-BEST STATION:
-- Name: {best['name']}
-- Wait hours: {best['wait']}
-- Drive time: {best['travel_time']}
-- Distance: {best['distance']}
-- Address: {best.get('address','N/A')}
-
-Alternatives:
-{alt_text}
-
-Charging time estimate (temporary): {charging_minutes} minutes
-Activities predicted by ML: {activities}
-
-Knowledge & search rules:
-1) If you know the answer with high confidence, answer directly.
-2) If the user’s question involves real-world, location-based, time-sensitive, or uncertain information
-   (e.g. station ratings, nearby cafés/restrooms/shops, opening hours, pricing, traffic, availability),
-   automatically search the internet to verify.
-   The user does NOT need to ask you to search.
-3) When you use online information, clearly mention the source(s) briefly
-   (example: “Source: Google Maps reviews”, “Source: operator website”).
-4) Never invent ratings, reviews, prices, or availability. If data is unavailable, say so briefly.
-
-Conversation behavior:
-- Do NOT repeat the same long explanation if the user asks again or says “no”.
-  Adapt the response and move forward.
-- If the user already indicated work or holiday, do NOT ask again.
-- Ask at most ONE short follow-up question only if it genuinely helps refine the answer.
-- If battery level (SOC) is missing and required, ask once:
-  “What’s your battery level right now? (0–100%)”
-  If still missing, continue with reasonable assumptions.
-
-Response goals:
-1) Explain why this station is the best choice and briefly mention 1–2 alternatives.
-2) Suggest how to spend the charging wait using ML-predicted activities.
-3) If helpful, include nearby highly rated places (cafés/food/shops) with ratings and source.
-4) Friendly tone. Short paragraphs. Light emojis only if helpful (⚡🔋⭐).
-
-Output rules:
-- Be concise and user-friendly.
-- Do NOT change the computed station decision.
-- Return ONLY valid JSON in this exact format:
-
-{{"assistant_text":"..."}}
-
-"""
+    messages = PROMPTS.reply_messages(
+        user_text=user_text,
+        user_type=user_type,
+        best=best,
+        sorted_list=sorted_list,
+        activities=activities,
+        charging_minutes=charging_minutes,
+        start_city=start_city,
+        end_city=end_city,
+        history=history,
+    )
     try:
-        res = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "Return ONLY valid JSON."},
-                {"role": "user", "content": prompt},
-            ],
-            model="llama-3.1-8b-instant",
-            response_format={"type": "json_object"},
-        )
+        with metrics.stage("llm_reply", upstream="groq"):
+            res = GROQ.call(lambda timeout: groq_client.chat.completions.create(
+                messages=messages,
+                model="llama-3.1-8b-instant",
+                response_format={"type": "json_object"},
+                extra_headers=tracing.inject(),
+                timeout=timeout,
+            ))
+        LLM_USAGE.record("reply", messages, res)
         data = json.loads(res.choices[0].message.content)
         return (data.get("assistant_text") or "").strip() or "Done."
+    except (resilience.CircuitOpen, resilience.RateLimited):
+        raise
     except Exception:
         return "Done."
 
@@ -263,105 +364,344 @@ async def get_nearby_stations(req: NearbyStationsRequest):
     path_points = req.path_points or []
     if not path_points:
         return {"stations": []}
+    try:
+        station_filter = req.station_filter()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     lats = [p["lat"] for p in path_points]
     lngs = [p["lng"] for p in path_points]
 
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT name, latitude as lat, longitude as lng, address, status
-                FROM station
-                WHERE latitude BETWEEN %s AND %s
-                  AND longitude BETWEEN %s AND %s
-                """,
-                (min(lats) - 0.1, max(lats) + 0.1, min(lngs) - 0.1, max(lngs) + 0.1),
-            )
-            rows = cur.fetchall()
-
-        for r in rows:
-            r["lat"] = float(r["lat"])
-            r["lng"] = float(r["lng"])
-
-        return {"stations": rows}
+        # first call (or a failed reload) waits for the DB; keep that off the event loop
+        snapshot = await asyncio.to_thread(STATION_SNAPSHOT.get)
     except Exception as e:
         print("❌ DB error:", e)
         return {"stations": [], "error": str(e)}
-    finally:
-        conn.close()
+
+    # bbox + vehicle filter as one vectorized mask over the snapshot
+    arrays = snapshot.arrays
+    keep = (
+        (arrays.lat >= min(lats) - 0.1) & (arrays.lat <= max(lats) + 0.1)
+        & (arrays.lon >= min(lngs) - 0.1) & (arrays.lon <= max(lngs) + 0.1)
+    )
+    if station_filter.active:
+        keep &= snapshot.mask(station_filter)
+
+    rows = []
+    for i in np.flatnonzero(keep):
+        st = snapshot.stations[i]
+        rows.append({
+            "station_id": st["station_id"],
+            "name": st["name"],
+            "lat": st["lat"],
+            "lng": st["lon"],
+            "address": st["address"],
+            "status": st.get("status"),
+            "connectors": st["connectors"],
+            "max_power_kw": st["max_power_kw"],
+            "available_count": st["available_count"],
+        })
+    return {"stations": rows}
 
 
 # -----------------------
 # Endpoint: chat
 # -----------------------
 @app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
-    try:
-        # Init memory
-        if req.conversation_id not in CHAT_STORE:
-            CHAT_STORE[req.conversation_id] = {"messages": [], "user_type": None}
+def chat(req: ChatRequest):
+    # sync on purpose: FastAPI runs it on the threadpool, so concurrent chats don't
+    # queue behind each other's Distance Matrix / Groq calls on the event loop
+    with profiling.thread_capture():
+        return _chat(req)
 
-        store = CHAT_STORE[req.conversation_id]
-        store["messages"].append({"role": "user", "text": req.user_text})
 
-        # Infer / update user type (LLM)
-        if not store["user_type"]:
-            store["user_type"] = infer_user_type_llm(
-                req.user_text, store["messages"], req.start_city, req.end_city
-            )
+def _chat(req: ChatRequest) -> ChatResponse:
+    try:
+        station_filter = req.vehicle.station_filter() if req.vehicle is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    session = SESSIONS.get_or_create(req.conversation_id)
 
-        stations_list = [s.model_dump() for s in req.stations] if req.stations else []
+    with session.lock:
+        session.apply_update(
+            start_city=req.start_city,
+            end_city=req.end_city,
+            origin=get_origin(req),
+            soc_level=req.soc_level,
+            stations=[s.model_dump() for s in req.stations] if req.stations is not None else None,
+            vehicle_filter=station_filter,
+            charging_minutes=req.charging_minutes,
+        )
+        if not session.start_city or not session.end_city:
+            raise HTTPException(status_code=400, detail="start_city and end_city are required on the first turn")
+
+        try:
+            session.messages.append({"role": "user", "text": req.user_text})
+
+            # Infer / update user type (LLM)
+            if not session.user_type:
+                session.user_type = infer_user_type_llm(
+                    req.user_text, session.messages, session.start_city, session.end_city
+                )
+
+            # Re-rank only when the inputs changed materially since the last turn
+            reanalyzed = False
+            if session.reanalysis_reason():
+                if session.stations:
+                    candidates = compatible_stations(session.stations, session.vehicle_filter)
+                else:
+                    candidates = nearest_candidates(session.origin, session.vehicle_filter)
+                range_km = CHAT_BATTERY.get_range(session.soc_level) if session.soc_level is not None else None
+                best, sorted_list = analyze_stations_logic(session.origin, candidates, max_distance_km=range_km)
+                reanalyzed = True
+                if best:
+                    session.record_analysis(best, sorted_list)
+            else:
+                best, sorted_list = session.best, session.sorted_list
+            metrics.cache_lookup("station_ranking", hit=not reanalyzed)
+            profiling.note(
+                stations=len(session.stations or []),
+                ranked_stations=len(sorted_list or []),
+                reanalyzed=reanalyzed,
+                history_messages=len(session.messages),
+                user_text_chars=len(req.user_text),
+            )
 
-        origin = get_origin(req)
-        best, sorted_list = analyze_stations_logic(origin, stations_list)
+            if not best:
+                assistant_text = "⚠️ I couldn't find a suitable station. Try another route or increase station coverage."
+                session.messages.append({"role": "ai", "text": assistant_text})
+                return ChatResponse(
+                    conversation_id=req.conversation_id,
+                    assistant_text=assistant_text,
+                    user_type=session.user_type or "Casual_Driver",
+                    best_station=None,
+                    sorted_stations=[],
+                    reanalyzed=reanalyzed,
+                )
+
+            charging_minutes = session.charging_time()
+
+            with metrics.stage("ml_predict"):
+                activities = predict_activities(session.user_type, charging_minutes)
+
+            cache_context = build_context_key(
+                session.user_type, best, sorted_list, activities, session.start_city, session.end_city,
+                charging_minutes=charging_minutes,
+            )
+            last_reply = next((m["text"] for m in reversed(session.messages) if m["role"] == "ai"), None)
+
+            assistant_text = REPLY_CACHE.lookup(cache_context, req.user_text, last_reply=last_reply)
+            metrics.cache_lookup("chat_reply", hit=assistant_text is not None)
+            if assistant_text is None:
+                assistant_text = generate_chatbot_reply_llm(
+                    user_text=req.user_text,
+                    user_type=session.user_type,
+                    best=best,
+                    sorted_list=sorted_list,
+                    activities=activities,
+                    charging_minutes=charging_minutes,
+                    start_city=session.start_city,
+                    end_city=session.end_city,
+                    history=session.messages[:-1],
+                )
+                # "Done." is the LLM failure fallback, never worth caching
+                if assistant_text != "Done.":
+                    REPLY_CACHE.store(cache_context, req.user_text, assistant_text)
+
+            session.messages.append({"role": "ai", "text": assistant_text})
 
-        if not best:
-            assistant_text = "⚠️ I couldn't find a suitable station. Try another route or increase station coverage."
-            store["messages"].append({"role": "ai", "text": assistant_text})
             return ChatResponse(
                 conversation_id=req.conversation_id,
                 assistant_text=assistant_text,
-                user_type=store["user_type"] or "Casual_Driver",
+                user_type=session.user_type,
+                best_station=best,
+                sorted_stations=sorted_list,
+                reanalyzed=reanalyzed,
+            )
+
+        except (resilience.CircuitOpen, resilience.RateLimited) as e:
+            # Groq's bucket is empty or its breaker open: 503 + Retry-After rather than a
+            # 200 "Done.", and the turn is dropped so the retry doesn't repeat it in the history
+            session.messages.pop()
+            raise HTTPException(
+                status_code=resilience.http_status(e), detail=str(e),
+                headers={"Retry-After": str(int(e.retry_after) + 1)},
+            )
+        except Exception:
+            traceback.print_exc()
+            return ChatResponse(
+                conversation_id=req.conversation_id,
+                assistant_text="⚠️ Error processing chat. Please try again.",
+                user_type="Casual_Driver",
                 best_station=None,
                 sorted_stations=[],
             )
 
-        charging_minutes = random.choice([30, 60, 90, 120, 150, 180, 210])
 
-        activities = predict_activities(store["user_type"], charging_minutes)
+# -----------------------
+# Endpoint: reply cache / LLM usage / session stats
+# -----------------------
+@app.get("/chat/cache-stats")
+async def chat_cache_stats():
+    return REPLY_CACHE.stats()
+
 
-        assistant_text = generate_chatbot_reply_llm(
-            user_text=req.user_text,
-            user_type=store["user_type"],
-            best=best,
-            sorted_list=sorted_list,
-            activities=activities,
-            charging_minutes=charging_minutes,
-            start_city=req.start_city,
-            end_city=req.end_city,
-        )
+@app.get("/chat/llm-usage")
+async def chat_llm_usage():
+    return LLM_USAGE.stats()
 
-        store["messages"].append({"role": "ai", "text": assistant_text})
 
-        return ChatResponse(
-            conversation_id=req.conversation_id,
-            assistant_text=assistant_text,
-            user_type=store["user_type"],
-            best_station=best,
-            sorted_stations=sorted_list,
-        )
+@app.get("/chat/sessions")
+async def chat_sessions():
+    return SESSIONS.stats()
 
-    except Exception:
-        traceback.print_exc()
-        return ChatResponse(
-            conversation_id=req.conversation_id,
-            assistant_text="⚠️ Error processing chat. Please try again.",
-            user_type="Casual_Driver",
-            best_station=None,
-            sorted_stations=[],
-        )
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return ADMISSION.stats()
+
+
+# -----------------------
+# Live charger status (SSE + WebSocket), services/charger_status.py
+# -----------------------
+# one poller/LISTEN connection per process, started by the first subscriber
+CHARGER_STATUS = ChargerStatusHub(lambda: PostgresChargerSource(get_db_connection))
+STATUS_HEARTBEAT_SECONDS = 15
+
+
+@app.get("/stations/status/stream")
+async def station_status_stream(request: Request, stations: Optional[str] = None, bbox: Optional[str] = None):
+    """
+    Server-sent events: one `snapshot` event for the filter, then `delta`
+    events with only the chargers that changed. ?stations=id1,id2 and/or
+    ?bbox=west,south,east,north; no filter streams every station.
+    """
+    try:
+        station_ids, box = parse_filter(stations, bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    sub = CHARGER_STATUS.subscribe(station_ids, box)
+    if sub is None:
+        raise HTTPException(status_code=503, detail="too many status subscribers")
+
+    def event(msg: dict) -> str:
+        return f"id: {msg['seq']}\nevent: {msg['type']}\ndata: {json.dumps(msg, separators=(',', ':'))}\n\n"
+
+    async def events():
+        try:
+            await CHARGER_STATUS.ready()
+            yield event(CHARGER_STATUS.snapshot_message(sub))
+            while not await request.is_disconnected():
+                msg = await CHARGER_STATUS.next(sub, STATUS_HEARTBEAT_SECONDS)
+                # comment line keeps proxies from closing an idle stream
+                yield event(msg) if msg else ": ping\n\n"
+        finally:
+            CHARGER_STATUS.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/ws/stations/status")
+async def station_status_ws(websocket: WebSocket, stations: Optional[str] = None, bbox: Optional[str] = None):
+    """
+    Same messages as the SSE stream. The client may change its filter at any
+    time by sending {"stations": [...], "bbox": [w, s, e, n]}; a new snapshot follows.
+    """
+    try:
+        station_ids, box = parse_filter(stations, bbox)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    sub = CHARGER_STATUS.subscribe(station_ids, box)
+    if sub is None:
+        await websocket.close(code=1013)  # try again later
+        return
+
+    async def receive_filters():
+        try:
+            while True:
+                try:
+                    data = await websocket.receive_json()
+                    ids, new_box = parse_filter(
+                        ",".join(data.get("stations") or []),
+                        ",".join(str(v) for v in data["bbox"]) if data.get("bbox") else None,
+                    )
+                except (ValueError, TypeError, AttributeError) as e:
+                    await websocket.send_json({"type": "error", "error": str(e)})
+                    continue
+                CHARGER_STATUS.update_filter(sub, ids, new_box)
+                await websocket.send_json(CHARGER_STATUS.snapshot_message(sub))
+        finally:
+            sub.event.set()  # wake the sender so it notices the disconnect
+
+    receiver = asyncio.create_task(receive_filters())
+    try:
+        await CHARGER_STATUS.ready()
+        await websocket.send_json(CHARGER_STATUS.snapshot_message(sub))
+        while True:
+            msg = await CHARGER_STATUS.next(sub, STATUS_HEARTBEAT_SECONDS)
+            if receiver.done():
+                break
+            await websocket.send_json(msg or {"type": "ping", "seq": CHARGER_STATUS.seq})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        CHARGER_STATUS.unsubscribe(sub)
+
+
+@app.get("/stations/status/stats")
+async def station_status_stats():
+    return CHARGER_STATUS.stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# -----------------------
+# Profiling admin (requires X-Profile-Token)
+# -----------------------
+class ProfilingConfig(BaseModel):
+    endpoints: Optional[List[str]] = None
+    sample_rate: float = 0.0  # 0 disarms
+
+
+def require_profile_token(token: Optional[str]):
+    if not PROFILER.authorized(token):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+
+@app.get("/admin/profiling")
+async def admin_profiling_status(x_profile_token: Optional[str] = Header(None)):
+    require_profile_token(x_profile_token)
+    return PROFILER.status()
+
+
+@app.post("/admin/profiling")
+async def admin_profiling_configure(cfg: ProfilingConfig, x_profile_token: Optional[str] = Header(None)):
+    require_profile_token(x_profile_token)
+    PROFILER.configure(cfg.endpoints or sorted(PROFILED_ENDPOINTS), cfg.sample_rate)
+    return PROFILER.status()
+
+
+@app.get("/admin/profiles")
+async def admin_profiles(x_profile_token: Optional[str] = Header(None)):
+    require_profile_token(x_profile_token)
+    return {"profiles": PROFILER.list()}
+
+
+@app.get("/admin/profiles/{profile_id}/{fmt}")
+async def admin_profile_download(profile_id: str, fmt: str, x_profile_token: Optional[str] = Header(None)):
+    require_profile_token(x_profile_token)
+    path = PROFILER.artifact_path(profile_id, fmt)
+    if not path:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
 
 
 if __name__ == "__main__":
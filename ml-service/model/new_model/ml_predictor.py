@@ -5,22 +5,47 @@ import pytz
 from datetime import datetime
 from dotenv import load_dotenv
 
+from fast_predictor import compile_pipeline, random_records, verify_parity
+
 load_dotenv()
 
 MODEL_PATH = os.getenv("MODEL_PATH", "models/ev_recommendation_model_v4.pkl")
+# "compiled" (NumPy evaluator, falls back to sklearn when unsupported) or "sklearn"
+INFERENCE_BACKEND = os.getenv("ML_INFERENCE_BACKEND", "compiled")
+PARITY_SAMPLE = int(os.getenv("ML_PARITY_SAMPLE", "300"))
 
 model_pipeline = None
 mlb = None
+compiled_model = None
 
 def load_model():
-    global model_pipeline, mlb
+    global model_pipeline, mlb, compiled_model
     try:
         model_data = joblib.load(MODEL_PATH)
         model_pipeline = model_data["pipeline"]
         mlb = model_data["mlb"]
+        compiled_model = None
         print("✅ ML model loaded:", MODEL_PATH)
     except Exception as e:
         print("⚠️ ML model not loaded:", e)
+        return
+
+    if INFERENCE_BACKEND != "compiled":
+        return
+    try:
+        candidate = compile_pipeline(model_pipeline)
+        if candidate is None:
+            print("ℹ️ Compiled inference not supported for this pipeline; using sklearn")
+            return
+        # never serve a compiled model that disagrees with sklearn
+        mismatches = verify_parity(model_pipeline, candidate, random_records(PARITY_SAMPLE))
+        if mismatches:
+            print(f"⚠️ Compiled inference parity failed ({mismatches}/{PARITY_SAMPLE}); using sklearn")
+            return
+        compiled_model = candidate
+        print(f"✅ Compiled inference enabled ({candidate.kind})")
+    except Exception as e:
+        print("⚠️ Compiled inference unavailable:", e)
 
 def app_user_to_model_user(app_user_type: str) -> str:
     """
@@ -45,6 +70,23 @@ def predict_activities(app_user_type: str, charging_time_minutes: int) -> str:
 
     model_user_type = app_user_to_model_user(app_user_type)
 
+    if compiled_model is not None:
+        record = (
+            model_user_type,
+            int(charging_time_minutes),
+            now_lk.strftime("%H:%M"),
+            now_lk.strftime("%A"),
+            now_lk.strftime("%B"),
+            0,
+            1 if now_lk.weekday() >= 5 else 0,
+        )
+        try:
+            pred = compiled_model.predict(record)
+            cleaned = [c for c, on in zip(mlb.classes_, pred) if on and c != "none"]
+            return ", ".join(cleaned) if cleaned else "Coffee, snack, short walk"
+        except Exception as e:
+            print("⚠️ Compiled predict error, falling back to sklearn:", e)
+
     input_df = pd.DataFrame([{
         "user_type": model_user_type,
         "charging_time": int(charging_time_minutes),
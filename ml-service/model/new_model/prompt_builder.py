@@ -0,0 +1,210 @@
+import os
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+# Token budget for the per-call (dynamic) part of a prompt; the static system
+# prompts below are sent verbatim and are identical on every call.
+PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "900"))
+USER_TYPE_TOKEN_BUDGET = int(os.getenv("CHAT_USER_TYPE_TOKEN_BUDGET", "300"))
+MAX_ALTERNATIVES = 2
+
+# -----------------------
+# Static system prompts
+# -----------------------
+REPLY_SYSTEM_PROMPT = """You are AMPORA ⚡, a friendly and reliable EV travel assistant. Be clear, natural, and practical.
+
+The station decision is already computed. Do NOT change the best station.
+Stations are given as a table: rank|name|wait_h|drive|distance|address (rank 1 = BEST).
+
+Knowledge & search rules:
+1) If you know the answer with high confidence, answer directly.
+2) If the question involves real-world, location-based, time-sensitive, or uncertain information
+   (station ratings, nearby cafés/restrooms/shops, opening hours, pricing, traffic, availability),
+   search the internet to verify. The user does NOT need to ask you to search.
+3) When you use online information, mention the source(s) briefly (e.g. "Source: Google Maps reviews").
+4) Never invent ratings, reviews, prices, or availability. If data is unavailable, say so briefly.
+
+Conversation behavior:
+- Do NOT repeat the same long explanation if the user asks again or says "no". Adapt and move forward.
+- If the user already indicated work or holiday, do NOT ask again.
+- Ask at most ONE short follow-up question only if it genuinely helps.
+- If battery level (SOC) is missing and required, ask once: "What's your battery level right now? (0–100%)"
+  If still missing, continue with reasonable assumptions.
+
+Response goals:
+1) Explain why the best station is the best choice and briefly mention 1–2 alternatives.
+2) Suggest how to spend the charging wait using the ML-predicted activities.
+3) If helpful, include nearby highly rated places (cafés/food/shops) with ratings and source.
+4) Friendly tone. Short paragraphs. Light emojis only if helpful (⚡🔋⭐).
+
+Output rules:
+- Be concise and user-friendly.
+- Return ONLY valid JSON in this exact format: {"assistant_text":"..."}"""
+
+USER_TYPE_SYSTEM_PROMPT = """Classify the user into exactly ONE type:
+- Delivery_Driver
+- Business_Man
+- Casual_Driver
+- Tourist
+
+Return ONLY JSON: {"user_type":"Casual_Driver"}"""
+
+
+# -----------------------
+# Token accounting
+# -----------------------
+def estimate_tokens(text: str) -> int:
+    """Cheap tokenizer-free estimate (~4 chars per token for English/Llama vocabularies)."""
+    return (len(text or "") + 3) // 4
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    max_chars = max(0, max_tokens) * 4
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return text
+    return text[: max(0, max_chars - 1)].rstrip() + "…"
+
+
+def compact_stations(best: dict, sorted_list: list) -> str:
+    """Best station + top alternatives as a terse pipe table."""
+    alternatives = [s for s in sorted_list if s.get("name") != best.get("name")][:MAX_ALTERNATIVES]
+    rows = []
+    for rank, s in enumerate([best] + alternatives, start=1):
+        rows.append("|".join([
+            str(rank),
+            str(s.get("name", "")),
+            str(s.get("wait", "")),
+            str(s.get("travel_time", "")),
+            str(s.get("distance", "")),
+            _truncate(str(s.get("address") or "N/A"), 12),
+        ]))
+    return "\n".join(rows)
+
+
+def fit_history(messages: List[dict], max_tokens: int) -> List[str]:
+    """
+    Newest messages verbatim while they fit `max_tokens`; everything older is
+    folded into a single 'Earlier:' line made of the user's own words.
+    """
+    kept: List[str] = []
+    used = 0
+    cut = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        line = f"{messages[i]['role']}: {messages[i]['text']}"
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+        cut = i
+    kept.reverse()
+
+    older = messages[:cut]
+    if older:
+        summary_budget = max_tokens - used
+        user_said = "; ".join(m["text"].strip() for m in older if m["role"] == "user")
+        if summary_budget > 8 and user_said:
+            kept.insert(0, "Earlier: user said " + _truncate(user_said, summary_budget - 5))
+    return kept
+
+
+# -----------------------
+# Builder
+# -----------------------
+class PromptBuilder:
+    """Builds chat messages for the Groq calls inside a fixed token budget."""
+
+    def __init__(self, token_budget: int = PROMPT_TOKEN_BUDGET, user_type_budget: int = USER_TYPE_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.user_type_budget = user_type_budget
+
+    def reply_messages(
+        self,
+        user_text: str,
+        user_type: str,
+        best: dict,
+        sorted_list: list,
+        activities: str,
+        charging_minutes: int,
+        start_city: str,
+        end_city: str,
+        history: Optional[List[dict]] = None,
+    ) -> List[Dict[str, str]]:
+        head = (
+            f"User type: {user_type}\n"
+            f"Trip: {_truncate(start_city, 20)} -> {_truncate(end_city, 20)}\n"
+            f"Stations:\n{compact_stations(best, sorted_list)}\n"
+            f"Charging estimate: {charging_minutes} min\n"
+            f"ML activities: {activities}\n"
+        )
+        message = f'User message: "{_truncate(user_text, self.token_budget // 4)}"'
+        remaining = self.token_budget - estimate_tokens(head) - estimate_tokens(message)
+
+        lines = fit_history(history or [], remaining - 2) if remaining > 10 else []
+        body = head + ("Conversation:\n" + "\n".join(lines) + "\n" if lines else "") + message
+        return [
+            {"role": "system", "content": REPLY_SYSTEM_PROMPT},
+            {"role": "user", "content": body},
+        ]
+
+    def user_type_messages(
+        self,
+        user_text: str,
+        start_city: str,
+        end_city: str,
+        history: Optional[List[dict]] = None,
+    ) -> List[Dict[str, str]]:
+        head = f"Trip: {_truncate(start_city, 20)} -> {_truncate(end_city, 20)}\n"
+        message = f"User message:\n{_truncate(user_text, self.user_type_budget // 2)}"
+        remaining = self.user_type_budget - estimate_tokens(head) - estimate_tokens(message)
+
+        lines = fit_history(history or [], remaining - 2) if remaining > 10 else []
+        body = head + ("Conversation:\n" + "\n".join(lines) + "\n" if lines else "") + message
+        return [
+            {"role": "system", "content": USER_TYPE_SYSTEM_PROMPT},
+            {"role": "user", "content": body},
+        ]
+
+
+# -----------------------
+# Usage reporting
+# -----------------------
+class LLMUsage:
+    """Per-call prompt/completion token counts as reported by the API."""
+
+    def __init__(self, keep_last: int = 100):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep_last)
+        self._totals: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, messages: List[Dict[str, str]], response: Any) -> Dict[str, Any]:
+        usage = getattr(response, "usage", None)
+        call = {
+            "kind": kind,
+            "estimated_prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages),
+            "prompt_tokens": int(getattr(usage, "prompt_tokens", 0) or 0),
+            "completion_tokens": int(getattr(usage, "completion_tokens", 0) or 0),
+        }
+        with self._lock:
+            self._recent.append(call)
+            totals = self._totals.setdefault(kind, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            totals["calls"] += 1
+            totals["prompt_tokens"] += call["prompt_tokens"]
+            totals["completion_tokens"] += call["completion_tokens"]
+        return call
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "totals": {
+                    kind: {
+                        **t,
+                        "avg_prompt_tokens": round(t["prompt_tokens"] / t["calls"], 1) if t["calls"] else 0.0,
+                        "avg_completion_tokens": round(t["completion_tokens"] / t["calls"], 1) if t["calls"] else 0.0,
+                    }
+                    for kind, t in self._totals.items()
+                },
+                "recent": list(self._recent),
+            }
@@ -0,0 +1,220 @@
+"""
+Out-of-core training for the activity recommendation model.
+
+    python train.py --data ../ev_activity_data_v3.csv --workers 4
+
+Streams the dataset (CSV or Parquet) in chunks, hashes features with
+features.encode_features, trains partial_fit estimators for every candidate
+in the grid in a process pool, and saves the best one in the package format
+ml_predictor.load_model expects ({"pipeline", "mlb", "target_names"}), next
+to a JSON report with accuracy and single-row latency.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import SGDClassifier
+from sklearn.multioutput import MultiOutputClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer, MultiLabelBinarizer
+
+from features import FEATURE_COLUMNS, encode_features
+
+DEFAULT_OUTPUT = "models/ev_recommendation_model_v5.pkl"
+CHUNK_SIZE = 200_000
+# every VALIDATION_MOD-th row (by position in the file) is held out
+VALIDATION_MOD = 5
+
+PARAM_GRID = {
+    "loss": ["log_loss", "modified_huber", "hinge"],
+    "alpha": [1e-6, 1e-5, 1e-4],
+}
+
+
+# -----------------------
+# Streaming input
+# -----------------------
+def iter_frames(path: str, chunk_size: int = CHUNK_SIZE, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, usecols=columns)
+
+
+def split_labels(labels: pd.Series) -> List[List[str]]:
+    return labels.fillna("none").astype(str).str.split(", ").tolist()
+
+
+def collect_classes(path: str, chunk_size: int) -> List[str]:
+    classes = set()
+    for frame in iter_frames(path, chunk_size, columns=["label"]):
+        for row in split_labels(frame["label"]):
+            classes.update(row)
+    return sorted(classes)
+
+
+def iter_split(path: str, chunk_size: int, validation: bool) -> Iterator[pd.DataFrame]:
+    offset = 0
+    for frame in iter_frames(path, chunk_size, columns=FEATURE_COLUMNS + ["label"]):
+        held_out = (np.arange(offset, offset + len(frame)) % VALIDATION_MOD) == 0
+        offset += len(frame)
+        part = frame[held_out if validation else ~held_out]
+        if len(part):
+            yield part
+
+
+# -----------------------
+# One grid candidate (runs in a worker process)
+# -----------------------
+def _evaluate(model, mlb: MultiLabelBinarizer, path: str, chunk_size: int) -> Dict[str, float]:
+    rows = exact = 0
+    wrong_labels = 0
+    for frame in iter_split(path, chunk_size, validation=True):
+        y_true = mlb.transform(split_labels(frame["label"]))
+        y_pred = model.predict(encode_features(frame))
+        rows += len(frame)
+        exact += int((y_true == y_pred).all(axis=1).sum())
+        wrong_labels += int((y_true != y_pred).sum())
+    n_labels = len(mlb.classes_)
+    return {
+        "validation_rows": rows,
+        "subset_accuracy": exact / rows if rows else 0.0,
+        "hamming_loss": wrong_labels / (rows * n_labels) if rows else 1.0,
+    }
+
+
+def train_candidate(params: Dict[str, Any], classes: List[str], path: str, chunk_size: int,
+                    epochs: int, seed: int) -> Dict[str, Any]:
+    mlb = MultiLabelBinarizer(classes=classes).fit([])
+    model = MultiOutputClassifier(SGDClassifier(random_state=seed, **params))
+    rng = np.random.default_rng(seed)
+    output_classes = [np.array([0, 1])] * len(classes)
+
+    started = time.perf_counter()
+    train_rows = 0
+    for _ in range(epochs):
+        for frame in iter_split(path, chunk_size, validation=False):
+            # chunks of real session logs arrive in time order; shuffle inside the chunk
+            frame = frame.iloc[rng.permutation(len(frame))]
+            model.partial_fit(
+                encode_features(frame),
+                mlb.transform(split_labels(frame["label"])),
+                classes=output_classes,
+            )
+            train_rows += len(frame)
+    train_seconds = time.perf_counter() - started
+
+    return {
+        "params": params,
+        "train_rows": train_rows,
+        "train_seconds": round(train_seconds, 2),
+        **_evaluate(model, mlb, path, chunk_size),
+        "model": model,
+    }
+
+
+# -----------------------
+# Report helpers
+# -----------------------
+def measure_latency(pipeline: Pipeline, sample: pd.DataFrame, repeats: int = 300) -> Dict[str, float]:
+    """Single-row predict latency through the full pipeline, as ml_predictor calls it."""
+    rows = [sample.iloc[[i % len(sample)]] for i in range(repeats)]
+    timings = []
+    for row in rows:
+        t0 = time.perf_counter()
+        pipeline.predict(row)
+        timings.append((time.perf_counter() - t0) * 1e6)
+    timings.sort()
+    return {
+        "single_row_p50_us": round(timings[len(timings) // 2], 1),
+        "single_row_p95_us": round(timings[int(len(timings) * 0.95) - 1], 1),
+        "single_row_max_us": round(timings[-1], 1),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Train the activity recommendation model out of core.")
+    parser.add_argument("--data", required=True, help="CSV or Parquet from model/dataset.py or session logs")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--report", default=None, help="defaults to <output>.report.json")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    classes = collect_classes(args.data, args.chunk_size)
+    print(f"Target activities: {classes}")
+
+    grid = [dict(zip(PARAM_GRID, values)) for values in itertools.product(*PARAM_GRID.values())]
+    print(f"Training {len(grid)} candidates on {args.workers} worker(s)...")
+
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(
+            train_candidate,
+            grid,
+            itertools.repeat(classes),
+            itertools.repeat(args.data),
+            itertools.repeat(args.chunk_size),
+            itertools.repeat(args.epochs),
+            itertools.repeat(args.seed),
+        ))
+
+    results.sort(key=lambda r: (-r["subset_accuracy"], r["hamming_loss"]))
+    best = results[0]
+    for r in results:
+        print(f"  {r['params']}: accuracy={r['subset_accuracy']:.4f} hamming={r['hamming_loss']:.4f}")
+    print(f"✅ Best: {best['params']}")
+
+    mlb = MultiLabelBinarizer(classes=classes).fit([])
+    # both steps are already fitted: the transformer is stateless, the classifier came from partial_fit
+    pipeline = Pipeline([
+        ("transformer", FunctionTransformer(encode_features)),
+        ("classifier", best["model"]),
+    ])
+    sample = next(iter_split(args.data, args.chunk_size, validation=True))[FEATURE_COLUMNS].head(100)
+    latency = measure_latency(pipeline, sample)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "data": os.path.abspath(args.data),
+        "chunk_size": args.chunk_size,
+        "epochs": args.epochs,
+        "seed": args.seed,
+        "classes": classes,
+        "best": {k: v for k, v in best.items() if k != "model"},
+        "candidates": [{k: v for k, v in r.items() if k != "model"} for r in results],
+        "latency": latency,
+    }
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    joblib.dump({
+        "pipeline": pipeline,
+        "mlb": mlb,
+        "target_names": np.array(classes),
+        "report": report,
+    }, args.output)
+
+    report_path = args.report or f"{os.path.splitext(args.output)[0]}.report.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"✅ Model saved: {args.output}")
+    print(f"📊 Report: {report_path} (p50 {latency['single_row_p50_us']} µs per prediction)")
+
+
+if __name__ == "__main__":
+    main()
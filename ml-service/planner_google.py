@@ -1,17 +1,29 @@
 # ml-service/planner_google.py
+import os
 import time
 from typing import List, Tuple, Any
 import httpx
-from geopy.distance import geodesic
+import numpy as np
 from pydantic import BaseModel
 
-GOOGLE_DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+from services import routing
+from services.cache import AsyncSingleFlight
+from services.nearest import match_route
+
+GOOGLE_MAPS_BASE_URL = os.getenv("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com").rstrip("/")
+GOOGLE_DIRECTIONS_URL = f"{GOOGLE_MAPS_BASE_URL}/maps/api/directions/json"
+GOOGLE_MATRIX_URL = f"{GOOGLE_MAPS_BASE_URL}/maps/api/distancematrix/json"
+
+# concurrent cache misses for the same trip share one Directions call
+_DIRECTIONS_FLIGHTS = AsyncSingleFlight("google_directions")
+# Directions and Distance Matrix calls go through routing.GOOGLE (services/resilience.py policy)
 
 # ---------------- DTOs ----------------
 class RouteDTO(BaseModel):
     distance_km: float
     duration_min: float
     path: List[Tuple[float, float]]
+    waypoint_order: List[int] | None = None  # indices into the requested waypoints
 
 class StationDTO(BaseModel):
     station_id: int
@@ -54,18 +66,6 @@ def decode_polyline5(polyline_str: str) -> List[Tuple[float, float]]:
     return coordinates
 
 
-def haversine_km(a, b):
-    return geodesic(a, b).km
-
-
-def point_segment_distance_km(p, a, b):
-    # simple & fast midpoint heuristic
-    return min(
-        haversine_km(p, a),
-        haversine_km(p, b),
-        haversine_km(p, ((a[0] + b[0]) / 2, (a[1] + b[1]) / 2)),
-    )
-
 # ---------------- Directions + stations ----------------
 class TTLCache:
     def __init__(self, ttl=25):
@@ -92,8 +92,41 @@ class GoogleEVPlanner:
         self.max_station_distance_km = max_station_distance_km
         self.cache = TTLCache(ttl=25)
 
+    async def get_duration_matrix(self, points):
+        """All-pairs driving seconds via the Distance Matrix API (NaN = no route)."""
+        matrix = np.full((len(points), len(points)), np.nan)
+        async with httpx.AsyncClient() as client:
+            for first_row, params in routing.google_matrix_requests(points):
+                async def get(timeout, params=params):
+                    r = await client.get(GOOGLE_MATRIX_URL, params={**params, "key": self.key}, timeout=timeout)
+                    r.raise_for_status()
+                    return r.json()
+                routing.google_matrix_fill(matrix, first_row, await routing.GOOGLE.call_async(get))
+        return matrix
+
+    async def order_waypoints(self, start, end, waypoints):
+        """(waypoints in drive-time order, order info) from a cached duration matrix; info is None if it failed."""
+        if len(waypoints) < 2:
+            return waypoints, None
+        points = routing.route_points(start, end, waypoints)
+        try:
+            # concurrent requests for the same stops share one Distance Matrix fetch
+            matrix, cached = await routing.DURATION_MATRICES.get_or_fetch_async("google", points, self.get_duration_matrix)
+        except Exception as e:
+            print(f"⚠️ Google distance matrix failed, letting Directions optimize: {e}")
+            return waypoints, None
+        return routing.order_stops(waypoints, matrix, cached)
+
+    async def _directions(self, params):
+        async with httpx.AsyncClient() as client:
+            async def get(timeout):
+                r = await client.get(GOOGLE_DIRECTIONS_URL, params=params, timeout=timeout)
+                r.raise_for_status()
+                return r.json()
+            return await routing.GOOGLE.call_async(get)
+
     async def get_routes_from_google(self, start, end, waypoints=None):
-        waypoints = waypoints or []
+        waypoints, info = await self.order_waypoints(start, end, list(waypoints or []))
         wp_string = "|".join(f"{lat},{lng}" for (lat, lng) in waypoints) if waypoints else None
 
         cache_key = f"{start}-{end}-{wp_string}"
@@ -110,11 +143,10 @@ class GoogleEVPlanner:
         }
 
         if wp_string:
-            params["waypoints"] = f"optimize:true|{wp_string}"
+            # already ordered locally; Google only optimizes when the matrix wasn't available
+            params["waypoints"] = wp_string if info or len(waypoints) < 2 else f"optimize:true|{wp_string}"
 
-        async with httpx.AsyncClient(timeout=8.5) as client:
-            r = await client.get(GOOGLE_DIRECTIONS_URL, params=params)
-            data = r.json()
+        data = await _DIRECTIONS_FLIGHTS.do(cache_key, self._directions, params)
 
         routes = []
         for rt in data.get("routes", []):
@@ -129,6 +161,7 @@ class GoogleEVPlanner:
                     distance_km=round(dist_m / 1000, 2),
                     duration_min=round(dur_s / 60, 1),
                     path=path,
+                    waypoint_order=info["order"] if info else rt.get("waypoint_order"),
                 )
             )
 
@@ -144,23 +177,13 @@ class GoogleEVPlanner:
         if len(path) < 2:
             return []
 
+        lats = np.fromiter((s.lat for s in stations), dtype=np.float64, count=len(stations))
+        lons = np.fromiter((s.lon for s in stations), dtype=np.float64, count=len(stations))
         near = []
-        for s in stations:
-            p = (s.lat, s.lon)
-            best = 9999
-            for i in range(len(path) - 1):
-                a = path[i]
-                b = path[i + 1]
-                d = point_segment_distance_km(p, a, b)
-                if d < best:
-                    best = d
-                    if best <= self.max_station_distance_km:
-                        break
-
-            if best <= self.max_station_distance_km:
-                s2 = s.model_copy()
-                s2.distance_to_route_km = round(best, 2)
-                near.append(s2)
+        for i, dist in match_route(path, lats, lons, self.max_station_distance_km):
+            s2 = stations[i].model_copy()
+            s2.distance_to_route_km = dist
+            near.append(s2)
 
         near.sort(key=lambda s: s.distance_to_route_km or 9999)
         return near
@@ -0,0 +1,50 @@
+# ml-service/publish_stations.py
+"""
+Keep the shared station snapshot of the route service fresh from one process.
+
+    STATION_SHM_DIR=/dev/shm/ampora-stations python publish_stations.py           # every STATION_SNAPSHOT_TTL_SECONDS
+    STATION_SHM_DIR=/dev/shm/ampora-stations python publish_stations.py --once
+
+Run it next to the app.py workers (same STATION_SHM_DIR and Postgres settings).
+While it keeps the generation younger than the TTL, no worker queries Postgres
+for stations; without it, one worker at a time reloads (services/shared_stations.py).
+"""
+import argparse
+import os
+import time
+from typing import List, Optional
+
+from services import shared_stations
+from services.stations import STATION_SNAPSHOT_TTL_SECONDS
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Publish the route service's station snapshot to shared memory.")
+    parser.add_argument("--once", action="store_true", help="publish one generation and exit")
+    # a little under the TTL so workers never find the generation stale
+    parser.add_argument("--interval", type=float, default=STATION_SNAPSHOT_TTL_SECONDS * 0.8, help="seconds between loads")
+    args = parser.parse_args(argv)
+
+    if not shared_stations.STATION_SHM_DIR:
+        raise SystemExit("❌ STATION_SHM_DIR is not set")
+    store = shared_stations.StationStore(os.path.join(shared_stations.STATION_SHM_DIR, "route-service"))
+
+    # the app module owns the database setup and the station loader
+    from app import _load_stations
+
+    while True:
+        try:
+            stations = _load_stations()
+            with store.publisher_lock(blocking=True):
+                pointer = store.publish(stations)
+            print(f"📁 {len(stations)} stations, generation {pointer['version']} in {store.directory}")
+        except Exception as e:
+            # workers keep serving the previous generation (and reload themselves once it is stale)
+            print(f"⚠️ Station publish failed: {e}")
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Admission control: per-endpoint concurrency limits, priority queueing and
+load shedding, plus token buckets for quota-bound upstreams.
+
+Without it a spike is accepted in full and every request slows down
+together. Each limited endpoint runs at most `limit` requests at once; the
+rest wait in a priority queue (X-Request-Priority: interactive ahead of
+fleet/batch, ahead of operator reports; interactive is the default) and a
+finished request hands its slot straight to the best waiter. Requests are
+shed with a fast 503 instead of queueing when:
+
+- predicted_wait: the queue ahead of them would take longer than the queue
+  budget to drain (going by recent request durations)
+- queue_full: the queue is at ADMISSION_QUEUE_SIZE and holds nothing of
+  lower priority to evict (evicted waiters are shed with reason "evicted")
+- queue_timeout: they waited ADMISSION_QUEUE_SECONDS (or their deadline ran out)
+
+    ADMISSION = AdmissionControl(parse_limits(os.getenv("ADMISSION_LIMITS"), {"/api/route": 16}))
+    ticket = ADMISSION.acquire("/api/route", request.headers.get(PRIORITY_HEADER))  # raises Shed
+    ...
+    ticket.release()
+
+Token buckets pace calls to quota-bound upstreams (Google, Groq) per
+process; resilience.Upstream takes one and refuses an attempt that couldn't
+get a token within RATE_LIMIT_WAIT_SECONDS (or before the request deadline).
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services import metrics, resilience
+
+PRIORITY_HEADER = "X-Request-Priority"
+PRIORITIES = {"interactive": 0, "fleet": 1, "batch": 1, "operator": 2}
+DEFAULT_PRIORITY = "interactive"
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_SECONDS = float(os.getenv("ADMISSION_QUEUE_SECONDS", "2"))
+
+# per process (rate and burst): divide the account quota by the total number of workers
+UPSTREAM_RATES: Dict[str, Tuple[float, int]] = {
+    "google": (float(os.getenv("GOOGLE_RATE_PER_SECOND", "10")), int(os.getenv("GOOGLE_BURST", "20"))),
+    "groq": (float(os.getenv("GROQ_RATE_PER_MINUTE", "30")) / 60.0, int(os.getenv("GROQ_BURST", "5"))),
+}
+
+QUEUE_DEPTH = metrics.gauge("ampora_admission_queue_depth", "Requests waiting for a slot.", ["endpoint"])
+ACTIVE = metrics.gauge("ampora_admission_active", "Requests holding a slot.", ["endpoint"])
+SHED = metrics.counter(
+    "ampora_admission_shed_total",
+    "Requests answered 503 by admission control (predicted_wait, queue_full, evicted, queue_timeout).",
+    ["endpoint", "priority", "reason"],
+)
+QUEUE_SECONDS = metrics.histogram(
+    "ampora_admission_queue_seconds", "Time admitted requests waited for a slot.", ["endpoint", "priority"]
+)
+BUCKET_TAKES = metrics.counter(
+    "ampora_rate_limit_takes_total", "Token bucket takes (immediate, waited, rejected).", ["bucket", "outcome"]
+)
+
+
+class Shed(Exception):
+    def __init__(self, endpoint: str, priority: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{endpoint} is overloaded ({reason}); retry later")
+        self.reason = reason
+        self.retry_after = retry_after
+        SHED.labels(endpoint=endpoint, priority=priority, reason=reason).inc()
+
+
+def parse_limits(spec: Optional[str], defaults: Dict[str, int]) -> Dict[str, int]:
+    """"/api/route=16,/chat=8" over the defaults; a limit of 0 turns an endpoint's limit off."""
+    limits = dict(defaults)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            endpoint, limit = item.rsplit("=", 1)
+            limits[endpoint.strip()] = int(limit)
+    return {e: n for e, n in limits.items() if n > 0}
+
+
+def priority_name(header_value: Optional[str]) -> str:
+    name = (header_value or "").strip().lower()
+    return name if name in PRIORITIES else DEFAULT_PRIORITY
+
+
+# -----------------------
+# Concurrency limit + priority queue
+# -----------------------
+class _Waiter:
+    __slots__ = ("level", "seq", "wake", "granted", "shed")
+
+    def __init__(self, level: int, seq: int, wake: Callable[[], None]):
+        self.level = level
+        self.seq = seq
+        self.wake = wake
+        self.granted = False
+        self.shed: Optional[str] = None
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.level, self.seq) < (other.level, other.seq)
+
+
+class Ticket:
+    """A held slot; release() exactly once when the request is done (later calls are no-ops)."""
+    __slots__ = ("_limiter", "_started", "waited")
+
+    def __init__(self, limiter: "EndpointLimiter", waited: float):
+        self._limiter = limiter
+        self._started = time.monotonic()
+        self.waited = waited
+
+    def release(self):
+        if self._limiter is not None:
+            self._limiter._release(time.monotonic() - self._started)
+            self._limiter = None
+
+
+class EndpointLimiter:
+    def __init__(self, endpoint: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 max_wait: float = ADMISSION_QUEUE_SECONDS):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        # smoothed request duration, for predicting queue waits
+        self._service_seconds = 0.0
+        self._stats = {"admitted": 0, "queued": 0, "shed": 0}
+
+    def _gauges(self):
+        QUEUE_DEPTH.labels(endpoint=self.endpoint).set(len(self._queue))
+        ACTIVE.labels(endpoint=self.endpoint).set(self.active)
+
+    def _shed(self, priority: str, reason: str) -> Shed:
+        self._stats["shed"] += 1
+        return Shed(self.endpoint, priority, reason, retry_after=max(1.0, self._service_seconds))
+
+    def _enter(self, priority: str, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """None when admitted straight away, else the queued waiter; raises Shed."""
+        level = PRIORITIES[priority]
+        with self._lock:
+            if self.active < self.limit and not self._queue:
+                self.active += 1
+                self._stats["admitted"] += 1
+                self._gauges()
+                return None
+            ahead = sum(1 for w in self._queue if w.level <= level)
+            if (ahead + 1) / self.limit * self._service_seconds > self.max_wait:
+                raise self._shed(priority, "predicted_wait")
+            if len(self._queue) >= self.queue_size:
+                # ADMISSION_QUEUE_SIZE=0: no queue, over the limit is shed straight away
+                worst = max(self._queue, key=lambda w: (w.level, w.seq), default=None)
+                if worst is None or worst.level <= level:
+                    raise self._shed(priority, "queue_full")
+                # a lower-priority waiter makes room
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                worst.shed = "evicted"
+                worst.wake()
+            waiter = _Waiter(level, next(self._seq), wake)
+            heapq.heappush(self._queue, waiter)
+            self._stats["queued"] += 1
+            self._gauges()
+            return waiter
+
+    def _settle(self, waiter: _Waiter, priority: str, waited: float) -> Ticket:
+        """After the wait: the slot, or Shed (the waiter leaves the queue if still in it)."""
+        with self._lock:
+            if not waiter.granted and waiter.shed is None:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                waiter.shed = "queue_timeout"
+                self._gauges()
+            if waiter.granted:
+                self._stats["admitted"] += 1
+        if waiter.shed is not None:
+            raise self._shed(priority, waiter.shed)
+        QUEUE_SECONDS.labels(endpoint=self.endpoint, priority=priority).observe(waited)
+        return Ticket(self, waited)
+
+    def _wait_budget(self) -> float:
+        left = resilience.remaining()
+        return self.max_wait if left is None else max(0.0, min(self.max_wait, left))
+
+    def acquire(self, priority: str) -> Ticket:
+        event = threading.Event()
+        waiter = self._enter(priority, event.set)
+        if waiter is None:
+            return Ticket(self, 0.0)
+        started = time.monotonic()
+        event.wait(self._wait_budget())
+        return self._settle(waiter, priority, time.monotonic() - started)
+
+    async def acquire_async(self, priority: str) -> Ticket:
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            # release() may run on a worker thread
+            loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+        waiter = self._enter(priority, wake)
+        if waiter is None:
+            return Ticket(self, 0.0)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(woken), self._wait_budget())
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # client went away while queued: leave, passing on a slot granted meanwhile
+            with self._lock:
+                granted = waiter.granted
+                if not granted and waiter.shed is None:
+                    self._queue.remove(waiter)
+                    heapq.heapify(self._queue)
+                    self._gauges()
+            if granted:
+                self._release(None)
+            raise
+        return self._settle(waiter, priority, time.monotonic() - started)
+
+    def _release(self, service_seconds: Optional[float]):
+        with self._lock:
+            if service_seconds is not None:
+                self._service_seconds = service_seconds if not self._service_seconds else (
+                    0.8 * self._service_seconds + 0.2 * service_seconds
+                )
+            if self._queue:
+                # the slot moves straight to the best waiter; active stays the same
+                waiter = heapq.heappop(self._queue)
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+            self._gauges()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "limit": self.limit,
+                "active": self.active,
+                "queued_now": len(self._queue),
+                "avg_request_ms": round(self._service_seconds * 1000, 1),
+            }
+
+
+class AdmissionControl:
+    """EndpointLimiter per limited endpoint; other endpoints are always admitted (ticket None)."""
+
+    def __init__(self, limits: Dict[str, int], queue_size: int = ADMISSION_QUEUE_SIZE,
+                 max_wait: float = ADMISSION_QUEUE_SECONDS):
+        self.limiters = {e: EndpointLimiter(e, n, queue_size, max_wait) for e, n in limits.items()}
+
+    def acquire(self, endpoint: str, priority_header: Optional[str] = None) -> Optional[Ticket]:
+        limiter = self.limiters.get(endpoint)
+        return limiter.acquire(priority_name(priority_header)) if limiter is not None else None
+
+    async def acquire_async(self, endpoint: str, priority_header: Optional[str] = None) -> Optional[Ticket]:
+        limiter = self.limiters.get(endpoint)
+        return await limiter.acquire_async(priority_name(priority_header)) if limiter is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {e: limiter.stats() for e, limiter in self.limiters.items()}
+
+
+# -----------------------
+# Token buckets
+# -----------------------
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate = max(0.0, rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, max_wait: float) -> Optional[float]:
+        """Seconds until the reserved token is ours, or None (nothing reserved) if over max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                wait = 0.0
+            else:
+                # rate 0: no refill, the burst is all there is (0 and 0 switches the upstream off)
+                wait = (1 - self._tokens) / self.rate if self.rate > 0 else float("inf")
+            if wait > max_wait:
+                BUCKET_TAKES.labels(bucket=self.name, outcome="rejected").inc()
+                return None
+            # may go negative: later callers queue behind this reservation
+            self._tokens -= 1
+        BUCKET_TAKES.labels(bucket=self.name, outcome="waited" if wait else "immediate").inc()
+        return wait
+
+    def take(self, max_wait: float) -> bool:
+        wait = self._reserve(max_wait)
+        if wait:
+            time.sleep(wait)
+        return wait is not None
+
+    async def take_async(self, max_wait: float) -> bool:
+        wait = self._reserve(max_wait)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait is not None
+
+
+_BUCKETS: Dict[str, TokenBucket] = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def bucket(name: str) -> TokenBucket:
+    """The process-wide bucket for an upstream in UPSTREAM_RATES."""
+    with _BUCKETS_LOCK:
+        if name not in _BUCKETS:
+            rate, burst = UPSTREAM_RATES[name]
+            _BUCKETS[name] = TokenBucket(name, rate, burst)
+        return _BUCKETS[name]
@@ -0,0 +1,174 @@
+"""
+Single-flight coalescing of identical in-flight calls.
+
+TTL/LRU caches only help once the first call has finished; when a popular
+trip is requested by many users at once, every one of them would still hit
+OSRM / Google / Postgres. A single-flight group lets the first caller for a
+key run the call while concurrent callers with the same key wait for its
+result (or exception) instead of making their own. Nothing is kept after
+the call finishes - pair it with a cache for that.
+
+    ROUTE_FLIGHTS = SingleFlight("osrm_route")
+    routes = ROUTE_FLIGHTS.do(key, fetch, start, end)              # threads (Flask)
+
+    DIRECTIONS_FLIGHTS = AsyncSingleFlight("google_directions")
+    data = await DIRECTIONS_FLIGHTS.do(key, fetch, origin, dest)   # asyncio
+
+Results are shared between callers, so they must be treated as read-only.
+The call runs under the service's own request deadline, not the first
+caller's (X-Request-Deadline-Ms may have shortened that one). Waiters give
+up after `timeout` seconds (the default, or per call, and never past their
+own request deadline) with TimeoutError; the call itself keeps running for
+whoever else is waiting. Errors reach every waiter as their own copy; a call
+that ran out of time or was cancelled is run again for the waiters instead.
+"""
+import asyncio
+import os
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from services import metrics, resilience
+
+SINGLEFLIGHT_TIMEOUT_SECONDS = float(os.getenv("SINGLEFLIGHT_TIMEOUT_SECONDS", "30"))
+
+CALLS = metrics.counter(
+    "ampora_singleflight_calls_total",
+    "Single-flight calls by role (leader ran it, follower shared it, timeout gave up waiting).",
+    ["flight", "role"],
+)
+IN_FLIGHT = metrics.gauge("ampora_singleflight_in_flight", "Keys currently being fetched.", ["flight"])
+
+
+def _wait_seconds(default: float, timeout: Optional[float]) -> float:
+    wait = default if timeout is None else timeout
+    left = resilience.remaining()
+    return wait if left is None else max(0.0, min(wait, left))
+
+
+def _rerun(error: BaseException) -> bool:
+    """Deadline and cancellation errors aren't the waiters' outcome; they run the call again while they have time."""
+    if isinstance(error, Exception) and not isinstance(error, resilience.DeadlineExceeded):
+        return False
+    left = resilience.remaining()
+    return left is None or left > 0
+
+
+def _fresh(error: BaseException) -> BaseException:
+    """A copy of a shared error; raising one object from several threads would tangle its traceback."""
+    cls = type(error)
+    try:
+        copy = cls.__new__(cls, *error.args)
+        copy.__dict__.update(error.__dict__)
+    except Exception:
+        return RuntimeError(f"shared call failed: {error!r}")
+    return copy
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Thread-based group: concurrent do() calls with the same key share one execution."""
+
+    def __init__(self, name: str, timeout: float = SINGLEFLIGHT_TIMEOUT_SECONDS):
+        self.name = name
+        self.timeout = timeout
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            CALLS.labels(flight=self.name, role="follower").inc()
+            if not call.done.wait(_wait_seconds(self.timeout, timeout)):
+                CALLS.labels(flight=self.name, role="timeout").inc()
+                raise TimeoutError(f"{self.name}: gave up waiting for the in-flight call")
+            if call.error is None:
+                return call.result
+            if _rerun(call.error):
+                return self.do(key, fn, *args, timeout=timeout, **kwargs)
+            raise _fresh(call.error) from call.error
+
+        CALLS.labels(flight=self.name, role="leader").inc()
+        IN_FLIGHT.labels(flight=self.name).inc()
+        try:
+            with resilience.service_deadline():
+                call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            IN_FLIGHT.labels(flight=self.name).dec()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"in_flight": len(self._calls), "waiting": sum(c.waiters for c in self._calls.values())}
+
+
+class AsyncSingleFlight:
+    """asyncio group: the call runs as its own task, so a cancelled caller doesn't cancel the others."""
+
+    def __init__(self, name: str, timeout: float = SINGLEFLIGHT_TIMEOUT_SECONDS):
+        self.name = name
+        self.timeout = timeout
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        IN_FLIGHT.labels(flight=self.name).dec()
+        if not task.cancelled():
+            task.exception()  # retrieved here so an error nobody waited for isn't logged as lost
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args,
+                 timeout: Optional[float] = None, **kwargs) -> Any:
+        task = self._tasks.get(key)
+        if task is None or task.done():  # a finished task whose callback hasn't run yet
+            CALLS.labels(flight=self.name, role="leader").inc()
+            IN_FLIGHT.labels(flight=self.name).inc()
+            # the task copies the context here, so it runs under the service deadline
+            with resilience.service_deadline():
+                task = self._tasks[key] = asyncio.ensure_future(fn(*args, **kwargs))
+            task.add_done_callback(lambda t, k=key: self._finished(k, t))
+        else:
+            CALLS.labels(flight=self.name, role="follower").inc()
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), _wait_seconds(self.timeout, timeout))
+        except asyncio.TimeoutError:
+            # DeadlineExceeded is a TimeoutError too: tell the call's own from this caller's
+            if not task.done():
+                CALLS.labels(flight=self.name, role="timeout").inc()
+                raise TimeoutError(f"{self.name}: gave up waiting for the in-flight call") from None
+            error = asyncio.CancelledError() if task.cancelled() else task.exception()
+            if error is None:
+                return task.result()
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise  # this caller was cancelled, not the call
+            error = asyncio.CancelledError()
+        except Exception as e:
+            error = e
+        if _rerun(error):
+            return await self.do(key, fn, *args, timeout=timeout, **kwargs)
+        raise _fresh(error) from error
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._tasks)}
@@ -0,0 +1,391 @@
+"""
+Live charger status fan-out (SSE / WebSocket) for the chat service.
+
+One poller per process reads (charger, station, status, lat, lon) rows and
+diffs them against the previous read; only changed chargers are published.
+With CHARGER_STATUS_CHANNEL set, the poller also LISTENs on that Postgres
+channel and re-reads as soon as a NOTIFY arrives (after a short coalescing
+window, so a burst of updates becomes one read). The diff stays the source of
+truth, so a lost notification only delays an update until the next poll.
+
+Subscribers filter by station ids and/or a bbox. Each subscriber keeps the
+latest pending status per charger rather than a queue of messages, so a slow
+client receives one merged delta instead of falling behind.
+
+    sub = HUB.subscribe(stations={"st-1"}, bbox=None)
+    await HUB.ready()
+    first = HUB.snapshot_message(sub)
+    msg = await HUB.next(sub, timeout=15)   # None on timeout (send a heartbeat)
+    HUB.unsubscribe(sub)
+"""
+import asyncio
+import os
+import re
+import select
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from services import metrics, tracing
+
+CHARGER_STATUS_POLL_SECONDS = float(os.getenv("CHARGER_STATUS_POLL_SECONDS", "2"))
+CHARGER_STATUS_COALESCE_MS = int(os.getenv("CHARGER_STATUS_COALESCE_MS", "250"))
+CHARGER_STATUS_CHANNEL = os.getenv("CHARGER_STATUS_CHANNEL", "")  # e.g. "charger_status"; empty = poll only
+CHARGER_STATUS_MAX_SUBSCRIBERS = int(os.getenv("CHARGER_STATUS_MAX_SUBSCRIBERS", "10000"))
+
+SUBSCRIBERS = metrics.gauge("ampora_charger_status_subscribers", "Open charger status streams.")
+CHANGES = metrics.counter("ampora_charger_status_changes_total", "Charger status changes published.")
+
+# (charger_id, station_id, status, lat, lon)
+Row = Tuple[str, str, Optional[str], Optional[float], Optional[float]]
+BBox = Tuple[float, float, float, float]  # west, south, east, north (same order as tile bboxes)
+
+
+def _available(status: Optional[str]) -> bool:
+    return (status or "").strip().lower() == "available"
+
+
+def parse_filter(stations: Optional[str], bbox: Optional[str]) -> Tuple[Optional[Set[str]], Optional[BBox]]:
+    """Query-string filters: stations=a,b,c and bbox=west,south,east,north. Raises ValueError."""
+    ids = {s.strip() for s in (stations or "").split(",") if s.strip()} or None
+    box = None
+    if bbox:
+        parts = [float(v) for v in bbox.split(",")]
+        if len(parts) != 4:
+            raise ValueError("bbox must be west,south,east,north")
+        west, south, east, north = parts
+        if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+            raise ValueError("bbox out of range")
+        box = (west, south, east, north)
+    return ids, box
+
+
+def _in_bbox(box: BBox, lat: Optional[float], lon: Optional[float]) -> bool:
+    if lat is None or lon is None:
+        return False
+    west, south, east, north = box
+    if not south <= lat <= north:
+        return False
+    # west > east means the box crosses the antimeridian
+    return west <= lon <= east if west <= east else (lon >= west or lon <= east)
+
+
+# -----------------------
+# Postgres source (poll + optional LISTEN)
+# -----------------------
+STATUS_SQL = """
+    SELECT c.charger_id, c.station_id, c.status, s.latitude, s.longitude
+    FROM charger c
+    JOIN station s ON s.station_id = c.station_id
+"""
+
+
+class PostgresChargerSource:
+    """
+    Holds one autocommit connection used for both the status query and
+    LISTEN; reconnects after errors. Only ever called from the hub's poller.
+    """
+
+    def __init__(self, connect: Callable[[], Any], channel: str = CHARGER_STATUS_CHANNEL):
+        if channel and not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]{0,62}", channel):
+            raise ValueError(f"invalid CHARGER_STATUS_CHANNEL: {channel!r}")
+        self._connect = connect
+        self.channel = channel
+        self._conn = None
+
+    @property
+    def listens(self) -> bool:
+        return bool(self.channel)
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+            self._conn.autocommit = True
+            if self.channel:
+                with self._conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+        return self._conn
+
+    def _reset(self):
+        try:
+            if self._conn is not None:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def fetch(self) -> List[Row]:
+        try:
+            conn = self._connection()
+            if self.channel:
+                # everything notified so far is covered by this read
+                conn.poll()
+                conn.notifies.clear()
+            with conn.cursor() as cur, tracing.db_span(STATUS_SQL):
+                cur.execute(STATUS_SQL)
+                rows = cur.fetchall()
+        except Exception:
+            self._reset()
+            raise
+        return [
+            (str(cid), str(sid), status, float(lat) if lat is not None else None,
+             float(lon) if lon is not None else None)
+            for cid, sid, status, lat, lon in rows
+        ]
+
+    def wait(self, timeout: float) -> bool:
+        """Block until a NOTIFY arrives (True) or `timeout` passes (False)."""
+        try:
+            conn = self._connection()
+            if not conn.notifies:
+                select.select([conn], [], [], timeout)
+                conn.poll()
+            notified = bool(conn.notifies)
+            conn.notifies.clear()
+            return notified
+        except Exception as e:
+            print(f"⚠️ Charger status LISTEN failed, falling back to polling: {e}")
+            self._reset()
+            time.sleep(timeout)
+            return False
+
+
+# -----------------------
+# Subscribers
+# -----------------------
+class Subscriber:
+    __slots__ = ("stations", "bbox", "pending", "seq", "event")
+
+    def __init__(self, stations: Optional[Set[str]], bbox: Optional[BBox]):
+        self.stations = stations
+        self.bbox = bbox
+        self.pending: Dict[str, Tuple[str, Optional[str]]] = {}  # charger_id -> (station_id, status)
+        self.seq = 0
+        self.event = asyncio.Event()
+
+    def push(self, seq: int, changes: Iterable[Tuple[str, str, Optional[str]]]):
+        for cid, sid, status in changes:
+            self.pending[cid] = (sid, status)  # newer status replaces an unsent one
+        self.seq = seq
+        self.event.set()
+
+
+class ChargerStatusHub:
+    def __init__(self, source_factory: Callable[[], Any], poll_seconds: float = CHARGER_STATUS_POLL_SECONDS,
+                 coalesce_ms: int = CHARGER_STATUS_COALESCE_MS,
+                 max_subscribers: int = CHARGER_STATUS_MAX_SUBSCRIBERS):
+        self._source_factory = source_factory
+        self.poll_seconds = poll_seconds
+        self.coalesce_seconds = coalesce_ms / 1000.0
+        self.max_subscribers = max_subscribers
+
+        self._chargers: Dict[str, Tuple[str, Optional[str]]] = {}  # charger_id -> (station_id, status)
+        self._stations: Dict[str, Dict[str, Optional[str]]] = {}   # station_id -> {charger_id: status}
+        self._coords: Dict[str, Tuple[Optional[float], Optional[float]]] = {}
+        self.seq = 0
+
+        # subscriber indexes: by station id, by bbox, and unfiltered
+        self._subs: Set[Subscriber] = set()
+        self._by_station: Dict[str, Set[Subscriber]] = {}
+        self._bbox_subs: Set[Subscriber] = set()
+        self._all_subs: Set[Subscriber] = set()
+
+        self._task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self.last_error: Optional[str] = None
+        self._stats = {"polls": 0, "notifies": 0, "changes": 0, "deliveries": 0, "rejected": 0}
+
+    # ---------- subscribe ----------
+    def subscribe(self, stations: Optional[Set[str]] = None, bbox: Optional[BBox] = None) -> Optional[Subscriber]:
+        """New subscriber (None when at max_subscribers); starts the poller on first use."""
+        if len(self._subs) >= self.max_subscribers:
+            self._stats["rejected"] += 1
+            return None
+        sub = Subscriber(stations, bbox)
+        self._index(sub)
+        SUBSCRIBERS.labels().set(len(self._subs))
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return sub
+
+    def update_filter(self, sub: Subscriber, stations: Optional[Set[str]], bbox: Optional[BBox]):
+        self._unindex(sub)
+        sub.stations, sub.bbox = stations, bbox
+        sub.pending = {}
+        self._index(sub)
+
+    def unsubscribe(self, sub: Subscriber):
+        self._unindex(sub)
+        SUBSCRIBERS.labels().set(len(self._subs))
+
+    def _index(self, sub: Subscriber):
+        self._subs.add(sub)
+        if sub.stations is None and sub.bbox is None:
+            self._all_subs.add(sub)
+        for sid in sub.stations or ():
+            self._by_station.setdefault(sid, set()).add(sub)
+        if sub.bbox is not None:
+            self._bbox_subs.add(sub)
+
+    def _unindex(self, sub: Subscriber):
+        self._subs.discard(sub)
+        self._all_subs.discard(sub)
+        self._bbox_subs.discard(sub)
+        for sid in sub.stations or ():
+            subs = self._by_station.get(sid)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_station[sid]
+
+    async def ready(self, timeout: float = 10.0) -> bool:
+        """Wait for the poller's first read (so snapshots aren't empty)."""
+        if self._ready is None:
+            return False
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # ---------- messages ----------
+    def _station_counts(self, station_ids: Iterable[str]) -> Dict[str, List[int]]:
+        counts = {}
+        for sid in station_ids:
+            chargers = self._stations.get(sid, {})
+            counts[sid] = [sum(1 for st in chargers.values() if _available(st)), len(chargers)]
+        return counts
+
+    def _matches(self, sub: Subscriber, sid: str) -> bool:
+        if sub.stations is None and sub.bbox is None:
+            return True
+        if sub.stations is not None and sid in sub.stations:
+            return True
+        return sub.bbox is not None and _in_bbox(sub.bbox, *self._coords.get(sid, (None, None)))
+
+    def snapshot_message(self, sub: Subscriber) -> Dict[str, Any]:
+        """Full state for the subscriber's filter; sent on connect and after a filter change."""
+        if sub.stations is not None and sub.bbox is None:
+            station_ids = [sid for sid in sub.stations if sid in self._stations]
+        else:
+            station_ids = [sid for sid in self._stations if self._matches(sub, sid)]
+        return {
+            "type": "snapshot",
+            "seq": self.seq,
+            "chargers": [[cid, sid, st] for sid in station_ids for cid, st in self._stations[sid].items()],
+            "stations": self._station_counts(station_ids),
+        }
+
+    def delta_message(self, seq: int, pending: Dict[str, Tuple[str, Optional[str]]]) -> Dict[str, Any]:
+        """
+        {"type": "delta", "seq": n, "chargers": [[charger_id, station_id, status], ...],
+         "stations": {station_id: [available, total]}}; status null = charger removed.
+        """
+        self._stats["deliveries"] += 1
+        return {
+            "type": "delta",
+            "seq": seq,
+            "chargers": [[cid, sid, st] for cid, (sid, st) in pending.items()],
+            "stations": self._station_counts({sid for sid, _ in pending.values()}),
+        }
+
+    async def next(self, sub: Subscriber, timeout: float) -> Optional[Dict[str, Any]]:
+        """Next merged delta for `sub`, or None if nothing changed within `timeout`."""
+        if not sub.pending:
+            sub.event.clear()
+            try:
+                await asyncio.wait_for(sub.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        pending, sub.pending = sub.pending, {}
+        sub.event.clear()
+        return self.delta_message(sub.seq, pending) if pending else None
+
+    # ---------- poller ----------
+    def _apply(self, rows: List[Row]) -> Dict[str, List[Tuple[str, str, Optional[str]]]]:
+        """Replace the state with `rows`; returns changes grouped by station id."""
+        changes: Dict[str, List[Tuple[str, str, Optional[str]]]] = {}
+        seen = set()
+        for cid, sid, status, lat, lon in rows:
+            seen.add(cid)
+            self._coords[sid] = (lat, lon)
+            old = self._chargers.get(cid)
+            if old == (sid, status):
+                continue
+            if old is not None and old[0] != sid:
+                # moved to another station: removed there, added here
+                self._stations.get(old[0], {}).pop(cid, None)
+                changes.setdefault(old[0], []).append((cid, old[0], None))
+            self._chargers[cid] = (sid, status)
+            self._stations.setdefault(sid, {})[cid] = status
+            changes.setdefault(sid, []).append((cid, sid, status))
+        for cid in [c for c in self._chargers if c not in seen]:
+            sid, _ = self._chargers.pop(cid)
+            self._stations.get(sid, {}).pop(cid, None)
+            changes.setdefault(sid, []).append((cid, sid, None))
+        for sid in [s for s, chargers in self._stations.items() if not chargers]:
+            del self._stations[sid]
+            self._coords.pop(sid, None)
+        return changes
+
+    def _publish(self, changes: Dict[str, List[Tuple[str, str, Optional[str]]]]):
+        self.seq += 1
+        n = sum(len(c) for c in changes.values())
+        self._stats["changes"] += n
+        CHANGES.inc(n)
+        for sid, items in changes.items():
+            targets = set(self._all_subs)
+            targets.update(self._by_station.get(sid, ()))
+            if self._bbox_subs:
+                lat, lon = self._coords.get(sid, (None, None))
+                targets.update(s for s in self._bbox_subs if _in_bbox(s.bbox, lat, lon))
+            for sub in targets:
+                sub.push(self.seq, items)
+
+    async def _run(self):
+        source = self._source_factory()
+        first = True
+        try:
+            while self._subs:
+                try:
+                    with metrics.stage("charger_status_poll"):
+                        rows = await asyncio.to_thread(source.fetch)
+                    self._stats["polls"] += 1
+                    changes = self._apply(rows)
+                    self.last_error = None
+                    if first:
+                        first = False
+                        self._ready.set()  # the first read is the baseline, not a change
+                    elif changes:
+                        self._publish(changes)
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"⚠️ Charger status poll failed: {e}")
+
+                if getattr(source, "listens", False):
+                    notified = await asyncio.to_thread(source.wait, self.poll_seconds)
+                    if notified:
+                        self._stats["notifies"] += 1
+                        # let the rest of a burst land so it is read (and sent) once
+                        await asyncio.sleep(self.coalesce_seconds)
+                else:
+                    await asyncio.sleep(self.poll_seconds)
+        finally:
+            # nobody is listening: drop the state, the next subscriber starts from a fresh read
+            self._chargers, self._stations, self._coords = {}, {}, {}
+            reset = getattr(source, "_reset", None)
+            if reset:
+                reset()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "subscribers": len(self._subs),
+            "chargers": len(self._chargers),
+            "stations": len(self._stations),
+            "seq": self.seq,
+            "running": self._task is not None and not self._task.done(),
+            "listen_channel": CHARGER_STATUS_CHANNEL or None,
+            "poll_seconds": self.poll_seconds,
+            "last_error": self.last_error,
+        }
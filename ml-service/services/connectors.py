@@ -0,0 +1,184 @@
+"""
+Connector / power capabilities of stations, as bitmasks and numpy columns.
+
+Every station in the snapshot carries a `connector_mask` (one bit per
+connector type), the max power per connector type and its available-charger
+count. StationArrays turns a station list into columns once per snapshot so a
+StationFilter ("CCS2 or CHAdeMO, at least 50 kW, something free") is a few
+vectorized comparisons over all stations, done before any distance work.
+
+    f = StationFilter.from_params(connectors=["CCS2"], min_power_kw=50)
+    candidates = snapshot.filtered(f)
+"""
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# bit i of connector_mask = CONNECTOR_TYPES[i]; append only, the order is the encoding
+CONNECTOR_TYPES = ("type1", "type2", "ccs1", "ccs2", "chademo", "gbt", "nacs")
+_BIT = {name: 1 << i for i, name in enumerate(CONNECTOR_TYPES)}
+
+# spellings seen in Charger.type and from clients, after lowercasing and dropping non-alphanumerics
+_ALIASES = {
+    "j1772": "type1", "sae": "type1", "type1": "type1",
+    "type2": "type2", "mennekes": "type2", "iec62196": "type2",
+    "ccs1": "ccs1", "combo1": "ccs1",
+    "ccs": "ccs2", "ccs2": "ccs2", "combo2": "ccs2",
+    "chademo": "chademo",
+    "gbt": "gbt", "gb": "gbt",
+    "nacs": "nacs", "tesla": "nacs", "supercharger": "nacs",
+}
+
+
+def normalize(connector: Optional[str]) -> Optional[str]:
+    """Canonical connector name ("CCS 2" -> "ccs2"), or None if unknown."""
+    key = re.sub(r"[^a-z0-9]", "", (connector or "").lower())
+    return _ALIASES.get(key)
+
+
+def mask_of(connectors: Iterable[str]) -> int:
+    mask = 0
+    for c in connectors:
+        name = normalize(c)
+        if name:
+            mask |= _BIT[name]
+    return mask
+
+
+def names_of(mask: int) -> List[str]:
+    return [name for name in CONNECTOR_TYPES if mask & _BIT[name]]
+
+
+def _available(status: Optional[str]) -> bool:
+    return (status or "").strip().lower() == "available"
+
+
+def summarize(chargers: Iterable[Tuple[Optional[str], Optional[float], Optional[str]]]) -> Dict[str, Any]:
+    """
+    Per-station aggregates from (type, power_kw, status) charger rows:
+    connector_mask, connectors, power_by_connector, max_power_kw,
+    charger_count, available_count and available_power_by_connector (max
+    power of the free chargers per connector type; types with none free are
+    left out).
+    """
+    mask, count, available, max_power = 0, 0, 0, 0.0
+    power_by: Dict[str, float] = {}
+    available_by: Dict[str, float] = {}
+    for ctype, power, status in chargers:
+        count += 1
+        power = float(power or 0.0)
+        max_power = max(max_power, power)
+        free = _available(status)
+        if free:
+            available += 1
+        name = normalize(ctype)
+        if name:
+            mask |= _BIT[name]
+            power_by[name] = max(power_by.get(name, 0.0), power)
+            if free:
+                available_by[name] = max(available_by.get(name, 0.0), power)
+    return {
+        "connector_mask": mask,
+        "connectors": names_of(mask),
+        "power_by_connector": power_by,
+        "max_power_kw": max_power,
+        "charger_count": count,
+        "available_count": available,
+        "available_power_by_connector": available_by,
+    }
+
+
+class StationArrays:
+    """Column view of a station list (index i = stations[i])."""
+
+    __slots__ = ("lat", "lon", "mask", "power", "max_power", "available", "available_power", "charger_count")
+
+    def __init__(self, stations: Sequence[Dict[str, Any]]):
+        n = len(stations)
+        self.lat = np.fromiter((s["lat"] for s in stations), dtype=np.float64, count=n)
+        self.lon = np.fromiter((s["lon"] for s in stations), dtype=np.float64, count=n)
+        self.mask = np.fromiter((s.get("connector_mask", 0) for s in stations), dtype=np.uint32, count=n)
+        self.max_power = np.fromiter((s.get("max_power_kw", 0.0) for s in stations), dtype=np.float32, count=n)
+        self.available = np.fromiter((s.get("available_count", 0) for s in stations), dtype=np.int32, count=n)
+        self.charger_count = np.fromiter((s.get("charger_count", 0) for s in stations), dtype=np.int32, count=n)
+        # max power per connector type; column j = CONNECTOR_TYPES[j]
+        self.power = np.zeros((n, len(CONNECTOR_TYPES)), dtype=np.float32)
+        # max power of the free chargers per connector type; -1 = none free
+        self.available_power = np.full((n, len(CONNECTOR_TYPES)), -1.0, dtype=np.float32)
+        for i, s in enumerate(stations):
+            for name, kw in (s.get("power_by_connector") or {}).items():
+                if name in _BIT:
+                    self.power[i, CONNECTOR_TYPES.index(name)] = kw
+            for name, kw in (s.get("available_power_by_connector") or {}).items():
+                if name in _BIT:
+                    self.available_power[i, CONNECTOR_TYPES.index(name)] = kw
+
+    @classmethod
+    def from_columns(cls, lat: np.ndarray, lon: np.ndarray, mask: np.ndarray, power: np.ndarray,
+                     max_power: np.ndarray, available: np.ndarray, available_power: np.ndarray,
+                     charger_count: np.ndarray) -> "StationArrays":
+        """Wrap existing columns (e.g. read-only views of a shared generation) without copying."""
+        arrays = cls.__new__(cls)
+        arrays.lat, arrays.lon, arrays.mask = lat, lon, mask
+        arrays.power, arrays.max_power, arrays.available = power, max_power, available
+        arrays.available_power, arrays.charger_count = available_power, charger_count
+        return arrays
+
+
+class StationFilter:
+    __slots__ = ("connector_mask", "min_power_kw", "available_only")
+
+    def __init__(self, connector_mask: int = 0, min_power_kw: float = 0.0, available_only: bool = False):
+        self.connector_mask = connector_mask
+        self.min_power_kw = float(min_power_kw or 0.0)
+        self.available_only = bool(available_only)
+
+    @classmethod
+    def from_params(cls, connectors: Union[None, str, Iterable[str]] = None, min_power_kw: Optional[float] = None,
+                    available_only: bool = False) -> "StationFilter":
+        """Build from request params; raises ValueError for a connector type it doesn't know."""
+        if isinstance(connectors, str):
+            connectors = connectors.split(",")
+        names = [c for c in (connectors or []) if c and c.strip()]
+        unknown = [c for c in names if normalize(c) is None]
+        if unknown:
+            raise ValueError(f"unknown connector type(s): {', '.join(unknown)}; known: {', '.join(CONNECTOR_TYPES)}")
+        if min_power_kw is not None and float(min_power_kw) < 0:
+            raise ValueError("min_power_kw must be >= 0")
+        return cls(mask_of(names), min_power_kw or 0.0, available_only)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.connector_mask or self.min_power_kw > 0 or self.available_only)
+
+    def key(self) -> str:
+        """Stable text form for cache keys / fingerprints."""
+        return f"{self.connector_mask}:{self.min_power_kw:g}:{int(self.available_only)}"
+
+    def mask(self, arrays: StationArrays) -> np.ndarray:
+        """Boolean row mask of the stations that pass."""
+        keep = np.ones(len(arrays.lat), dtype=bool)
+        if self.connector_mask:
+            keep &= (arrays.mask & np.uint32(self.connector_mask)) != 0
+            # power (and a free charger) has to come from one of the requested connectors, not just any charger
+            cols = [i for i, name in enumerate(CONNECTOR_TYPES) if self.connector_mask & _BIT[name]]
+            if self.available_only:
+                keep &= arrays.available_power[:, cols].max(axis=1) >= self.min_power_kw
+            elif self.min_power_kw > 0:
+                keep &= arrays.power[:, cols].max(axis=1) >= self.min_power_kw
+        elif self.available_only and self.min_power_kw > 0:
+            # any connector, but the free charger itself has to be fast enough
+            keep &= arrays.available_power.max(axis=1) >= self.min_power_kw
+        elif self.available_only:
+            # any free charger, including ones of a type normalize() doesn't know
+            keep &= arrays.available > 0
+        elif self.min_power_kw > 0:
+            keep &= arrays.max_power >= self.min_power_kw
+        return keep
+
+    def apply(self, stations: List[Dict[str, Any]], arrays: Optional[StationArrays] = None) -> List[Dict[str, Any]]:
+        if not self.active:
+            return stations
+        keep = self.mask(arrays if arrays is not None else StationArrays(stations))
+        return [stations[i] for i in np.flatnonzero(keep)]
@@ -0,0 +1,255 @@
+"""
+Precomputed routes and corridor stations for popular city pairs.
+
+Most /api/route traffic runs between a handful of towns. build_corridors.py
+(offline) routes every ordered pair of CORRIDOR_CITIES through OSRM, matches
+the corridor stations along the fastest route and writes one compressed .npz
+artifact: paths as int32 1e-5 degree coordinates, OSRM segment durations as
+float32 and a JSON index. The route service loads it at start
+(CORRIDOR_FILE); a request without stops whose start and end both lie within
+CORRIDOR_SNAP_KM of two of the cities is answered from it, with no OSRM call
+and no station matching.
+
+Corridor station lists are (station id, distance) pairs for the station
+coordinates they were built against (Snapshot.coords_key); the station
+records themselves (status, chargers) always come from the live snapshot. If
+stations were added or moved since the build, a pair is rematched once
+against its stored path and the result kept in memory.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from services import metrics
+from services.cache import SingleFlight
+from services.connectors import StationFilter
+from services.nearest import haversine_km
+from services.stations import Snapshot
+
+CORRIDOR_FILE = os.getenv("CORRIDOR_FILE", "corridors.npz")
+CORRIDOR_SNAP_KM = float(os.getenv("CORRIDOR_SNAP_KM", "1.0"))
+FORMAT = 1
+
+# towns from model/dataset.py and the load-test mix
+CORRIDOR_CITIES: Dict[str, Tuple[float, float]] = {
+    "Colombo": (6.9271, 79.8612),
+    "Kandy": (7.2906, 80.6337),
+    "Galle": (6.0535, 80.2210),
+    "Negombo": (7.2083, 79.8358),
+    "Katunayake": (7.1697, 79.8883),
+    "Matara": (5.9549, 80.5550),
+    "Kurunegala": (7.4863, 80.3647),
+    "Anuradhapura": (8.3114, 80.4037),
+    "Jaffna": (9.6615, 80.0255),
+    "Nuwara Eliya": (6.9497, 80.7891),
+    "Trincomalee": (8.5874, 81.2152),
+}
+
+Point = Tuple[float, float]
+RouteFn = Callable[[Point, Point], List[Dict[str, Any]]]
+# EnhancedEVPlanner.stations_near_route(path, snapshot)
+MatchFn = Callable[[List[Point], Snapshot], List[Dict[str, Any]]]
+
+
+# -----------------------
+# Offline build
+# -----------------------
+def build(cities: Dict[str, Point], route_fn: RouteFn, snapshot: Snapshot, match_fn: MatchFn,
+          out_path: str = CORRIDOR_FILE) -> Dict[str, Any]:
+    """Route and match every ordered city pair and write the artifact; returns its index."""
+    meta: Dict[str, Any] = {
+        "format": FORMAT,
+        "built_at": time.time(),
+        "coords_key": snapshot.coords_key,
+        "cities": {name: list(p) for name, p in cities.items()},
+        "pairs": [],
+    }
+    paths, seconds, offset = [], [], 0
+    for a, pa in cities.items():
+        for b, pb in cities.items():
+            if a == b:
+                continue
+            routes = route_fn(pa, pb)
+            if not routes:
+                print(f"⚠️ No route {a} -> {b}, skipped")
+                continue
+            entry = {"from": a, "to": b, "routes": []}
+            for r in routes:
+                pts = np.round(np.asarray(r["path"], dtype=float) * 1e5).astype(np.int32)
+                # one duration per vertex (the last is padding) so paths and seconds share offsets
+                secs = np.zeros(len(pts), dtype=np.float32)
+                if r.get("segment_seconds") is not None:
+                    secs[:-1] = r["segment_seconds"]
+                entry["routes"].append({
+                    "distance_km": r["distance_km"],
+                    "duration_min": r["duration_min"],
+                    "offset": offset,
+                    "length": len(pts),
+                    "has_seconds": r.get("segment_seconds") is not None,
+                })
+                paths.append(pts)
+                seconds.append(secs)
+                offset += len(pts)
+            near = match_fn(routes[0]["path"], snapshot)
+            entry["stations"] = [[s["station_id"], s["distance_to_route_km"]] for s in near]
+            meta["pairs"].append(entry)
+            print(f"{a} -> {b}: {len(routes)} routes, {len(near)} stations")
+
+    tmp = f"{out_path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(
+            f,
+            meta=np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+            path=np.concatenate(paths) if paths else np.zeros((0, 2), dtype=np.int32),
+            seconds=np.concatenate(seconds) if seconds else np.zeros(0, dtype=np.float32),
+        )
+    os.replace(tmp, out_path)
+    return meta
+
+
+# -----------------------
+# Serving
+# -----------------------
+class Corridor:
+    __slots__ = ("origin", "destination", "routes", "stations")
+
+    def __init__(self, entry: Dict[str, Any]):
+        self.origin = entry["from"]
+        self.destination = entry["to"]
+        self.routes = entry["routes"]
+        self.stations = entry["stations"]
+
+    @property
+    def name(self) -> str:
+        return f"{self.origin}-{self.destination}"
+
+
+class CorridorCache:
+    def __init__(self, path: str = CORRIDOR_FILE, snap_km: float = CORRIDOR_SNAP_KM):
+        self.path = path
+        self.snap_km = snap_km
+        self.meta: Dict[str, Any] = {}
+        self._pairs: Dict[Tuple[str, str], Corridor] = {}
+        self._names: List[str] = []
+        self._lats = self._lons = np.zeros(0)
+        self._path = np.zeros((0, 2), dtype=np.int32)
+        self._seconds = np.zeros(0, dtype=np.float32)
+        # (pair, coords_key) -> station list rematched after the stations moved
+        self._rematched: Dict[Tuple[str, str], List[List[Any]]] = {}
+        self._by_id: Tuple[Optional[str], Dict[str, int]] = (None, {})
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "rematches": 0}
+        self._rematch_flights = SingleFlight("corridor_rematch")
+        metrics.register_hit_ratio("corridor", self._hit_ratio)
+
+    def _hit_ratio(self) -> float:
+        total = self._stats["hits"] + self._stats["misses"]
+        return self._stats["hits"] / total if total else 0.0
+
+    def load(self) -> "CorridorCache":
+        """Read the artifact; a missing or unreadable file leaves the cache empty."""
+        if not os.path.exists(self.path):
+            print(f"⚠️ No corridor artifact at {self.path}; run build_corridors.py to precompute popular routes")
+            return self
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+                path, seconds = data["path"], data["seconds"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"❌ Could not read corridor artifact {self.path}: {e}")
+            return self
+        if meta.get("format") != FORMAT:
+            print(f"⚠️ Corridor artifact {self.path} has format {meta.get('format')}, expected {FORMAT}; ignored")
+            return self
+        self.meta = meta
+        self._path, self._seconds = path, seconds
+        self._names = list(meta["cities"])
+        self._lats = np.array([meta["cities"][n][0] for n in self._names])
+        self._lons = np.array([meta["cities"][n][1] for n in self._names])
+        self._pairs = {(e["from"], e["to"]): Corridor(e) for e in meta["pairs"]}
+        return self
+
+    def _city_at(self, lat: float, lon: float) -> Optional[str]:
+        if not self._names:
+            return None
+        dist = haversine_km(lat, lon, self._lats, self._lons)
+        i = int(np.argmin(dist))
+        return self._names[i] if dist[i] <= self.snap_km else None
+
+    def lookup(self, start: Point, end: Point) -> Optional[Corridor]:
+        """The precomputed corridor when both ends snap to cities, else None."""
+        if not self._pairs:
+            return None
+        a, b = self._city_at(*start), self._city_at(*end)
+        corridor = self._pairs.get((a, b)) if a and b else None
+        self._stats["hits" if corridor is not None else "misses"] += 1
+        metrics.cache_lookup("corridor", hit=corridor is not None)
+        return corridor
+
+    def routes(self, corridor: Corridor) -> List[Dict[str, Any]]:
+        """Route dicts shaped like EnhancedEVPlanner.get_routes_from_osrm() output."""
+        out = []
+        for r in corridor.routes:
+            lo, hi = r["offset"], r["offset"] + r["length"]
+            out.append({
+                "distance_km": r["distance_km"],
+                "duration_min": r["duration_min"],
+                "path": (self._path[lo:hi] / 1e5).tolist(),
+                "segment_seconds": self._seconds[lo:hi - 1] if r["has_seconds"] else None,
+            })
+        return out
+
+    def _index_by_id(self, snapshot: Snapshot) -> Dict[str, int]:
+        version, by_id = self._by_id
+        if version != snapshot.version:
+            by_id = dict(zip(snapshot.ids.tolist(), range(len(snapshot.ids))))
+            self._by_id = (snapshot.version, by_id)
+        return by_id
+
+    def stations(self, corridor: Corridor, snapshot: Snapshot, station_filter: Optional[StationFilter],
+                 match_fn: MatchFn) -> List[Dict[str, Any]]:
+        """Corridor stations from the live snapshot, nearest to the route first, passing the filter."""
+        matched = corridor.stations
+        if snapshot.coords_key != self.meta.get("coords_key"):
+            key = (corridor.name, snapshot.coords_key)
+            with self._lock:
+                matched = self._rematched.get(key)
+            if matched is None:
+                # concurrent requests for the pair wait for one rematch
+                matched = self._rematch_flights.do(key, self._rematch, corridor, snapshot, match_fn)
+
+        by_id = self._index_by_id(snapshot)
+        keep = snapshot.mask(station_filter) if station_filter is not None and station_filter.active else None
+        out = []
+        for station_id, dist in matched:
+            i = by_id.get(station_id)
+            if i is None or (keep is not None and not keep[i]):
+                continue
+            s = dict(snapshot.stations[i])
+            s["distance_to_route_km"] = dist
+            out.append(s)
+        return out
+
+    def _rematch(self, corridor: Corridor, snapshot: Snapshot, match_fn: MatchFn) -> List[List[Any]]:
+        near = match_fn(self.routes(corridor)[0]["path"], snapshot)
+        matched = [[s["station_id"], s["distance_to_route_km"]] for s in near]
+        with self._lock:
+            # rematches for older coordinates are dead weight
+            self._rematched = {k: v for k, v in self._rematched.items() if k[1] == snapshot.coords_key}
+            self._rematched[(corridor.name, snapshot.coords_key)] = matched
+            self._stats["rematches"] += 1
+        return matched
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "file": self.path,
+            "built_at": self.meta.get("built_at"),
+            "cities": len(self._names),
+            "pairs": len(self._pairs),
+            "rematched_pairs": len(self._rematched),
+        }
@@ -0,0 +1,93 @@
+"""
+Response encoding for large JSON payloads (/api/route).
+
+- orjson when installed (falls back to json),
+- MessagePack when the client sends `Accept: application/msgpack` and msgpack is installed,
+- brotli (if installed) or gzip for bodies above COMPRESS_MIN_BYTES, per Accept-Encoding,
+- round_path() trims coordinates to ROUTE_COORD_PRECISION decimals (5 = ~1 m).
+"""
+import gzip
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+from services import metrics
+
+ROUTE_COORD_PRECISION = int(os.getenv("ROUTE_COORD_PRECISION", "5"))
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+def round_path(path: Sequence[Sequence[float]], precision: int = ROUTE_COORD_PRECISION) -> List[List[float]]:
+    return [[round(lat, precision), round(lon, precision)] for lat, lon in path]
+
+
+def _accepts(header: Optional[str], token: str) -> bool:
+    """True if `token` is listed in an Accept/Accept-Encoding header with q > 0."""
+    for part in (header or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip() == token:
+            q = params.strip()
+            try:
+                return not (q.startswith("q=") and float(q[2:] or 0) == 0)
+            except ValueError:
+                return True
+    return False
+
+
+def _default(obj: Any) -> Any:
+    """numpy scalars/arrays (snapshot columns, distances) as plain numbers; anything else is a bug."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps_json(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def encode(payload: Any, accept: Optional[str] = None, accept_encoding: Optional[str] = None,
+           min_compress_bytes: int = COMPRESS_MIN_BYTES) -> Tuple[bytes, Dict[str, str]]:
+    """Serialize + compress `payload` for the client's Accept headers; returns (body, headers)."""
+    with metrics.stage("serialize"):
+        if msgpack is not None and any(_accepts(accept, t) for t in MSGPACK_TYPES):
+            body = msgpack.packb(payload, use_bin_type=True, default=_default)
+            content_type = "application/msgpack"
+        else:
+            body = dumps_json(payload)
+            content_type = "application/json"
+
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+    if len(body) >= min_compress_bytes:
+        with metrics.stage("compress"):
+            if brotli is not None and _accepts(accept_encoding, "br"):
+                body = brotli.compress(body, quality=BROTLI_QUALITY)
+                headers["Content-Encoding"] = "br"
+            elif _accepts(accept_encoding, "gzip"):
+                body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+                headers["Content-Encoding"] = "gzip"
+    return body, headers
@@ -0,0 +1,221 @@
+"""
+Elevation-aware energy use along a route.
+
+Elevations come from SRTM .hgt tiles in DEM_DIR (e.g. N07E080.hgt, 1 or 3
+arc-second), opened as read-only numpy memmaps so only the pages a route
+touches are read, and bilinearly interpolated at every path vertex. Energy
+per segment is computed vectorized from rolling resistance, aero drag at the
+segment speed, grade and auxiliary load; downhill/braking energy is partly
+recovered at REGEN_EFFICIENCY. Without tiles (or where a tile is missing) the
+route is treated as flat, which is what the old flat kWh/km figure assumed.
+
+    profile = route_energy(path, duration_min=95, segment_seconds=None, vehicle=Vehicle())
+    profile["kwh"], profile["cumulative_kwh"]
+"""
+import math
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services import metrics
+
+DEM_DIR = os.getenv("DEM_DIR", "dem")
+G = 9.81
+AIR_DENSITY = 1.2
+EARTH_RADIUS_M = 6371008.8
+HGT_VOID = -32768
+# a few metres of DEM noise per vertex would otherwise add up to phantom climbing
+MIN_SEGMENT_M = 1.0
+MAX_GRADE = 0.3
+
+
+class Vehicle:
+    """Physical parameters of the car (defaults: a mid-size EV with a 40 kWh pack)."""
+
+    __slots__ = ("mass_kg", "cda", "crr", "drivetrain_efficiency", "regen_efficiency", "aux_kw", "battery_kwh")
+
+    def __init__(self, mass_kg: float = 1700.0, cda: float = 0.65, crr: float = 0.011,
+                 drivetrain_efficiency: float = 0.90, regen_efficiency: float = 0.60, aux_kw: float = 0.8,
+                 battery_kwh: float = 40.0):
+        self.mass_kg = mass_kg
+        self.cda = cda
+        self.crr = crr
+        self.drivetrain_efficiency = drivetrain_efficiency
+        self.regen_efficiency = regen_efficiency
+        self.aux_kw = aux_kw
+        self.battery_kwh = battery_kwh
+
+    @classmethod
+    def from_params(cls, params: Optional[Dict[str, Any]]) -> "Vehicle":
+        """From a request body dict; unknown keys are ignored, bad values raise ValueError."""
+        v = cls()
+        for name in cls.__slots__:
+            if params and params.get(name) is not None:
+                value = float(params[name])
+                if value <= 0 or (name.endswith("efficiency") and value > 1):
+                    raise ValueError(f"{name} out of range")
+                setattr(v, name, value)
+        return v
+
+
+# -----------------------
+# DEM (SRTM .hgt tiles, memory-mapped)
+# -----------------------
+def _tile_name(lat_floor: int, lon_floor: int) -> str:
+    ns = "N" if lat_floor >= 0 else "S"
+    ew = "E" if lon_floor >= 0 else "W"
+    return f"{ns}{abs(lat_floor):02d}{ew}{abs(lon_floor):03d}.hgt"
+
+
+class DEM:
+    def __init__(self, directory: str = DEM_DIR):
+        self.directory = directory
+        self._tiles: Dict[Tuple[int, int], Optional[np.memmap]] = {}
+        self._lock = threading.Lock()
+
+    def _tile(self, lat_floor: int, lon_floor: int) -> Optional[np.memmap]:
+        key = (lat_floor, lon_floor)
+        if key in self._tiles:
+            return self._tiles[key]
+        with self._lock:
+            if key not in self._tiles:
+                path = os.path.join(self.directory, _tile_name(lat_floor, lon_floor))
+                tile = None
+                if os.path.exists(path):
+                    side = int(math.isqrt(os.path.getsize(path) // 2))
+                    # .hgt is big-endian int16, rows north to south, with one overlapping edge row/col
+                    tile = np.memmap(path, dtype=">i2", mode="r", shape=(side, side))
+                self._tiles[key] = tile
+            return self._tiles[key]
+
+    def available(self) -> List[str]:
+        try:
+            return sorted(f for f in os.listdir(self.directory) if re.fullmatch(r"[NS]\d\d[EW]\d{3}\.hgt", f))
+        except FileNotFoundError:
+            return []
+
+    def sample(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Elevation in metres at each point (bilinear); NaN where there is no data."""
+        out = np.full(len(lats), np.nan)
+        lat_f = np.floor(lats).astype(int)
+        lon_f = np.floor(lons).astype(int)
+        for la, lo in set(zip(lat_f.tolist(), lon_f.tolist())):
+            tile = self._tile(la, lo)
+            if tile is None:
+                continue
+            sel = np.flatnonzero((lat_f == la) & (lon_f == lo))
+            n = tile.shape[0] - 1
+            # fractional row/col inside the tile (row 0 = north edge)
+            r = (la + 1 - lats[sel]) * n
+            c = (lons[sel] - lo) * n
+            r0 = np.clip(np.floor(r).astype(int), 0, n - 1)
+            c0 = np.clip(np.floor(c).astype(int), 0, n - 1)
+            fr, fc = r - r0, c - c0
+            q = np.stack([tile[r0, c0], tile[r0, c0 + 1], tile[r0 + 1, c0], tile[r0 + 1, c0 + 1]]).astype(float)
+            q[q == HGT_VOID] = np.nan
+            out[sel] = (q[0] * (1 - fr) * (1 - fc) + q[1] * (1 - fr) * fc
+                        + q[2] * fr * (1 - fc) + q[3] * fr * fc)
+        return out
+
+
+def _fill_gaps(elev: np.ndarray) -> np.ndarray:
+    """Linear interpolation over NaNs (voids, missing tiles); all-NaN becomes flat."""
+    ok = ~np.isnan(elev)
+    if ok.all():
+        return elev
+    if not ok.any():
+        return np.zeros_like(elev)
+    idx = np.arange(len(elev))
+    return np.interp(idx, idx[ok], elev[ok])
+
+
+def _segment_lengths_m(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    la, lo = np.radians(lats), np.radians(lons)
+    h = np.sin(np.diff(la) / 2) ** 2 + np.cos(la[:-1]) * np.cos(la[1:]) * np.sin(np.diff(lo) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+DEM_TILES = DEM()
+
+
+# -----------------------
+# Energy model
+# -----------------------
+def route_energy(path: Sequence[Tuple[float, float]], duration_min: float,
+                 segment_seconds: Optional[Sequence[float]] = None, vehicle: Optional[Vehicle] = None,
+                 dem: Optional[DEM] = None) -> Dict[str, Any]:
+    """
+    Energy along `path` [(lat, lon), ...]. Segment speeds come from
+    `segment_seconds` (OSRM duration annotation, one per segment) when it lines up
+    with the path, otherwise from the route's average speed. Returns totals and
+    numpy arrays per vertex: elevation_m, cumulative_kwh (both len(path)).
+    """
+    vehicle = vehicle or Vehicle()
+    dem = dem or DEM_TILES
+    pts = np.asarray(path, dtype=float)
+    if len(pts) < 2:
+        zeros = np.zeros(len(pts))
+        return {"kwh": 0.0, "kwh_per_km": 0.0, "climb_m": 0.0, "descent_m": 0.0, "regen_kwh": 0.0,
+                "elevation_m": zeros, "cumulative_kwh": zeros, "dem": False}
+    lats, lons = pts[:, 0], pts[:, 1]
+
+    with metrics.stage("elevation_sample"):
+        raw = dem.sample(lats, lons)
+    has_dem = bool((~np.isnan(raw)).any())
+    elev = _fill_gaps(raw)
+
+    with metrics.stage("energy_model"):
+        d = np.maximum(_segment_lengths_m(lats, lons), MIN_SEGMENT_M)
+        dh = np.diff(elev)
+        # clamp DEM spikes (bridges, cuttings) to a plausible road grade
+        dh = np.clip(dh, -MAX_GRADE * d, MAX_GRADE * d)
+
+        total_m = float(d.sum())
+        if segment_seconds is not None and len(segment_seconds) == len(d):
+            t = np.maximum(np.asarray(segment_seconds, dtype=float), 0.1)
+        else:
+            avg = total_m / max(duration_min * 60.0, 1.0)
+            t = d / max(avg, 1.0)
+        v = np.minimum(d / t, 45.0)  # m/s; clip annotation noise on tiny segments
+
+        m = vehicle.mass_kg
+        wheel_j = (vehicle.crr * m * G * d                       # rolling
+                   + 0.5 * AIR_DENSITY * vehicle.cda * v ** 2 * d  # aero at segment speed
+                   + m * G * dh)                                   # grade
+        battery_j = np.where(wheel_j > 0, wheel_j / vehicle.drivetrain_efficiency,
+                             wheel_j * vehicle.regen_efficiency)
+        battery_j += vehicle.aux_kw * 1000.0 * t
+        kwh = battery_j / 3.6e6
+        cumulative = np.concatenate(([0.0], np.cumsum(kwh)))
+
+    total = float(cumulative[-1])
+    return {
+        "kwh": round(total, 3),
+        "kwh_per_km": round(total / (total_m / 1000.0), 3) if total_m else 0.0,
+        "climb_m": round(float(dh[dh > 0].sum()), 1),
+        "descent_m": round(float(-dh[dh < 0].sum()), 1),
+        "regen_kwh": round(max(0.0, float(-wheel_j[wheel_j < 0].sum())) * vehicle.regen_efficiency / 3.6e6, 3),
+        "elevation_m": elev,
+        "cumulative_kwh": cumulative,
+        "dem": has_dem,
+    }
+
+
+def energy_summary(profile: Dict[str, Any], soc: Optional[float], battery_kwh: float,
+                   include_profile: bool = False) -> Dict[str, Any]:
+    """JSON-ready view of route_energy(); SOC figures only when the start SOC is known."""
+    out = {k: profile[k] for k in ("kwh", "kwh_per_km", "climb_m", "descent_m", "regen_kwh", "dem")}
+    soc_path = None
+    if soc is not None:
+        soc_path = soc - profile["cumulative_kwh"] / battery_kwh * 100.0
+        out["arrival_soc"] = round(float(soc_path[-1]), 1)
+        out["min_soc"] = round(float(soc_path.min()), 1)
+    if include_profile:
+        out["elevation_m"] = np.round(profile["elevation_m"], 1).tolist()
+        out["cumulative_kwh"] = np.round(profile["cumulative_kwh"], 3).tolist()
+        if soc_path is not None:
+            out["soc"] = np.round(soc_path, 1).tolist()
+    return out
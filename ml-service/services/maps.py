@@ -0,0 +1,165 @@
+"""
+Background, content-addressed rendering of the Folium route maps.
+
+Maps are named after a hash of what is drawn on them (start/end, route paths,
+stations), so an identical trip reuses the file rendered for an earlier
+request instead of rendering it again. Rendering runs on a small thread pool
+off the request path. The directory is kept under MAPS_MAX_BYTES by evicting
+the least recently served files.
+
+    key = MAP_RENDERER.submit(start, end, routes, stations, planner.build_map)
+    MAP_RENDERER.status(key)   # "ready" | "pending" | "failed" | "unknown"
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+MAPS_DIR = os.getenv("MAPS_DIR", "maps")
+MAPS_MAX_BYTES = int(os.getenv("MAPS_MAX_BYTES", str(200 * 1024 * 1024)))
+MAP_RENDER_WORKERS = int(os.getenv("MAP_RENDER_WORKERS", "2"))
+# failed renders are reported as "failed" for a while, then forgotten (a new request retries)
+MAP_FAILED_TTL_SECONDS = float(os.getenv("MAP_FAILED_TTL_SECONDS", "300"))
+MAP_FAILED_MAX = 1024
+# coordinates are rounded before hashing so float noise from decoding doesn't split the cache
+KEY_PRECISION = 5
+
+
+def _r(point) -> Tuple[float, float]:
+    return round(float(point[0]), KEY_PRECISION), round(float(point[1]), KEY_PRECISION)
+
+
+def map_key(start, end, routes: List[Dict[str, Any]], stations: List[Dict[str, Any]]) -> str:
+    """Stable across processes and restarts (unlike hash(), which is salted per process)."""
+    payload = {
+        "start": _r(start),
+        "end": _r(end),
+        "routes": [[_r(p) for p in r["path"]] for r in routes[:3]],
+        "stations": sorted(
+            [str(s.get("station_id", "")), s.get("name", ""), *_r((s["lat"], s["lon"])), s.get("max_power_kw", 0)]
+            for s in stations
+        ),
+    }
+    blob = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()[:24]
+
+
+class MapRenderer:
+    def __init__(self, directory: str = MAPS_DIR, max_bytes: int = MAPS_MAX_BYTES, workers: int = MAP_RENDER_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="map-render")
+        self._pending: Dict[str, float] = {}
+        # key -> (failed at, error), oldest first
+        self._failed: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "cache_hits": 0, "rendered": 0, "failed": 0, "evicted": 0}
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.directory, f"route_{key}.html")
+
+    @staticmethod
+    def valid_key(key: str) -> bool:
+        return len(key) == 24 and all(c in "0123456789abcdef" for c in key)
+
+    # ---------- submit / status ----------
+    def submit(self, start, end, routes, stations, build_map: Callable[..., Optional[str]]) -> str:
+        """Queue a render unless the map exists or is already being rendered; returns the map key."""
+        key = map_key(start, end, routes, stations)
+        with self._lock:
+            self._stats["submitted"] += 1
+            if os.path.exists(self._file(key)):
+                self._stats["cache_hits"] += 1
+                return key
+            if key in self._pending:
+                return key
+            self._pending[key] = time.time()
+            self._failed.pop(key, None)
+        # snapshot the inputs so the worker never sees later changes made by the caller
+        routes = [dict(r) for r in routes[:3]]
+        stations = [dict(s) for s in stations]
+        self._pool.submit(self._render, key, start, end, routes, stations, build_map)
+        return key
+
+    def _render(self, key, start, end, routes, stations, build_map):
+        tmp_name = f"route_{key}.{threading.get_ident()}.tmp.html"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = build_map(start, end, routes, stations, filename=tmp_name, directory=self.directory)
+            if not name:
+                raise RuntimeError("folium is not installed")
+            os.replace(os.path.join(self.directory, tmp_name), self._file(key))
+            with self._lock:
+                self._stats["rendered"] += 1
+            self._evict()
+        except Exception as e:
+            print(f"⚠️ Map render failed ({key}): {e}")
+            with self._lock:
+                self._failed[key] = (time.time(), str(e))
+                self._failed.move_to_end(key)
+                self._trim_failed_locked()
+                self._stats["failed"] += 1
+            try:
+                os.remove(os.path.join(self.directory, tmp_name))
+            except OSError:
+                pass
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _trim_failed_locked(self):
+        cutoff = time.time() - MAP_FAILED_TTL_SECONDS
+        while self._failed and (len(self._failed) > MAP_FAILED_MAX or next(iter(self._failed.values()))[0] < cutoff):
+            self._failed.popitem(last=False)
+
+    def status(self, key: str) -> str:
+        with self._lock:
+            if key in self._pending:
+                return "pending"
+            self._trim_failed_locked()
+            if key in self._failed:
+                return "failed"
+        return "ready" if os.path.exists(self._file(key)) else "unknown"
+
+    def path_for_serving(self, key: str) -> Optional[str]:
+        """Absolute path of a ready map; marks it recently used for the LRU."""
+        path = self._file(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return os.path.abspath(path)
+
+    # ---------- LRU size cap ----------
+    def _evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.is_file() and e.name.endswith(".html")
+                       and not e.name.endswith(".tmp.html")]
+        except FileNotFoundError:
+            return
+        infos = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries))
+        total = sum(size for _, size, _ in infos)
+        # never evict the newest file (the map that was just rendered)
+        for _, size, path in infos[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self._stats["evicted"] += 1
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._trim_failed_locked()
+            return {**self._stats, "pending": len(self._pending), "failed_recent": len(self._failed),
+                    "max_bytes": self.max_bytes}
+
+
+MAP_RENDERER = MapRenderer()
@@ -0,0 +1,294 @@
+"""
+Prometheus metrics shared by the route service (app.py) and the chat service.
+
+Minimal text-exposition implementation (counters, gauges, histograms with
+labels) so neither service needs an extra dependency. Typical use:
+
+    from services import metrics
+
+    with metrics.stage("corridor_match"):
+        near = planner.stations_near_route(path, snapshot)
+
+    with metrics.stage("llm_reply", upstream="groq"):   # errors counted per upstream
+        res = groq_client.chat.completions.create(...)
+
+and serve metrics.render() with metrics.CONTENT_TYPE at GET /metrics.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from services import tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# external calls and DB loads sit in the 10ms - 10s range; decode/match can be sub-millisecond
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# -----------------------
+# Metric types
+# -----------------------
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "fn", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.fn: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = float(value)
+
+    def set_function(self, fn: Callable[[], float]):
+        """Evaluate fn at scrape time instead of storing a value (e.g. a cache hit ratio)."""
+        self.fn = fn
+
+    def get(self) -> float:
+        if self.fn is not None:
+            try:
+                return float(self.fn())
+            except Exception:
+                return math.nan
+        return self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(c.get())}" for k, c in list(self._children.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = 0
+        n = len(self.buckets)
+        while i < n and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        out = []
+        for key, h in list(self._children.items()):
+            with h._lock:
+                counts, total = list(h.counts), h.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, ('le', _fmt(bound)))} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return out
+
+
+# -----------------------
+# Registry
+# -----------------------
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, cls, name: str, help_text: str, labelnames: Sequence[str] = (), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"metric {name} already registered with a different type or labels")
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.get_or_create(Counter, name, help_text, labelnames)
+
+
+def gauge(name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.get_or_create(Gauge, name, help_text, labelnames)
+
+
+def histogram(name: str, help_text: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.get_or_create(Histogram, name, help_text, labelnames, buckets=buckets)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# -----------------------
+# Shared metrics
+# -----------------------
+STAGE_SECONDS = histogram(
+    "ampora_stage_duration_seconds", "Time spent in one pipeline stage of a request.", ["stage"]
+)
+EXTERNAL_ERRORS = counter(
+    "ampora_external_call_errors_total", "Failed calls to external services.", ["upstream", "error"]
+)
+REQUESTS = counter("ampora_http_requests_total", "HTTP requests handled.", ["endpoint", "method", "status"])
+REQUEST_SECONDS = histogram(
+    "ampora_http_request_duration_seconds", "End-to-end HTTP request latency.", ["endpoint", "method"]
+)
+IN_FLIGHT = gauge("ampora_http_requests_in_flight", "HTTP requests currently being handled.", ["endpoint"])
+CACHE_LOOKUPS = counter("ampora_cache_lookups_total", "Cache lookups by outcome.", ["cache", "result"])
+CACHE_HIT_RATIO = gauge("ampora_cache_hit_ratio", "Hit ratio since process start.", ["cache"])
+
+
+@contextmanager
+def stage(name: str, upstream: Optional[str] = None):
+    """
+    Time a block into STAGE_SECONDS (and a trace span of the same name);
+    exceptions are counted against `upstream` and re-raised.
+    """
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    except Exception as ex:
+        if upstream:
+            EXTERNAL_ERRORS.labels(upstream=upstream, error=type(ex).__name__).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - started)
+
+
+def timed(name: str, upstream: Optional[str] = None):
+    """Decorator form of stage()."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name, upstream):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def external_error(upstream: str, error: str):
+    """Count a failure the caller handles itself (bad status in a 200 body, empty result, ...)."""
+    EXTERNAL_ERRORS.labels(upstream=upstream, error=error).inc()
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def register_hit_ratio(cache: str, fn: Callable[[], float]):
+    CACHE_HIT_RATIO.labels(cache=cache).set_function(fn)
+
+
+# -----------------------
+# Request tracking (framework hooks call these)
+# -----------------------
+def request_started(endpoint: str) -> float:
+    IN_FLIGHT.labels(endpoint=endpoint).inc()
+    return time.perf_counter()
+
+
+def request_finished(endpoint: str, method: str, status: int, started: float):
+    IN_FLIGHT.labels(endpoint=endpoint).dec()
+    REQUESTS.labels(endpoint=endpoint, method=method, status=str(status)).inc()
+    REQUEST_SECONDS.labels(endpoint=endpoint, method=method).observe(time.perf_counter() - started)
@@ -0,0 +1,219 @@
+"""
+Nearest-station queries (k nearest / within a radius) over the station snapshot.
+
+A scikit-learn BallTree with the haversine metric is built per snapshot
+(`rebuild` is a StationSnapshot.on_change hook, so it happens on the refresh
+thread). Status or charger changes don't move stations: when the coordinates
+of a new snapshot are the same as the previous one the tree is reused and only
+the station list is swapped. Without scikit-learn, queries fall back to a
+vectorized haversine scan over the snapshot columns. Shared snapshots
+(services/shared_stations.py) bring a tree built by the publisher, which is
+used as is.
+
+    index = NearestStations()
+    STATIONS.on_change(index.rebuild)
+    index.knn(STATIONS.get(), lat, lon, k=10, station_filter=f)
+    index.within(STATIONS.get(), lat, lon, radius_km=25)
+
+route_distance_km() is the vectorized station-to-polyline distance the
+planners use to match stations along a route.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from sklearn.neighbors import BallTree
+except ImportError:  # optional
+    BallTree = None
+
+from services import metrics
+from services.connectors import StationFilter
+from services.stations import Snapshot
+
+EARTH_RADIUS_KM = 6371.0088
+MAX_K = 500
+MAX_RADIUS_KM = 500.0
+KEEP_VERSIONS = 2
+KM_PER_DEG_LAT = 110.574
+# polyline points per bounding box in route_distance_km
+ROUTE_CHUNK_POINTS = 64
+
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def route_distance_km(path: Sequence[Tuple[float, float]], lats: np.ndarray, lons: np.ndarray,
+                      max_km: float, chunk: int = ROUTE_CHUNK_POINTS) -> np.ndarray:
+    """
+    Distance from each station to a route polyline, measured to the nearest
+    vertex or segment midpoint (the planners' point-to-segment rule); inf for
+    stations farther than max_km. The path is walked in chunks and each chunk
+    only looks at the stations inside its bounding box widened by max_km, so
+    the cost is about (path points / chunk) x stations comparisons plus the
+    exact distances of the few stations near the route.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    out = np.full(len(lats), np.inf)
+    pts = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+    if len(pts) == 0 or len(lats) == 0:
+        return out
+    samples = np.empty((2 * len(pts) - 1, 2))
+    samples[0::2] = pts
+    samples[1::2] = (pts[:-1] + pts[1:]) / 2.0
+
+    dlat = max_km / KM_PER_DEG_LAT
+    for lo in range(0, len(samples), chunk):
+        block = samples[lo:lo + chunk]
+        lat_min, lat_max = block[:, 0].min() - dlat, block[:, 0].max() + dlat
+        # a degree of longitude is shortest at the box edge nearest a pole
+        cos_lat = max(np.cos(np.radians(min(90.0, max(abs(lat_min), abs(lat_max))))), 1e-6)
+        dlon = max_km / (KM_PER_DEG_LAT * cos_lat)
+        idx = np.flatnonzero(
+            (lats >= lat_min) & (lats <= lat_max)
+            & (lons >= block[:, 1].min() - dlon) & (lons <= block[:, 1].max() + dlon)
+        )
+        if not idx.size:
+            continue
+        d = haversine_km(block[:, 0][None, :], block[:, 1][None, :], lats[idx][:, None], lons[idx][:, None])
+        out[idx] = np.minimum(out[idx], d.min(axis=1))
+    out[out > max_km] = np.inf
+    return out
+
+
+def match_route(path: Sequence[Tuple[float, float]], lats: np.ndarray, lons: np.ndarray, max_km: float,
+                keep: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+    """(station index, distance_to_route_km rounded to 10 m) within max_km of the route, nearest first."""
+    dist = route_distance_km(path, lats, lons, max_km)
+    if keep is not None:
+        dist[~keep] = np.inf
+    idx = np.flatnonzero(np.isfinite(dist))
+    rounded = np.round(dist[idx], 2)
+    order = np.argsort(rounded, kind="stable")
+    return [(int(idx[j]), float(rounded[j])) for j in order]
+
+
+class NearestStations:
+    def __init__(self):
+        # snapshot version -> tree; versions whose stations didn't move share one tree
+        self._trees: "OrderedDict[str, Any]" = OrderedDict()
+        self._coords: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "reused": 0}
+
+    def rebuild(self, snapshot: Snapshot):
+        """StationSnapshot.on_change hook; reuses the tree when no station moved."""
+        coords = snapshot.coords_key
+        with self._lock:
+            if coords == self._coords and self._trees:
+                self._trees[snapshot.version] = next(reversed(self._trees.values()))
+                self._stats["reused"] += 1
+                self._trim_locked()
+                return
+        tree = snapshot.tree
+        if tree is None and BallTree is not None and snapshot.stations:
+            arrays = snapshot.arrays
+            with metrics.stage("nearest_index_build"):
+                tree = BallTree(np.radians(np.column_stack((arrays.lat, arrays.lon))), metric="haversine")
+        with self._lock:
+            self._coords = coords
+            self._trees[snapshot.version] = tree
+            self._stats["builds"] += 1
+            self._trim_locked()
+
+    def _trim_locked(self):
+        # requests still holding the previous snapshot keep a matching tree
+        while len(self._trees) > KEEP_VERSIONS:
+            self._trees.popitem(last=False)
+
+    def _tree_for(self, snapshot: Snapshot):
+        with self._lock:
+            if snapshot.version in self._trees:
+                return self._trees[snapshot.version]
+        # first query, or the hook hasn't run for this snapshot yet
+        self.rebuild(snapshot)
+        with self._lock:
+            return self._trees.get(snapshot.version)
+
+    # ---------- queries ----------
+    def _results(self, snapshot: Snapshot, idx: np.ndarray, dist_km: np.ndarray,
+                 limit: Optional[int]) -> List[Dict[str, Any]]:
+        order = np.argsort(dist_km, kind="stable")
+        if limit is not None:
+            order = order[:limit]
+        out = []
+        for j in order:
+            s = dict(snapshot.stations[int(idx[j])])
+            s["distance_km"] = round(float(dist_km[j]), 3)
+            out.append(s)
+        return out
+
+    def knn(self, snapshot: Snapshot, lat: float, lon: float, k: int = 10,
+            station_filter: Optional[StationFilter] = None) -> List[Dict[str, Any]]:
+        """The k nearest stations (straight-line) passing the filter, nearest first, with distance_km."""
+        n = len(snapshot.stations)
+        k = max(1, min(int(k), MAX_K))
+        if n == 0:
+            return []
+        keep = snapshot.mask(station_filter) if station_filter is not None and station_filter.active else None
+        tree = self._tree_for(snapshot)
+
+        if tree is None:
+            dist = haversine_km(lat, lon, snapshot.arrays.lat, snapshot.arrays.lon)
+            idx = np.arange(n) if keep is None else np.flatnonzero(keep)
+            return self._results(snapshot, idx, dist[idx], k)
+
+        point = np.radians([[lat, lon]])
+        # filtered queries over-fetch and widen until k stations pass (or everything was looked at)
+        fetch = k if keep is None else min(n, k * 4)
+        while True:
+            dist, idx = tree.query(point, k=min(fetch, n))
+            dist, idx = dist[0] * EARTH_RADIUS_KM, idx[0]
+            if keep is not None:
+                passing = keep[idx]
+                dist, idx = dist[passing], idx[passing]
+            if len(idx) >= k or fetch >= n:
+                return self._results(snapshot, idx, dist, k)
+            fetch = min(n, fetch * 4)
+
+    def within(self, snapshot: Snapshot, lat: float, lon: float, radius_km: float,
+               station_filter: Optional[StationFilter] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Stations within radius_km (straight-line) passing the filter, nearest first."""
+        if not snapshot.stations:
+            return []
+        radius_km = min(float(radius_km), MAX_RADIUS_KM)
+        tree = self._tree_for(snapshot)
+        if tree is None:
+            dist = haversine_km(lat, lon, snapshot.arrays.lat, snapshot.arrays.lon)
+            hit = dist <= radius_km
+            idx, dist = np.flatnonzero(hit), dist[hit]
+        else:
+            idx, dist = tree.query_radius(np.radians([[lat, lon]]), r=radius_km / EARTH_RADIUS_KM,
+                                          return_distance=True)
+            idx, dist = idx[0], dist[0] * EARTH_RADIUS_KM
+        if station_filter is not None and station_filter.active:
+            passing = snapshot.mask(station_filter)[idx]
+            idx, dist = idx[passing], dist[passing]
+        return self._results(snapshot, idx, dist, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            versions = list(self._trees)
+        return {**self._stats, "versions": versions, "backend": "balltree" if BallTree is not None else "scan"}
+
+
+def parse_point(lat: Any, lon: Any) -> Tuple[float, float]:
+    """Validated (lat, lon) from request params; raises ValueError."""
+    if lat is None or lon is None:
+        raise ValueError("lat and lng are required")
+    lat, lon = float(lat), float(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat/lng out of range")
+    return lat, lon
@@ -0,0 +1,345 @@
+"""
+Opt-in cProfile capture of single requests.
+
+A request is profiled when it carries `X-Profile-Token: <PROFILE_TOKEN>` or
+when an admin armed sampling for its endpoint (POST /admin/profiling), and
+only while the per-minute budget allows it. Each capture is stored in
+PROFILE_DIR as:
+
+    <id>.pstats            python -m pstats / snakeviz
+    <id>.speedscope.json   https://www.speedscope.app (stacks inferred from caller edges)
+    <id>.json              endpoint, duration and request inputs (route points, station count, ...)
+
+Handlers attach their inputs with profiling.note(route_points=..., stations=...);
+it is a no-op for requests that are not being profiled. Sync handlers that a
+framework runs on a worker thread (FastAPI `def` endpoints) wrap their body in
+`with profiling.thread_capture():` so the capture includes that thread.
+
+On an event loop, begin(..., threads_only=True) profiles only those worker
+threads: a profiler enabled on the loop thread would also record (and slow
+down) every other request interleaved on it. end(..., background=True) then
+writes the files on a separate thread instead of the loop.
+"""
+import contextlib
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# empty token disables header-triggered profiling and the admin endpoints
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_MAX_PER_MINUTE = int(os.getenv("PROFILE_MAX_PER_MINUTE", "6"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+
+HEADER = "X-Profile-Token"
+RESPONSE_HEADER = "X-Profile-Id"
+FORMATS = {"pstats": ".pstats", "speedscope": ".speedscope.json", "meta": ".json"}
+
+_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+# one writer: saves of background-ended captures (and the pruning after them) never overlap
+_SAVER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-save")
+_current: contextvars.ContextVar[Optional["Capture"]] = contextvars.ContextVar("profile_capture", default=None)
+
+
+# -----------------------
+# pstats -> speedscope
+# -----------------------
+def _frame_name(func) -> str:
+    filename, line, name = func
+    return name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def pstats_to_speedscope(stats: pstats.Stats, name: str, max_depth: int = 48,
+                         min_share: float = 0.02) -> Dict[str, Any]:
+    """
+    cProfile only records caller -> callee totals, not full stacks. Each
+    function's self time is spread over its callers in proportion to the time
+    each caller spent in it, recursively, which is what flame-graph converters
+    for cProfile do. Good enough to see which path a hot function was reached by.
+    """
+    raw = stats.stats
+    frames: List[Dict[str, Any]] = []
+    index: Dict[tuple, int] = {}
+
+    def frame(func) -> int:
+        if func not in index:
+            index[func] = len(frames)
+            frames.append({"name": _frame_name(func), "file": func[0], "line": func[1]})
+        return index[func]
+
+    def stacks(func, share: float, depth: int, seen: Set[tuple]):
+        callers = raw.get(func, (0, 0, 0, 0, {}))[4]
+        live = {c: v[3] for c, v in callers.items() if c not in seen and c in raw}
+        total = sum(live.values())
+        if not live or total <= 0 or depth >= max_depth:
+            yield [func], share
+            return
+        pruned = 0.0
+        for caller, ct in live.items():
+            part = share * ct / total
+            if part < min_share:
+                pruned += part
+                continue
+            for stack, weight in stacks(caller, part, depth + 1, seen | {func}):
+                yield stack + [func], weight
+        if pruned:
+            # minor call paths are kept as a truncated stack so total time still adds up
+            yield [func], pruned
+
+    merged: Dict[tuple, float] = {}
+    for func, (_, _, tt, _, _) in raw.items():
+        if tt <= 0:
+            continue
+        for stack, share in stacks(func, 1.0, 0, set()):
+            key = tuple(frame(f) for f in stack)
+            merged[key] = merged.get(key, 0.0) + tt * share
+    samples = [list(k) for k in merged]
+    weights = list(merged.values())
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "ampora-ml-service",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+# -----------------------
+# Capture
+# -----------------------
+class Capture:
+    def __init__(self, endpoint: str, reason: str, threads_only: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.endpoint = endpoint
+        self.reason = reason
+        # True: only thread_capture() threads are profiled, not the thread that began the capture
+        self.threads_only = threads_only
+        self.inputs: Dict[str, Any] = {}
+        self.token: Optional[contextvars.Token] = None
+        self.started_at = datetime.now(timezone.utc)
+        self._profile = cProfile.Profile()
+        # profiles of worker threads that ran the handler (thread_capture)
+        self._threads: List[cProfile.Profile] = []
+        self._thread_id = 0
+        self._t0 = 0.0
+        self.duration_s = 0.0
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        if not self.threads_only:
+            self._thread_id = threading.get_ident()
+            self._profile.enable()
+
+    def stop(self):
+        if not self.threads_only:
+            self._profile.disable()
+        self.duration_s = time.perf_counter() - self._t0
+
+    def profiles(self) -> List[cProfile.Profile]:
+        return ([] if self.threads_only else [self._profile]) + self._threads
+
+
+class RequestProfiler:
+    def __init__(self, directory: str = PROFILE_DIR, token: str = PROFILE_TOKEN,
+                 max_per_minute: int = PROFILE_MAX_PER_MINUTE, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.token = token
+        self.max_per_minute = max_per_minute
+        self.keep = keep
+        self._recent: deque = deque()
+        self._lock = threading.Lock()
+        # admin toggle: endpoint -> sample rate (0..1)
+        self._armed: Dict[str, float] = {}
+        # cProfile can only run one profiler per thread; never nest captures
+        self._active = threading.local()
+
+    # ---------- admin ----------
+    def authorized(self, header_value: Optional[str]) -> bool:
+        if not self.token or header_value is None:
+            return False
+        return hmac.compare_digest(header_value.encode("utf-8"), self.token.encode("utf-8"))
+
+    def configure(self, endpoints: List[str], sample_rate: float) -> Dict[str, float]:
+        with self._lock:
+            for endpoint in endpoints:
+                if sample_rate > 0:
+                    self._armed[endpoint] = min(1.0, sample_rate)
+                else:
+                    self._armed.pop(endpoint, None)
+            return dict(self._armed)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "armed": dict(self._armed),
+                "max_per_minute": self.max_per_minute,
+                "used_last_minute": len(self._recent),
+                "directory": os.path.abspath(self.directory),
+            }
+
+    # ---------- per request ----------
+    def _take_budget(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_minute:
+                return False
+            self._recent.append(now)
+            return True
+
+    def begin(self, endpoint: str, header_value: Optional[str], threads_only: bool = False) -> Optional[Capture]:
+        """
+        Start a capture if this request qualifies and the rate budget allows; else None.
+        threads_only: called on an event loop; profile only the handler's thread_capture().
+        """
+        if not threads_only and getattr(self._active, "busy", False):
+            return None
+        if self.authorized(header_value):
+            reason = "header"
+        else:
+            rate = self._armed.get(endpoint, 0.0)
+            if not rate or random.random() >= rate:
+                return None
+            reason = "sampled"
+        if not self._take_budget():
+            return None
+
+        capture = Capture(endpoint, reason, threads_only)
+        capture.token = _current.set(capture)
+        if not threads_only:
+            self._active.busy = True
+        capture.start()
+        return capture
+
+    def end(self, capture: Capture, status: Optional[int] = None, background: bool = False):
+        """Stop the capture and write its files; background=True writes them on the saver thread."""
+        capture.stop()
+        if not capture.threads_only:
+            self._active.busy = False
+        try:
+            _current.reset(capture.token)
+        except ValueError:
+            # finished from a different context (Starlette middleware); nothing to restore
+            pass
+        if background:
+            _SAVER.submit(self._save_logged, capture, status)
+        else:
+            self._save_logged(capture, status)
+
+    def _save_logged(self, capture: Capture, status: Optional[int]):
+        try:
+            self._save(capture, status)
+        except Exception as e:
+            print(f"⚠️ Could not save profile {capture.id}: {e}")
+
+    def _save(self, capture: Capture, status: Optional[int]):
+        profiles = capture.profiles()
+        if not profiles:
+            # the handler never reached thread_capture() (e.g. rejected by validation)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, capture.id)
+        stats = pstats.Stats(*profiles, stream=io.StringIO())
+        stats.dump_stats(base + FORMATS["pstats"])
+
+        title = f"{capture.endpoint} {capture.started_at.isoformat()}"
+        with open(base + FORMATS["speedscope"], "w", encoding="utf-8") as f:
+            json.dump(pstats_to_speedscope(stats, title), f)
+
+        top = io.StringIO()
+        pstats.Stats(*profiles, stream=top).sort_stats("cumulative").print_stats(15)
+        meta = {
+            "id": capture.id,
+            "endpoint": capture.endpoint,
+            "reason": capture.reason,
+            "status": status,
+            "started_at": capture.started_at.isoformat(),
+            "duration_ms": round(capture.duration_s * 1000, 1),
+            "inputs": capture.inputs,
+            "top_cumulative": top.getvalue().splitlines()[-25:],
+        }
+        with open(base + FORMATS["meta"], "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2, default=str)
+        print(f"📊 Profile {capture.id} saved ({capture.endpoint}, {meta['duration_ms']} ms)")
+        self._prune()
+
+    def _prune(self):
+        metas = sorted(
+            (p for p in os.listdir(self.directory) if p.endswith(FORMATS["meta"]) and not p.endswith(".speedscope.json")),
+            key=lambda p: os.path.getmtime(os.path.join(self.directory, p)),
+        )
+        for old in metas[:-self.keep] if self.keep > 0 else []:
+            pid = old[: -len(FORMATS["meta"])]
+            for ext in FORMATS.values():
+                try:
+                    os.remove(os.path.join(self.directory, pid + ext))
+                except FileNotFoundError:
+                    pass
+
+    # ---------- artifacts ----------
+    def list(self) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.directory):
+            return []
+        out = []
+        for name in os.listdir(self.directory):
+            if name.endswith(FORMATS["meta"]) and not name.endswith(".speedscope.json"):
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta.pop("top_cumulative", None)
+                out.append(meta)
+        return sorted(out, key=lambda m: m["started_at"], reverse=True)
+
+    def artifact_path(self, profile_id: str, fmt: str) -> Optional[str]:
+        if not _ID_RE.match(profile_id or "") or fmt not in FORMATS:
+            return None
+        path = os.path.join(self.directory, profile_id + FORMATS[fmt])
+        return path if os.path.exists(path) else None
+
+
+PROFILER = RequestProfiler()
+
+
+@contextlib.contextmanager
+def thread_capture():
+    """Also profile the current thread into the running capture, if it started on another thread."""
+    capture = _current.get()
+    if capture is None or capture._thread_id == threading.get_ident():
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        capture._threads.append(profile)
+
+
+def note(**inputs):
+    """Attach request inputs (route length, station count, ...) to the running capture, if any."""
+    capture = _current.get()
+    if capture is not None:
+        capture.inputs.update(inputs)
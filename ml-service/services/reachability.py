@@ -0,0 +1,253 @@
+"""
+Reachable stations and reachable-area polygon from the current SOC.
+
+Road distance is never shorter than the straight line, so the stations inside
+a circle of the battery range (services/nearest.py) are the only candidates.
+Their road distances come from the OSRM table API and are cached per origin
+cell, so later requests from the same cell (any SOC) only ask OSRM for
+stations it hasn't measured yet. The polygon is the range circle shrunk per
+compass sector by the detour factor (road km / straight km) measured to the
+stations in that sector.
+
+Requests are quantized so neighbours share work: the origin snaps to the
+centre of a REACH_ORIGIN_GRID_DEG cell, SOC rounds down to REACH_SOC_STEP and
+full range rounds down to REACH_RANGE_STEP_KM (both in the driver's favour).
+"""
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services import metrics
+from services.connectors import StationFilter
+from services.nearest import NearestStations
+from services.stations import Snapshot
+
+# BatteryRange lives with the older API code in model/create_api
+_CREATE_API = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model", "create_api")
+if _CREATE_API not in sys.path:
+    sys.path.append(_CREATE_API)
+from calculate_batry import BatteryRange  # noqa: E402
+
+REACH_ORIGIN_GRID_DEG = float(os.getenv("REACH_ORIGIN_GRID_DEG", "0.01"))  # ~1.1 km
+REACH_SOC_STEP = int(os.getenv("REACH_SOC_STEP", "5"))
+REACH_RANGE_STEP_KM = float(os.getenv("REACH_RANGE_STEP_KM", "5"))
+REACH_MAX_CANDIDATES = int(os.getenv("REACH_MAX_CANDIDATES", "300"))
+REACH_CACHE_SIZE = int(os.getenv("REACH_CACHE_SIZE", "4096"))
+REACH_RESULT_TTL_SECONDS = float(os.getenv("REACH_RESULT_TTL_SECONDS", "120"))
+REACH_DISTANCE_TTL_SECONDS = float(os.getenv("REACH_DISTANCE_TTL_SECONDS", "3600"))
+REACH_POLYGON_SECTORS = 16
+# road/straight ratio used where no station measured it (and when OSRM is down)
+DEFAULT_DETOUR = 1.3
+EARTH_RADIUS_KM = 6371.0088
+
+DEFAULT_RESERVE_SOC = 10.0
+
+TableFn = Callable[[Tuple[float, float], List[Tuple[float, float]]], List[Optional[Tuple[float, float]]]]
+
+
+def vehicle_range(battery_kwh: Optional[float] = None, kwh_per_100km: Optional[float] = None,
+                  full_range_km: Optional[float] = None, reserve_soc: float = DEFAULT_RESERVE_SOC) -> BatteryRange:
+    """BatteryRange from either battery size + consumption or a rated full range; raises ValueError."""
+    if not 0 <= reserve_soc < 100:
+        raise ValueError("reserve_soc must be in [0, 100)")
+    if battery_kwh is not None or kwh_per_100km is not None:
+        if not battery_kwh or not kwh_per_100km or battery_kwh <= 0 or kwh_per_100km <= 0:
+            raise ValueError("battery_kwh and kwh_per_100km must both be > 0")
+        br = BatteryRange.from_consumption(battery_kwh, kwh_per_100km, reserve_soc)
+    elif full_range_km is not None:
+        if full_range_km <= 0:
+            raise ValueError("full_range_km must be > 0")
+        br = BatteryRange(full_range_km, reserve_soc)
+    else:
+        br = BatteryRange(reserve_soc=reserve_soc)
+    # bucketed down so nearby vehicles share cache entries (never overstates range)
+    br.full_range = max(REACH_RANGE_STEP_KM, math.floor(br.full_range / REACH_RANGE_STEP_KM) * REACH_RANGE_STEP_KM)
+    return br
+
+
+def quantize_origin(lat: float, lon: float, grid: float = REACH_ORIGIN_GRID_DEG) -> Tuple[float, float]:
+    return (round((math.floor(lat / grid) + 0.5) * grid, 6), round((math.floor(lon / grid) + 0.5) * grid, 6))
+
+
+def quantize_soc(soc: float, step: int = REACH_SOC_STEP) -> int:
+    return int(max(0, min(100, math.floor(float(soc) / step) * step)))
+
+
+def _bearing(o: Tuple[float, float], p: Tuple[float, float]) -> float:
+    lat1, lat2 = math.radians(o[0]), math.radians(p[0])
+    dlon = math.radians(p[1] - o[1])
+    y = math.sin(dlon) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return (math.degrees(math.atan2(y, x)) + 360.0) % 360.0
+
+
+def _destination(o: Tuple[float, float], bearing_deg: float, km: float) -> Tuple[float, float]:
+    lat1, lon1, b = math.radians(o[0]), math.radians(o[1]), math.radians(bearing_deg)
+    d = km / EARTH_RADIUS_KM
+    lat2 = math.asin(math.sin(lat1) * math.cos(d) + math.cos(lat1) * math.sin(d) * math.cos(b))
+    lon2 = lon1 + math.atan2(math.sin(b) * math.sin(d) * math.cos(lat1), math.cos(d) - math.sin(lat1) * math.sin(lat2))
+    return math.degrees(lat2), (math.degrees(lon2) + 540.0) % 360.0 - 180.0
+
+
+def _median(values: List[float]) -> float:
+    v = sorted(values)
+    n = len(v)
+    return v[n // 2] if n % 2 else (v[n // 2 - 1] + v[n // 2]) / 2
+
+
+def reach_polygon(origin: Tuple[float, float], range_km: float,
+                  samples: List[Tuple[float, float]], sectors: int = REACH_POLYGON_SECTORS) -> Dict[str, Any]:
+    """
+    GeoJSON polygon of the reachable area. `samples` are (bearing_deg, detour)
+    pairs; each sector's radius is range_km / median detour in that sector.
+    """
+    width = 360.0 / sectors
+    by_sector: List[List[float]] = [[] for _ in range(sectors)]
+    for bearing, detour in samples:
+        by_sector[int(bearing // width) % sectors].append(detour)
+    overall = _median([d for _, d in samples]) if samples else DEFAULT_DETOUR
+    ring = []
+    for i in range(sectors):
+        detour = max(1.0, _median(by_sector[i]) if by_sector[i] else overall)
+        lat, lon = _destination(origin, (i + 0.5) * width, range_km / detour)
+        ring.append([round(lon, 5), round(lat, 5)])
+    ring.append(ring[0])
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+class _CellDistances:
+    __slots__ = ("km", "lock", "updated")
+
+    def __init__(self):
+        self.km: Dict[str, Optional[Tuple[float, float]]] = {}  # station_id -> (road_km, drive_min) | None
+        self.lock = threading.Lock()
+        self.updated = time.time()
+
+
+class Reachability:
+    def __init__(self, table: TableFn, nearest: NearestStations, cache_size: int = REACH_CACHE_SIZE):
+        self._table = table
+        self._nearest = nearest
+        self._cache_size = cache_size
+        self._results: "OrderedDict[tuple, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._cells: "OrderedDict[Tuple[float, float], _CellDistances]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "osrm_destinations": 0, "osrm_failures": 0}
+        metrics.register_hit_ratio("reachability", self._hit_ratio)
+
+    def _hit_ratio(self) -> float:
+        total = self._stats["hits"] + self._stats["misses"]
+        return self._stats["hits"] / total if total else 0.0
+
+    # ---------- caches ----------
+    def _cell(self, origin: Tuple[float, float]) -> _CellDistances:
+        with self._lock:
+            cell = self._cells.get(origin)
+            if cell is None or time.time() - cell.updated > REACH_DISTANCE_TTL_SECONDS:
+                cell = self._cells[origin] = _CellDistances()
+            self._cells.move_to_end(origin)
+            while len(self._cells) > self._cache_size:
+                self._cells.popitem(last=False)
+            return cell
+
+    def _road_distances(self, origin: Tuple[float, float], candidates: List[Dict[str, Any]]):
+        """(distances by station id, measured) for the candidates; fetches only unseen stations."""
+        cell = self._cell(origin)
+        # one OSRM fetch per cell at a time; concurrent requests for the cell wait and reuse it
+        with cell.lock:
+            missing = [s for s in candidates if s["station_id"] not in cell.km]
+            if missing:
+                try:
+                    rows = self._table(origin, [(s["lat"], s["lon"]) for s in missing])
+                except Exception as e:
+                    self._stats["osrm_failures"] += 1
+                    print(f"⚠️ OSRM table failed, estimating road distances: {e}")
+                    est = {s["station_id"]: (s["distance_km"] * DEFAULT_DETOUR, None) for s in missing}
+                    return {**cell.km, **est}, False
+                self._stats["osrm_destinations"] += len(missing)
+                for s, row in zip(missing, rows):
+                    cell.km[s["station_id"]] = row
+            return cell.km, True
+
+    # ---------- query ----------
+    def reachable(self, snapshot: Snapshot, lat: float, lon: float, soc: float, battery: BatteryRange,
+                  station_filter: Optional[StationFilter] = None) -> Tuple[Dict[str, Any], bool]:
+        """(result, served_from_cache) for the quantized request."""
+        origin = quantize_origin(lat, lon)
+        soc_b = quantize_soc(soc)
+        fkey = station_filter.key() if station_filter is not None else ""
+        key = (origin, soc_b, battery.full_range, battery.reserve_soc, fkey, snapshot.version)
+
+        with self._lock:
+            hit = self._results.get(key)
+            if hit is not None and time.time() - hit[0] <= REACH_RESULT_TTL_SECONDS:
+                self._results.move_to_end(key)
+                self._stats["hits"] += 1
+                return hit[1], True
+            self._stats["misses"] += 1
+
+        result, measured = self._compute(snapshot, origin, soc_b, battery, station_filter)
+        if measured:
+            with self._lock:
+                self._results[key] = (time.time(), result)
+                while len(self._results) > self._cache_size:
+                    self._results.popitem(last=False)
+        return result, False
+
+    def _compute(self, snapshot, origin, soc_b, battery, station_filter):
+        range_km = battery.get_range(soc_b)
+        result = {
+            "origin": {"lat": origin[0], "lng": origin[1]},
+            "soc": soc_b,
+            "range_km": round(range_km, 1),
+            "stations": [],
+            "polygon": None,
+            "truncated": False,
+            "road_distances": "osrm",
+        }
+        if range_km <= 0:
+            return result, True
+
+        with metrics.stage("reach_candidates"):
+            candidates = self._nearest.within(snapshot, origin[0], origin[1], range_km, station_filter)
+        if len(candidates) > REACH_MAX_CANDIDATES:
+            candidates = candidates[:REACH_MAX_CANDIDATES]
+            result["truncated"] = True
+
+        road, measured = self._road_distances(origin, candidates)
+        if not measured:
+            result["road_distances"] = "estimated"
+
+        reachable, samples = [], []
+        for s in candidates:
+            row = road.get(s["station_id"])
+            if row is None:
+                continue  # no road route to it
+            km, minutes = row
+            if s["distance_km"] >= 0.5:
+                samples.append((_bearing(origin, (s["lat"], s["lon"])), km / s["distance_km"]))
+            if km <= range_km:
+                reachable.append({
+                    "station_id": s["station_id"],
+                    "name": s["name"],
+                    "lat": s["lat"],
+                    "lng": s["lon"],
+                    "road_km": round(km, 1),
+                    "drive_min": round(minutes) if minutes is not None else None,
+                    "arrival_soc": round(battery.soc_after(soc_b, km), 1),
+                    "connectors": s.get("connectors", []),
+                    "max_power_kw": s.get("max_power_kw", 0.0),
+                    "available_count": s.get("available_count", 0),
+                })
+        reachable.sort(key=lambda r: r["road_km"])
+        result["stations"] = reachable
+        result["polygon"] = reach_polygon(origin, range_km, samples)
+        return result, measured
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "results": len(self._results), "cells": len(self._cells)}
@@ -0,0 +1,445 @@
+"""
+Deadlines, retries, hedging and circuit breakers for outbound calls.
+
+Every request gets an end-to-end deadline (set by the framework hooks from
+`X-Request-Deadline-Ms`, or the service default); each upstream attempt is
+given only what is left of it, so a slow upstream can no longer hold a
+request for its full client timeout. On top of that, per upstream:
+
+- bounded retries with full-jitter exponential backoff, for connection
+  errors, timeouts, 429 and 5xx only (4xx answers are returned as they are)
+- hedging (idempotent upstreams only, see HEDGE_UPSTREAMS): if the first
+  attempt hasn't answered after the upstream's recent p95 latency, a
+  duplicate is sent and whichever answers first wins
+- a circuit breaker: after BREAKER_FAILURES consecutive failures calls fail
+  fast (or go to the fallback) for BREAKER_RESET_SECONDS, then one trial
+  call decides whether to close it again
+- optionally a token bucket (services/admission.py) for quota-bound
+  upstreams: an attempt that can't get a token before the deadline is
+  refused like an open breaker
+
+Attempts are functions of the time they may take:
+
+    OSRM = resilience.upstream("osrm")
+    data = OSRM.call(lambda timeout: get_json(url, timeout=timeout), fallback=use_secondary)
+    data = await GOOGLE.call_async(lambda timeout: client.get(url, timeout=timeout))
+"""
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from services import metrics
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_TIMEOUT_SECONDS", "10"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_SECONDS = float(os.getenv("UPSTREAM_BACKOFF_SECONDS", "0.2"))
+# duplicates cost quota on billed APIs, so only these upstreams hedge
+HEDGE_UPSTREAMS = {u.strip() for u in os.getenv("HEDGE_UPSTREAMS", "osrm").split(",") if u.strip()}
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_SECONDS = 0.05
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# longest an attempt waits for a rate-limit token (less if the deadline is nearer)
+RATE_LIMIT_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_WAIT_SECONDS", "1"))
+
+ATTEMPTS = metrics.counter(
+    "ampora_upstream_attempts_total",
+    "Outbound attempts by outcome (ok, error, rejected, rate_limited, retry, hedge, hedge_won, fallback).",
+    ["upstream", "outcome"],
+)
+BREAKER_STATE = metrics.gauge("ampora_circuit_breaker_state", "0 closed, 1 half-open, 2 open.", ["upstream"])
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+# the same request's deadline before the header shortened it
+_service_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("service_deadline", default=None)
+# attempts run here when they may be hedged; sized for the hedged upstreams only
+_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_WORKERS", "32")), thread_name_prefix="hedge")
+
+
+class UpstreamError(RuntimeError):
+    def __init__(self, upstream: str, message: str):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+
+
+class CircuitOpen(UpstreamError):
+    """The upstream failed repeatedly; calls are refused until the breaker resets."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(upstream, f"circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RateLimited(UpstreamError):
+    """No token from the upstream's bucket within the request deadline."""
+
+    def __init__(self, upstream: str):
+        super().__init__(upstream, "rate limit reached, retry later")
+        self.retry_after = 1.0
+
+
+class DeadlineExceeded(UpstreamError, TimeoutError):
+    """The request's deadline ran out before (or while) calling the upstream."""
+
+
+# -----------------------
+# Deadlines
+# -----------------------
+def start_deadline(seconds: float, header_value: Optional[str] = None) -> Tuple[contextvars.Token, contextvars.Token]:
+    """Set the request deadline (the header's budget if it is shorter); reset with end_deadline()."""
+    now = time.monotonic()
+    service = _service_deadline.set(now + seconds)
+    if header_value:
+        try:
+            seconds = min(seconds, max(0.0, float(header_value) / 1000.0))
+        except ValueError:
+            pass
+    return _deadline.set(now + seconds), service
+
+
+def end_deadline(tokens: Tuple[contextvars.Token, contextvars.Token]):
+    for var, token in zip((_deadline, _service_deadline), tokens):
+        try:
+            var.reset(token)
+        except ValueError:
+            # finished from a different context (Starlette middleware)
+            pass
+
+
+@contextmanager
+def service_deadline():
+    """
+    Run a block under the service's own request deadline instead of the
+    caller's, which X-Request-Deadline-Ms may have shortened; for work shared
+    by several requests (services/cache.py).
+    """
+    token = _deadline.set(_service_deadline.get())
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Narrow the deadline for a block; never extends the request's own deadline."""
+    current = _deadline.get()
+    token = _deadline.set(min(current, time.monotonic() + seconds) if current is not None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(default: Optional[float] = None) -> Optional[float]:
+    """Seconds left before the deadline (default if none is set)."""
+    d = _deadline.get()
+    return default if d is None else d - time.monotonic()
+
+
+def retryable(exc: BaseException) -> bool:
+    """Transient failures worth another attempt (and counted against the breaker)."""
+    if isinstance(exc, (CircuitOpen, RateLimited)):
+        return False
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRY_STATUSES
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    # requests / httpx / googlemaps / groq name their transport errors alike; no imports needed
+    name = type(exc).__name__
+    return any(part in name for part in ("Timeout", "Connection", "Transport", "RateLimit"))
+
+
+# -----------------------
+# Circuit breaker
+# -----------------------
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+        BREAKER_STATE.labels(upstream=name).set(self.state)
+
+    def _set(self, state: int):
+        self.state = state
+        BREAKER_STATE.labels(upstream=self.name).set(state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._set(self.HALF_OPEN)
+                self._trial = False
+            if self.state == self.HALF_OPEN:
+                # one trial call at a time decides
+                if self._trial:
+                    return False
+                self._trial = True
+                return True
+            return self.state == self.CLOSED
+
+    def release(self):
+        """End a trial call without a verdict (it ran out of request deadline, not upstream time)."""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._trial = False
+            if self.state != self.CLOSED:
+                self._set(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            self._trial = False
+            if self.state == self.HALF_OPEN or self._consecutive >= self.failures:
+                if self.state != self.OPEN:
+                    print(f"⚠️ Circuit breaker for {self.name} opened after {self._consecutive} failures")
+                self._set(self.OPEN)
+                self._opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        return max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+
+# -----------------------
+# Upstream policy
+# -----------------------
+class Upstream:
+    def __init__(self, name: str, timeout: float = UPSTREAM_TIMEOUT_SECONDS, retries: int = UPSTREAM_RETRIES,
+                 backoff: float = UPSTREAM_BACKOFF_SECONDS, hedge: Optional[bool] = None, bucket: Any = None):
+        self.name = name
+        self.bucket = bucket
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = name in HEDGE_UPSTREAMS if hedge is None else hedge
+        self.breaker = CircuitBreaker(name)
+        self._latencies: deque = deque(maxlen=200)
+
+    # ---------- helpers ----------
+    def hedge_delay(self) -> Optional[float]:
+        """Recent p95 latency of successful attempts; None until there are enough samples."""
+        if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY_SECONDS, float(np.quantile(list(self._latencies), HEDGE_QUANTILE)))
+
+    def _attempt_timeout(self) -> float:
+        left = remaining(self.timeout)
+        if left <= 0:
+            ATTEMPTS.labels(upstream=self.name, outcome="deadline").inc()
+            raise DeadlineExceeded(self.name, "request deadline exceeded")
+        return min(self.timeout, left)
+
+    def _sleep_before_retry(self, attempt: int) -> bool:
+        """Full-jitter backoff; False when it wouldn't fit in the deadline."""
+        pause = random.uniform(0, self.backoff * (2 ** attempt))
+        left = remaining(None)
+        if left is not None and pause >= left:
+            return False
+        time.sleep(pause)
+        return True
+
+    def _failed(self, exc: BaseException, timeout: float):
+        # a timeout on an attempt the request deadline cut short says little about the upstream
+        timed_out = isinstance(exc, TimeoutError) or "Timeout" in type(exc).__name__
+        if timed_out and timeout < self.timeout:
+            self.breaker.release()
+        else:
+            self.breaker.failure()
+        ATTEMPTS.labels(upstream=self.name, outcome="error").inc()
+
+    def _ok(self, started: float):
+        self._latencies.append(time.perf_counter() - started)
+        self.breaker.success()
+        ATTEMPTS.labels(upstream=self.name, outcome="ok").inc()
+
+    def _refused(self, error: UpstreamError, fallback):
+        ATTEMPTS.labels(upstream=self.name, outcome="rate_limited" if isinstance(error, RateLimited) else "rejected").inc()
+        if fallback is not None:
+            ATTEMPTS.labels(upstream=self.name, outcome="fallback").inc()
+            return fallback()
+        raise error
+
+    def _token_wait(self) -> float:
+        return max(0.0, min(RATE_LIMIT_WAIT_SECONDS, remaining(RATE_LIMIT_WAIT_SECONDS)))
+
+    # ---------- sync ----------
+    def _hedged(self, fn: Callable[[float], Any], timeout: float) -> Any:
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return fn(timeout)
+        first = _POOL.submit(contextvars.copy_context().run, fn, timeout)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        ATTEMPTS.labels(upstream=self.name, outcome="hedge").inc()
+        second = _POOL.submit(contextvars.copy_context().run, fn, timeout - delay)
+        pending, error = {first, second}, None
+        end = time.monotonic() + timeout - delay
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"{self.name}: no answer within {timeout:.1f}s")
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        ATTEMPTS.labels(upstream=self.name, outcome="hedge_won").inc()
+                    return f.result()
+                error = f.exception()
+        raise error
+
+    def call(self, fn: Callable[[float], Any], fallback: Optional[Callable[[], Any]] = None) -> Any:
+        """fn(timeout_seconds) under the deadline, retry, hedge and breaker policy."""
+        last: Optional[BaseException] = None
+        for attempt in range(self.retries + 1):
+            if self.bucket is not None and not self.bucket.take(self._token_wait()):
+                return self._refused(RateLimited(self.name), fallback)
+            if not self.breaker.allow():
+                return self._refused(CircuitOpen(self.name, self.breaker.retry_after()), fallback)
+            timeout = self._attempt_timeout()
+            started = time.perf_counter()
+            try:
+                result = self._hedged(fn, timeout)
+            except Exception as e:
+                if not retryable(e):
+                    # the upstream answered; nothing wrong with it
+                    self.breaker.success()
+                    raise
+                last = e
+                self._failed(e, timeout)
+                if attempt == self.retries or not self._sleep_before_retry(attempt):
+                    break
+                ATTEMPTS.labels(upstream=self.name, outcome="retry").inc()
+                continue
+            self._ok(started)
+            return result
+        if fallback is not None:
+            ATTEMPTS.labels(upstream=self.name, outcome="fallback").inc()
+            return fallback()
+        raise last
+
+    # ---------- asyncio ----------
+    async def _hedged_async(self, fn: Callable[[float], Awaitable[Any]], timeout: float) -> Any:
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(fn(timeout))
+        if delay is None or delay >= timeout:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        ATTEMPTS.labels(upstream=self.name, outcome="hedge").inc()
+        second = asyncio.ensure_future(fn(timeout - delay))
+        pending, error = {first, second}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        if t is second:
+                            ATTEMPTS.labels(upstream=self.name, outcome="hedge_won").inc()
+                        return t.result()
+                    error = t.exception()
+            raise error
+        finally:
+            for t in pending:
+                t.cancel()
+
+    async def call_async(self, fn: Callable[[float], Awaitable[Any]],
+                         fallback: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+        """call() for coroutine attempts."""
+        last: Optional[BaseException] = None
+        for attempt in range(self.retries + 1):
+            refused: Optional[UpstreamError] = None
+            if self.bucket is not None and not await self.bucket.take_async(self._token_wait()):
+                refused = RateLimited(self.name)
+            elif not self.breaker.allow():
+                refused = CircuitOpen(self.name, self.breaker.retry_after())
+            if refused is not None:
+                ATTEMPTS.labels(upstream=self.name, outcome="rate_limited" if isinstance(refused, RateLimited) else "rejected").inc()
+                if fallback is not None:
+                    ATTEMPTS.labels(upstream=self.name, outcome="fallback").inc()
+                    return await fallback()
+                raise refused
+            timeout = self._attempt_timeout()
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(self._hedged_async(fn, timeout), timeout)
+            except Exception as e:
+                if not retryable(e):
+                    self.breaker.success()
+                    raise
+                last = e
+                self._failed(e, timeout)
+                pause = random.uniform(0, self.backoff * (2 ** attempt))
+                left = remaining(None)
+                if attempt == self.retries or (left is not None and pause >= left):
+                    break
+                ATTEMPTS.labels(upstream=self.name, outcome="retry").inc()
+                await asyncio.sleep(pause)
+                continue
+            self._ok(started)
+            return result
+        if fallback is not None:
+            ATTEMPTS.labels(upstream=self.name, outcome="fallback").inc()
+            return await fallback()
+        raise last
+
+    def stats(self) -> Dict[str, Any]:
+        lat = list(self._latencies)
+        return {
+            "breaker": ("closed", "half_open", "open")[self.breaker.state],
+            "hedge": self.hedge,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1) if self.hedge_delay() is not None else None,
+            "p50_ms": round(float(np.quantile(lat, 0.5)) * 1000, 1) if lat else None,
+            "samples": len(lat),
+        }
+
+
+_UPSTREAMS: Dict[str, Upstream] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def upstream(name: str, **kwargs) -> Upstream:
+    """The process-wide policy for `name` (created with kwargs on first use)."""
+    with _REGISTRY_LOCK:
+        if name not in _UPSTREAMS:
+            _UPSTREAMS[name] = Upstream(name, **kwargs)
+        return _UPSTREAMS[name]
+
+
+def stats() -> Dict[str, Any]:
+    with _REGISTRY_LOCK:
+        return {name: u.stats() for name, u in _UPSTREAMS.items()}
+
+
+def http_status(exc: BaseException) -> int:
+    """Status for a request that failed on an upstream: 503 refused, 504 out of time, 502 otherwise."""
+    if isinstance(exc, (CircuitOpen, RateLimited)):
+        return 503
+    if isinstance(exc, TimeoutError) or "Timeout" in type(exc).__name__:
+        return 504
+    return 502 if retryable(exc) or isinstance(exc, UpstreamError) else 500
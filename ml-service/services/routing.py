@@ -0,0 +1,286 @@
+"""
+Multi-stop waypoint ordering from a cached duration matrix.
+
+Instead of letting each provider decide the stop order (Google's
+optimize:true, OSRM none at all), the planners fetch one duration matrix
+over start + stops + end (OSRM table API / Google Distance Matrix), cache it
+and order the stops here, so every provider drives the same order:
+
+- up to ROUTE_EXACT_MAX_STOPS stops: Held-Karp dynamic programming (optimal)
+- beyond that: nearest neighbour, then 2-opt and Or-opt moves until neither improves
+
+The start and end stay fixed; durations may be asymmetric. Matrices are cached
+by the point *set* (coordinates rounded to ~1 m), so the same stops sent in a
+different order reuse the same matrix, and concurrent misses for one set
+share a single fetch.
+
+    points = route_points(start, end, stops)
+    matrix, cached = DURATION_MATRICES.get_or_fetch("osrm", points, planner.get_matrix_from_osrm)
+    matrix, cached = await DURATION_MATRICES.get_or_fetch_async("google", points, fetch_google_matrix)
+    ordered, info = order_stops(stops, matrix, cached)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services import admission, metrics, resilience
+from services.cache import AsyncSingleFlight, SingleFlight
+
+ROUTE_EXACT_MAX_STOPS = int(os.getenv("ROUTE_EXACT_MAX_STOPS", "10"))
+# Google waypoints and Distance Matrix origins/destinations both stop at 25 points
+ROUTE_MAX_STOPS = int(os.getenv("ROUTE_MAX_STOPS", "23"))
+ROUTE_MATRIX_TTL_SECONDS = float(os.getenv("ROUTE_MATRIX_TTL_SECONDS", "900"))
+ROUTE_MATRIX_CACHE_SIZE = int(os.getenv("ROUTE_MATRIX_CACHE_SIZE", "1024"))
+# Distance Matrix elements (origins x destinations) per request
+GOOGLE_MATRIX_MAX_ELEMENTS = 100
+GOOGLE_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_TIMEOUT_SECONDS", "8"))
+# seconds charged for a leg the provider couldn't route, so such orders lose
+UNREACHABLE_SECONDS = 1e7
+
+Point = Tuple[float, float]
+
+
+def route_points(start: Point, end: Point, stops: Sequence[Point]) -> List[Point]:
+    """Matrix index 0 = start, 1..n = stops, n + 1 = end."""
+    return [start, *stops, end]
+
+
+def _rounded(p: Point) -> Point:
+    return round(float(p[0]), 5), round(float(p[1]), 5)
+
+
+# -----------------------
+# Matrix cache
+# -----------------------
+class DurationMatrixCache:
+    """(provider, point set) -> duration matrix in seconds (NaN = no route), LRU with a TTL."""
+
+    def __init__(self, size: int = ROUTE_MATRIX_CACHE_SIZE, ttl: float = ROUTE_MATRIX_TTL_SECONDS):
+        self._size = size
+        self._ttl = ttl
+        self._entries: "OrderedDict[tuple, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+        self._flights = SingleFlight("duration_matrix")
+        self._async_flights = AsyncSingleFlight("duration_matrix")
+        metrics.register_hit_ratio("duration_matrix", self._hit_ratio)
+
+    def _hit_ratio(self) -> float:
+        total = self._stats["hits"] + self._stats["misses"]
+        return self._stats["hits"] / total if total else 0.0
+
+    @staticmethod
+    def _canonical(points: Sequence[Point]) -> Tuple[Tuple[Point, ...], np.ndarray]:
+        # stored in sorted point order; perm maps the caller's order onto it
+        keys = [_rounded(p) for p in points]
+        perm = np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=int)
+        return tuple(keys[i] for i in perm), perm
+
+    @staticmethod
+    def _reordered(stored: np.ndarray, perm: np.ndarray) -> np.ndarray:
+        inv = np.empty_like(perm)
+        inv[perm] = np.arange(len(perm))
+        return stored[np.ix_(inv, inv)]
+
+    def get(self, provider: str, points: Sequence[Point]) -> Optional[np.ndarray]:
+        key, perm = self._canonical(points)
+        with self._lock:
+            hit = self._entries.get((provider, key))
+            if hit is not None and time.time() - hit[0] > self._ttl:
+                self._entries.pop((provider, key), None)
+                hit = None
+            if hit is not None:
+                self._entries.move_to_end((provider, key))
+            self._stats["hits" if hit is not None else "misses"] += 1
+        metrics.cache_lookup("duration_matrix", hit=hit is not None)
+        return self._reordered(hit[1], perm) if hit is not None else None
+
+    def put(self, provider: str, points: Sequence[Point], matrix: np.ndarray) -> np.ndarray:
+        """Store a matrix given in the points' order; returns it in canonical (sorted) order."""
+        key, perm = self._canonical(points)
+        stored = np.asarray(matrix, dtype=float)[np.ix_(perm, perm)]
+        with self._lock:
+            self._entries[(provider, key)] = (time.time(), stored)
+            self._entries.move_to_end((provider, key))
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+        return stored
+
+    def get_or_fetch(self, provider: str, points: Sequence[Point],
+                     fetch: Callable[[List[Point]], np.ndarray]) -> Tuple[np.ndarray, bool]:
+        """(matrix, served_from_cache); `fetch` gets the points in the caller's order."""
+        matrix = self.get(provider, points)
+        if matrix is not None:
+            return matrix, True
+        key, perm = self._canonical(points)
+        # followers may list the same points in another order, so the flight shares the canonical matrix
+        stored = self._flights.do((provider, key), lambda: self.put(provider, points, fetch(list(points))))
+        return self._reordered(stored, perm), False
+
+    async def get_or_fetch_async(self, provider: str, points: Sequence[Point],
+                                 fetch: Callable[[List[Point]], Awaitable[np.ndarray]]) -> Tuple[np.ndarray, bool]:
+        """get_or_fetch() for coroutine fetchers (the Google planners)."""
+        matrix = self.get(provider, points)
+        if matrix is not None:
+            return matrix, True
+        key, perm = self._canonical(points)
+
+        async def fetch_stored():
+            return self.put(provider, points, await fetch(list(points)))
+
+        stored = await self._async_flights.do((provider, key), fetch_stored)
+        return self._reordered(stored, perm), False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+
+DURATION_MATRICES = DurationMatrixCache()
+
+
+# -----------------------
+# Google Distance Matrix helpers (the planners do the HTTP)
+# -----------------------
+# one deadline / retry / breaker policy for Directions and Distance Matrix in both
+# Google planners, paced by the shared Google quota bucket
+GOOGLE = resilience.upstream("google", timeout=GOOGLE_TIMEOUT_SECONDS, bucket=admission.bucket("google"))
+
+
+def google_matrix_requests(points: Sequence[Point]) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """(first row, params) per request; each covers as many origin rows as the element limit allows."""
+    locs = [f"{lat},{lng}" for lat, lng in points]
+    rows = max(1, GOOGLE_MATRIX_MAX_ELEMENTS // len(locs))
+    for i in range(0, len(locs), rows):
+        yield i, {"origins": "|".join(locs[i:i + rows]), "destinations": "|".join(locs), "mode": "driving"}
+
+
+def google_matrix_fill(matrix: np.ndarray, first_row: int, data: Dict[str, Any]):
+    """Copy duration seconds from one Distance Matrix response into matrix rows (NaN if not OK)."""
+    if data.get("status") != "OK":
+        raise RuntimeError(f"Google distance matrix failed: {data.get('status')}")
+    for i, row in enumerate(data.get("rows", [])):
+        for j, el in enumerate(row.get("elements", [])):
+            if el.get("status") == "OK":
+                matrix[first_row + i, j] = el["duration"]["value"]
+
+
+# -----------------------
+# Solvers
+# -----------------------
+def _prepared(matrix: np.ndarray) -> np.ndarray:
+    m = np.array(matrix, dtype=float)
+    m[~np.isfinite(m)] = UNREACHABLE_SECONDS
+    np.fill_diagonal(m, 0.0)
+    return m
+
+
+def path_seconds(m: np.ndarray, order: Sequence[int]) -> float:
+    """Duration of start -> stops in `order` (0-based stop indices) -> end."""
+    seq = [0, *(i + 1 for i in order), len(m) - 1]
+    return float(sum(m[a, b] for a, b in zip(seq, seq[1:])))
+
+
+def _held_karp(m: np.ndarray) -> List[int]:
+    n = len(m) - 2
+    legs = m[1:n + 1, 1:n + 1]           # stop -> stop
+    full = (1 << n) - 1
+    cost = np.full((1 << n, n), np.inf)
+    parent = np.full((1 << n, n), -1, dtype=np.int16)
+    for j in range(n):
+        cost[1 << j, j] = m[0, j + 1]
+    bits = 1 << np.arange(n)
+    for mask in range(1, full):
+        row = cost[mask]
+        if not np.isfinite(row).any():
+            continue
+        # best way to reach each stop k from any last stop j in mask
+        via = row[:, None] + legs
+        best_j = via.argmin(axis=0)
+        best = via[best_j, np.arange(n)]
+        for k in np.flatnonzero((mask & bits) == 0):
+            nxt = mask | (1 << k)
+            if best[k] < cost[nxt, k]:
+                cost[nxt, k] = best[k]
+                parent[nxt, k] = best_j[k]
+    last = int(np.argmin(cost[full] + m[1:n + 1, n + 1]))
+    order, mask = [], full
+    while last >= 0:
+        order.append(last)
+        prev = int(parent[mask, last])
+        mask ^= 1 << last
+        last = prev
+    return order[::-1]
+
+
+def _nearest_neighbour(m: np.ndarray) -> List[int]:
+    n = len(m) - 2
+    left, order, here = set(range(n)), [], 0
+    while left:
+        nxt = min(left, key=lambda k: m[here, k + 1])
+        order.append(nxt)
+        left.discard(nxt)
+        here = nxt + 1
+    return order
+
+
+def _improve(m: np.ndarray, order: List[int]) -> List[int]:
+    """2-opt (segment reversal) and Or-opt (move 1-3 stops) until neither finds a shorter path."""
+    best = path_seconds(m, order)
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                cand = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                c = path_seconds(m, cand)
+                if c < best - 1e-9:
+                    order, best, improved = cand, c, True
+        for seg in (1, 2, 3):
+            for i in range(n - seg + 1):
+                chunk, rest = order[i:i + seg], order[:i] + order[i + seg:]
+                for j in range(len(rest) + 1):
+                    if j == i:
+                        continue
+                    cand = rest[:j] + chunk + rest[j:]
+                    c = path_seconds(m, cand)
+                    if c < best - 1e-9:
+                        order, best, improved = cand, c, True
+                        break
+    return order
+
+
+def solve_order(matrix: np.ndarray) -> Tuple[List[int], str]:
+    """(stop order as 0-based stop indices, method) for a matrix laid out as route_points()."""
+    m = _prepared(matrix)
+    n = len(m) - 2
+    if n <= 1:
+        return list(range(n)), "given"
+    if n <= ROUTE_EXACT_MAX_STOPS:
+        return _held_karp(m), "exact"
+    return _improve(m, _nearest_neighbour(m)), "heuristic"
+
+
+def order_stops(stops: Sequence[Point], matrix: np.ndarray, cached: bool = False) -> Tuple[List[Point], Dict[str, Any]]:
+    """Stops in the solved order plus what the response reports about it."""
+    with metrics.stage("waypoint_order"):
+        order, method = solve_order(matrix)
+    m = _prepared(matrix)
+    given = path_seconds(m, range(len(stops)))
+    solved = path_seconds(m, order)
+    if solved >= given:
+        # ties (and heuristic misses) keep the caller's order
+        order = list(range(len(stops)))
+        solved = given
+    return [stops[i] for i in order], {
+        "order": order,
+        "method": method,
+        "matrix_cached": cached,
+        "duration_min": round(solved / 60.0, 1),
+        "given_duration_min": round(given / 60.0, 1),
+    }
@@ -0,0 +1,344 @@
+"""
+Station snapshot shared by all worker processes through one mmap'd file.
+
+With several gunicorn/uvicorn workers every process used to load and hold
+its own copy of the stations, its own numpy columns and its own BallTree.
+With STATION_SHM_DIR set (a tmpfs such as /dev/shm/ampora-stations), a
+snapshot is published once as a read-only *generation* file:
+
+- the StationArrays columns (lat, lon, connector mask, power, availability,
+  charger count) and the station ids
+- the station records as JSON with an offsets column, decoded on access
+  (the last RECORD_CACHE_SIZE records stay decoded per process); full scans
+  such as tiles, tilejson bounds, index_of and the corridor id index read
+  the columns instead
+- the BallTree of services/nearest.py (its state arrays, when scikit-learn
+  is installed), so no worker builds its own
+
+Workers map the current generation read-only, so the pages exist once in
+the page cache no matter how many workers there are. A refresh writes a new
+generation file and then swaps the `current` pointer with os.replace.
+Workers still holding the old generation keep their mapping until they
+drop it, and unlinking the file doesn't invalidate the mapping.
+
+Whoever finds the generation older than the TTL reloads it from Postgres
+under an flock; the others keep serving and attach the result. The loader
+can also be a separate process (publish_stations.py), and then no worker
+ever queries Postgres for stations.
+
+    STATIONS = shared_stations.snapshot_source("route-service", _load_stations)
+"""
+import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # optional (not on Windows)
+    fcntl = None
+
+try:
+    import sklearn
+    from sklearn.metrics import DistanceMetric
+    from sklearn.neighbors import BallTree
+except ImportError:  # optional
+    sklearn = DistanceMetric = BallTree = None
+
+from services import connectors, metrics
+from services.stations import STATION_SNAPSHOT_TTL_SECONDS, Snapshot, StationSnapshot
+
+STATION_SHM_DIR = os.getenv("STATION_SHM_DIR", "")
+RECORD_CACHE_SIZE = int(os.getenv("STATION_RECORD_CACHE_SIZE", "4096"))
+# bumped whenever the columns or the record fields change; older generations are republished
+MAGIC = b"AMPSTN03"
+ALIGN = 64
+ARRAY_COLUMNS = ("lat", "lon", "mask", "power", "max_power", "available", "available_power", "charger_count")
+
+GENERATION_AGE = metrics.gauge(
+    "ampora_station_generation_age_seconds", "Age of the shared station generation this process serves.", ["store"]
+)
+PUBLISHES = metrics.counter("ampora_station_generation_publishes_total", "Generations published.", ["store"])
+
+
+# -----------------------
+# Records
+# -----------------------
+class StationRecords(Sequence):
+    """Read-only station dicts decoded on access from a generation's record blob."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, cache_size: int = RECORD_CACHE_SIZE):
+        self._blob = blob
+        self._offsets = offsets
+        self._cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _decode(self, i: int) -> Dict[str, Any]:
+        return json.loads(self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        with self._lock:
+            rec = self._cache.get(i)
+            if rec is not None:
+                self._cache.move_to_end(i)
+                return rec
+        rec = self._decode(i)
+        with self._lock:
+            self._cache[i] = rec
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return rec
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        # full scans would only churn the cache
+        for i in range(len(self)):
+            yield self._decode(i)
+
+
+# -----------------------
+# Generation files
+# -----------------------
+def _tree_state(snapshot: Snapshot) -> Optional[List[Any]]:
+    if BallTree is None or not snapshot.stations:
+        return None
+    with metrics.stage("nearest_index_build"):
+        tree = BallTree(np.radians(np.column_stack((snapshot.arrays.lat, snapshot.arrays.lon))), metric="haversine")
+    return list(tree.__getstate__())
+
+
+def write_generation(path: str, snapshot: Snapshot):
+    """Write a snapshot (columns, records, spatial index) as one generation file."""
+    arrays: Dict[str, np.ndarray] = {name: getattr(snapshot.arrays, name) for name in ARRAY_COLUMNS}
+    arrays["station_id"] = snapshot.ids
+    encoded = [json.dumps(s, default=str, separators=(",", ":")).encode("utf-8") for s in snapshot.stations]
+    arrays["records"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    arrays["record_offsets"] = np.concatenate(([0], np.cumsum([len(e) for e in encoded], dtype=np.int64)))
+
+    tree = None
+    state = _tree_state(snapshot)
+    if state is not None:
+        # arrays go in the file; the scalars and the metric name in the header
+        tree = {"sklearn": sklearn.__version__, "state": []}
+        for j, item in enumerate(state):
+            if isinstance(item, np.ndarray):
+                arrays[f"tree_{j}"] = item
+                tree["state"].append({"array": f"tree_{j}"})
+            elif item is None or isinstance(item, (int, float)):
+                tree["state"].append({"value": item})
+            else:
+                tree["state"].append({"metric": "haversine"})
+
+    layout, offset = {}, 0
+    for name, arr in arrays.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        layout[name] = {"dtype": arr.dtype.descr if arr.dtype.fields else arr.dtype.str,
+                        "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+    header = json.dumps({
+        "version": snapshot.version,
+        "coords_key": snapshot.coords_key,
+        "loaded_at": snapshot.loaded_at,
+        "arrays": layout,
+        "tree": tree,
+    }).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, arr in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmp, path)
+
+
+class Generation:
+    """A generation file mapped read-only; its numpy views share the mapping."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a station generation")
+        size = int.from_bytes(self._mm[len(MAGIC):len(MAGIC) + 8], "little")
+        self.header = json.loads(self._mm[len(MAGIC) + 8:len(MAGIC) + 8 + size])
+        data_start = -(-(len(MAGIC) + 8 + size) // ALIGN) * ALIGN
+        self.arrays: Dict[str, np.ndarray] = {}
+        for name, spec in self.header["arrays"].items():
+            dtype = np.dtype([tuple(f) for f in spec["dtype"]] if isinstance(spec["dtype"], list) else spec["dtype"])
+            count = int(np.prod(spec["shape"]))
+            self.arrays[name] = np.frombuffer(
+                self._mm, dtype=dtype, count=count, offset=data_start + spec["offset"]
+            ).reshape(spec["shape"])
+
+    @property
+    def version(self) -> str:
+        return self.header["version"]
+
+    def _tree(self):
+        spec = self.header.get("tree")
+        if spec is None or BallTree is None or spec["sklearn"] != sklearn.__version__:
+            # nearest.py builds a per-process tree instead
+            return None
+        state = []
+        for item in spec["state"]:
+            if "array" in item:
+                state.append(self.arrays[item["array"]])
+            elif "metric" in item:
+                state.append(DistanceMetric.get_metric(item["metric"]))
+            else:
+                state.append(item["value"])
+        tree = BallTree.__new__(BallTree)
+        tree.__setstate__(tuple(state))
+        return tree
+
+    def snapshot(self) -> Snapshot:
+        arrays = connectors.StationArrays.from_columns(**{name: self.arrays[name] for name in ARRAY_COLUMNS})
+        records = StationRecords(self.arrays["records"], self.arrays["record_offsets"])
+        return Snapshot.from_columns(
+            records, self.version, self.header["loaded_at"], arrays, self.header["coords_key"],
+            ids=self.arrays["station_id"], tree=self._tree(),
+        )
+
+
+# -----------------------
+# Store (one directory per service)
+# -----------------------
+class StationStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._pointer = os.path.join(directory, "current")
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """The pointer: {"file", "version", "format", "published_at"}, or None before the first publish."""
+        try:
+            with open(self._pointer, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def attach(self) -> Optional[Generation]:
+        for _ in range(2):
+            pointer = self.current()
+            if pointer is None:
+                return None
+            try:
+                return Generation(os.path.join(self.directory, pointer["file"]))
+            except FileNotFoundError:
+                # replaced and removed between reading the pointer and opening the file
+                continue
+        return None
+
+    @contextmanager
+    def publisher_lock(self, blocking: bool):
+        """True while this process is the one publisher; False if another one holds it."""
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.directory, "publish.lock"), "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def publish(self, stations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Write a generation for these stations (unless the current one has the same data) and point at it."""
+        snapshot = Snapshot(stations)
+        pointer = self.current()
+        name = f"stations-{snapshot.version}.bin"
+        if pointer is None or pointer["version"] != snapshot.version or pointer.get("format") != MAGIC.decode():
+            write_generation(os.path.join(self.directory, name), snapshot)
+            PUBLISHES.labels(store=os.path.basename(self.directory)).inc()
+        new = {"file": name, "version": snapshot.version, "format": MAGIC.decode(), "published_at": time.time()}
+        tmp = f"{self._pointer}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(new, f)
+        os.replace(tmp, self._pointer)
+        # workers that mapped older generations keep their mappings; new attaches can't see them
+        for entry in os.listdir(self.directory):
+            if entry.startswith("stations-") and entry.endswith(".bin") and entry != name:
+                try:
+                    os.unlink(os.path.join(self.directory, entry))
+                except OSError:
+                    pass
+        return new
+
+
+class SharedStationSnapshot(StationSnapshot):
+    """StationSnapshot served from a StationStore generation instead of a per-process copy."""
+
+    def __init__(self, loader: Callable[[], List[Dict[str, Any]]], store: StationStore,
+                 ttl: float = STATION_SNAPSHOT_TTL_SECONDS):
+        super().__init__(loader, ttl)
+        self.store = store
+        self.generation: Optional[Generation] = None
+
+    def _stale(self, pointer: Optional[Dict[str, Any]]) -> bool:
+        # a generation written by an older release can't be read; the first new process replaces it
+        return (pointer is None or pointer.get("format") != MAGIC.decode()
+                or time.time() - pointer["published_at"] > self.ttl)
+
+    def _load(self):
+        pointer = self.store.current()
+        if self._stale(pointer):
+            # one process reloads from the database; with a generation to serve the rest don't wait
+            with self.store.publisher_lock(blocking=pointer is None) as publisher:
+                if publisher and self._stale(self.store.current()):
+                    with metrics.stage("station_snapshot_load"):
+                        stations = self._loader()
+                    self.store.publish(stations)
+            pointer = self.store.current()
+        old = self._snapshot
+        if old is not None and pointer is not None and old.version == pointer["version"]:
+            old.loaded_at = pointer["published_at"]
+        else:
+            generation = self.store.attach()
+            if generation is None:
+                raise RuntimeError(f"no station generation in {self.store.directory}")
+            self.generation = generation
+            new = generation.snapshot()
+            new.loaded_at = pointer["published_at"] if pointer else new.loaded_at
+            self._install(new)
+        GENERATION_AGE.labels(store=os.path.basename(self.store.directory)).set_function(
+            lambda: time.time() - self._snapshot.loaded_at if self._snapshot else 0.0
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "shared": True,
+            "generation": os.path.basename(self.generation.path) if self.generation else None,
+            "tree_shared": bool(self._snapshot is not None and self._snapshot.tree is not None),
+        }
+
+
+def snapshot_source(service: str, loader: Callable[[], List[Dict[str, Any]]],
+                    ttl: float = STATION_SNAPSHOT_TTL_SECONDS) -> StationSnapshot:
+    """The shared snapshot under STATION_SHM_DIR/<service> when configured, else a per-process one."""
+    if not STATION_SHM_DIR:
+        return StationSnapshot(loader, ttl)
+    return SharedStationSnapshot(loader, StationStore(os.path.join(STATION_SHM_DIR, service)), ttl)
@@ -0,0 +1,220 @@
+"""
+In-memory station snapshot shared by the request handlers.
+
+/api/route used to query every station and charger aggregate from Postgres
+on each request. StationSnapshot loads them once, keeps them for
+STATION_SNAPSHOT_TTL_SECONDS, and then reloads in a background thread while
+requests keep using the previous snapshot (stale-while-revalidate). Every
+snapshot carries a content `version`; derived data such as station tiles is
+keyed by it.
+
+Stations are dicts built by build_stations(): id, name, address, lat/lon
+plus the charger aggregates from services/connectors.summarize(). With
+several worker processes, services/shared_stations.py serves the same
+snapshot from one shared mmap'd file instead; there `stations` is a
+read-only sequence that decodes records on access (not a list, so use
+list(snapshot.stations) to serialize it). Whole-snapshot work goes through
+the columns (`arrays`, `ids`) rather than the records.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services import connectors, metrics
+
+STATION_SNAPSHOT_TTL_SECONDS = float(os.getenv("STATION_SNAPSHOT_TTL_SECONDS", "60"))
+# distinct vehicle filters whose masks are kept per snapshot
+MASK_CACHE_SIZE = 64
+
+
+def build_stations(station_rows: Iterable[Dict[str, Any]],
+                   charger_rows: Iterable[Tuple[str, Optional[str], Optional[float], Optional[str]]]) -> List[Dict[str, Any]]:
+    """
+    Snapshot records from station rows (station_id, name, address, lat, lon
+    and optionally status) and (station_id, type, power_kw, status) charger rows.
+    Stations without coordinates are skipped.
+    """
+    by_station: Dict[str, List[Tuple[Optional[str], Optional[float], Optional[str]]]] = {}
+    for station_id, ctype, power_kw, status in charger_rows:
+        by_station.setdefault(str(station_id), []).append((ctype, power_kw, status))
+
+    out = []
+    for st in station_rows:
+        if st.get("lat") is None or st.get("lon") is None:
+            continue
+        sid = str(st["station_id"])
+        rec = {
+            "station_id": sid,
+            "name": st.get("name"),
+            "address": st.get("address"),
+            "lat": float(st["lat"]),
+            "lon": float(st["lon"]),
+        }
+        if "status" in st:
+            rec["status"] = st["status"]
+        rec.update(connectors.summarize(by_station.get(sid, ())))
+        out.append(rec)
+    return out
+
+
+class Snapshot:
+    __slots__ = ("stations", "version", "loaded_at", "tree", "_arrays", "_ids", "_by_coord", "_masks", "_coords_key")
+
+    def __init__(self, stations: List[Dict[str, Any]]):
+        self.stations = stations
+        blob = json.dumps(stations, sort_keys=True, default=str, separators=(",", ":")).encode("utf-8")
+        self.version = hashlib.sha1(blob).hexdigest()[:16]
+        self.loaded_at = time.time()
+        # spatial index built elsewhere and shipped with the snapshot (shared_stations.py); else None
+        self.tree = None
+        self._arrays: Optional[connectors.StationArrays] = None
+        self._ids: Optional[np.ndarray] = None
+        self._by_coord: Optional[Dict[Tuple[float, float], int]] = None
+        self._masks: Dict[str, Any] = {}
+        self._coords_key: Optional[str] = None
+
+    @classmethod
+    def from_columns(cls, stations: Sequence[Dict[str, Any]], version: str, loaded_at: float,
+                     arrays: connectors.StationArrays, coords_key: str, ids: Optional[np.ndarray] = None,
+                     tree: Any = None) -> "Snapshot":
+        """A snapshot over data computed elsewhere (version, columns, index are not recomputed)."""
+        snap = cls.__new__(cls)
+        snap.stations = stations
+        snap.version = version
+        snap.loaded_at = loaded_at
+        snap.tree = tree
+        snap._arrays = arrays
+        snap._ids = ids
+        snap._by_coord = None
+        snap._masks = {}
+        snap._coords_key = coords_key
+        return snap
+
+    @property
+    def arrays(self) -> connectors.StationArrays:
+        """Numpy columns of the stations, built on first use (the snapshot never changes)."""
+        if self._arrays is None:
+            self._arrays = connectors.StationArrays(self.stations)
+        return self._arrays
+
+    @property
+    def ids(self) -> np.ndarray:
+        """station_id column (str), built on first use."""
+        if self._ids is None:
+            self._ids = np.array([str(s["station_id"]) for s in self.stations], dtype=str)
+        return self._ids
+
+    @property
+    def coords_key(self) -> str:
+        """Hash of the station order and coordinates only; unchanged by status or charger updates."""
+        if self._coords_key is None:
+            arrays = self.arrays
+            self._coords_key = hashlib.sha1(arrays.lat.tobytes() + arrays.lon.tobytes()).hexdigest()
+        return self._coords_key
+
+    def mask(self, station_filter: connectors.StationFilter):
+        """Boolean numpy mask of the stations passing the filter, cached per filter."""
+        key = station_filter.key()
+        keep = self._masks.get(key)
+        if keep is None:
+            if len(self._masks) >= MASK_CACHE_SIZE:
+                self._masks.clear()
+            keep = self._masks[key] = station_filter.mask(self.arrays)
+        return keep
+
+    def filtered(self, station_filter: Optional[connectors.StationFilter]) -> List[Dict[str, Any]]:
+        if station_filter is None or not station_filter.active:
+            return self.stations
+        return [self.stations[i] for i in np.flatnonzero(self.mask(station_filter))]
+
+    def index_of(self, lat: float, lon: float) -> Optional[int]:
+        """Snapshot index of the station at (lat, lon), matched to ~10 m; for clients that send no ids."""
+        if self._by_coord is None:
+            arrays = self.arrays
+            keys = zip(np.round(arrays.lat, 4).tolist(), np.round(arrays.lon, 4).tolist())
+            self._by_coord = dict(zip(keys, range(len(arrays.lat))))
+        return self._by_coord.get((float(np.round(float(lat), 4)), float(np.round(float(lon), 4))))
+
+
+class StationSnapshot:
+    def __init__(self, loader: Callable[[], List[Dict[str, Any]]], ttl: float = STATION_SNAPSHOT_TTL_SECONDS):
+        self._loader = loader
+        self.ttl = ttl
+        self._snapshot: Optional[Snapshot] = None
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        self._listeners: List[Callable[[Snapshot], None]] = []
+        self.last_error: Optional[str] = None
+
+    def on_change(self, fn: Callable[[Snapshot], None]):
+        """fn(snapshot) runs after every load that changed the station data."""
+        self._listeners.append(fn)
+
+    def _load(self):
+        with metrics.stage("station_snapshot_load"):
+            stations = self._loader()
+        self._install(Snapshot(stations))
+
+    def _install(self, new: Snapshot):
+        old = self._snapshot
+        if old is not None and old.version == new.version:
+            old.loaded_at = new.loaded_at
+            return
+        self._snapshot = new
+        for fn in self._listeners:
+            try:
+                fn(new)
+            except Exception as e:
+                print(f"⚠️ Station snapshot listener failed: {e}")
+
+    def _refresh_in_background(self):
+        def run():
+            try:
+                with self._load_lock:
+                    self._load()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️ Station snapshot refresh failed, serving previous snapshot: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="station-snapshot", daemon=True).start()
+
+    def get(self) -> Snapshot:
+        snap = self._snapshot
+        if snap is None:
+            # first request waits for the load; concurrent first requests share it
+            with self._load_lock:
+                if self._snapshot is None:
+                    self._load()
+            return self._snapshot
+        if time.time() - snap.loaded_at > self.ttl and not self._refreshing:
+            self._refreshing = True
+            self._refresh_in_background()
+        return snap
+
+    def stations(self) -> List[Dict[str, Any]]:
+        return self.get().stations
+
+    def invalidate(self):
+        """Force a reload on the next get() (e.g. after an admin edits stations)."""
+        snap = self._snapshot
+        if snap is not None:
+            snap.loaded_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snapshot
+        return {
+            "loaded": snap is not None,
+            "version": snap.version if snap else None,
+            "stations": len(snap.stations) if snap else 0,
+            "age_seconds": round(time.time() - snap.loaded_at, 1) if snap else None,
+            "ttl_seconds": self.ttl,
+            "last_error": self.last_error,
+        }
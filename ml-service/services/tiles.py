@@ -0,0 +1,222 @@
+"""
+Station tiles: z/x/y GeoJSON buckets over the station snapshot.
+
+Stations are bucketed into Web Mercator (slippy map) tiles once per snapshot
+version and zoom, from the snapshot's columns; only single stations are
+read from the records. Below CLUSTER_MAX_ZOOM stations are merged into clusters on
+a grid of CLUSTER_GRID x CLUSTER_GRID cells per tile, so a country-wide view
+is a few dozen features instead of every station. Encoded tiles carry a
+strong ETag (hash of the body); unchanged tiles are answered with 304.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from services.connectors import StationArrays
+from services.stations import Snapshot
+
+MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "18"))
+CLUSTER_MAX_ZOOM = int(os.getenv("TILE_CLUSTER_MAX_ZOOM", "11"))
+CLUSTER_GRID = 4  # cells per tile side at clustered zooms (64 px cells on 256 px tiles)
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "4096"))
+# tiles up to this zoom are encoded as soon as a new snapshot arrives
+PRECOMPUTE_MAX_ZOOM = int(os.getenv("TILE_PRECOMPUTE_MAX_ZOOM", "10"))
+MAX_LAT = 85.05112878
+
+
+def lonlat_to_tile(lon: float, lat: float, z: int) -> Tuple[int, int]:
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    n = 1 << z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_r = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(lat_r) + 1.0 / math.cos(lat_r)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(z: int, x: int, y: int) -> List[float]:
+    """[west, south, east, north] in degrees."""
+    n = 1 << z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return [x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)]
+
+
+def _station_feature(s: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [round(s["lon"], 6), round(s["lat"], 6)]},
+        "properties": {
+            "station_id": s["station_id"],
+            "name": s["name"],
+            "address": s.get("address"),
+            "max_power_kw": s.get("max_power_kw", 0.0),
+            "charger_count": s.get("charger_count", 0),
+        },
+    }
+
+
+def _cluster_feature(arrays: StationArrays, members: np.ndarray) -> Dict[str, Any]:
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [round(float(arrays.lon[members].mean()), 6),
+                                                      round(float(arrays.lat[members].mean()), 6)]},
+        "properties": {
+            "cluster": True,
+            "point_count": len(members),
+            "charger_count": int(arrays.charger_count[members].sum()),
+            # float32 column; 3 decimals gives back the kW figure as loaded
+            "max_power_kw": round(float(arrays.max_power[members].max()), 3),
+        },
+    }
+
+
+def _tile_xy(lats: np.ndarray, lons: np.ndarray, z: int) -> Tuple[np.ndarray, np.ndarray]:
+    """lonlat_to_tile over coordinate columns."""
+    n = 1 << z
+    lat_r = np.radians(np.clip(lats, -MAX_LAT, MAX_LAT))
+    x = ((lons + 180.0) / 360.0 * n).astype(np.int64)
+    y = ((1.0 - np.log(np.tan(lat_r) + 1.0 / np.cos(lat_r)) / np.pi) / 2.0 * n).astype(np.int64)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+def _group(xs: np.ndarray, ys: np.ndarray, z: int, idx: np.ndarray) -> Dict[Tuple[int, int], np.ndarray]:
+    """{(x, y): idx entries in that tile}, ordered by (x, y), each group in ascending order."""
+    if not len(idx):
+        return {}
+    keys = xs * (1 << z) + ys
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    return {(int(xs[g[0]]), int(ys[g[0]])): idx[g] for g in np.split(order, starts[1:])}
+
+
+def _bucket(arrays: StationArrays, z: int) -> Dict[Tuple[int, int], np.ndarray]:
+    xs, ys = _tile_xy(arrays.lat, arrays.lon, z)
+    return _group(xs, ys, z, np.arange(len(xs)))
+
+
+def _features(stations, arrays: StationArrays, buckets, z: int, x: int, y: int) -> List[Dict[str, Any]]:
+    idx = buckets.get((x, y))
+    if idx is None:
+        return []
+    if z > CLUSTER_MAX_ZOOM or len(idx) <= 1:
+        return [_station_feature(stations[i]) for i in idx]
+
+    # cluster on the grid of the zoom log2(CLUSTER_GRID) levels further in
+    sub = z + int(math.log2(CLUSTER_GRID))
+    xs, ys = _tile_xy(arrays.lat[idx], arrays.lon[idx], sub)
+    return [
+        _station_feature(stations[group[0]]) if len(group) == 1 else _cluster_feature(arrays, group)
+        for group in _group(xs, ys, sub, idx).values()
+    ]
+
+
+def _encode(z: int, x: int, y: int, features: List[Dict[str, Any]]) -> Tuple[bytes, str]:
+    body = json.dumps({
+        "type": "FeatureCollection",
+        "tile": {"z": z, "x": x, "y": y, "bbox": tile_bounds(z, x, y)},
+        "features": features,
+    }, separators=(",", ":")).encode("utf-8")
+    return body, '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+class StationTiles:
+    def __init__(self, cache_size: int = TILE_CACHE_SIZE):
+        self._version: Optional[str] = None
+        self._buckets: Dict[int, Dict[Tuple[int, int], np.ndarray]] = {}
+        self._encoded: "OrderedDict[Tuple[int, int, int], Tuple[bytes, str]]" = OrderedDict()
+        self._bounds: Tuple[Optional[str], List[float]] = (None, [])
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def rebuild(self, snapshot: Snapshot):
+        """
+        StationSnapshot.on_change hook: bucket and encode the low-zoom tiles
+        for the new snapshot off the request path, then swap them in.
+        """
+        stations, arrays = snapshot.stations, snapshot.arrays
+        buckets = {z: _bucket(arrays, z) for z in range(PRECOMPUTE_MAX_ZOOM + 1)}
+        encoded: "OrderedDict[Tuple[int, int, int], Tuple[bytes, str]]" = OrderedDict()
+        for z in range(PRECOMPUTE_MAX_ZOOM + 1):
+            for (x, y) in buckets[z]:
+                if len(encoded) >= self._cache_size:
+                    break
+                encoded[(z, x, y)] = _encode(z, x, y, _features(stations, arrays, buckets[z], z, x, y))
+        with self._lock:
+            self._version = snapshot.version
+            self._buckets = buckets
+            self._encoded = encoded
+
+    def tile(self, snapshot: Snapshot, z: int, x: int, y: int) -> Tuple[bytes, str]:
+        """(GeoJSON body, strong ETag) for one tile."""
+        key = (z, x, y)
+        with self._lock:
+            self._sync_locked(snapshot)
+            hit = self._encoded.get(key)
+            if hit is not None:
+                self._encoded.move_to_end(key)
+                return hit
+            buckets = self._buckets.get(z)
+        # built outside the lock (two misses on one tile may both build it), swapped in under it
+        if buckets is None:
+            buckets = _bucket(snapshot.arrays, z)
+        entry = _encode(z, x, y, _features(snapshot.stations, snapshot.arrays, buckets, z, x, y))
+        with self._lock:
+            if self._version == snapshot.version:
+                self._buckets.setdefault(z, buckets)
+                self._encoded[key] = entry
+                if len(self._encoded) > self._cache_size:
+                    self._encoded.popitem(last=False)
+        return entry
+
+    def _sync_locked(self, snapshot: Snapshot):
+        if snapshot.version != self._version:
+            self._version = snapshot.version
+            self._buckets = {}
+            self._encoded = OrderedDict()
+
+    def _bounds_for(self, snapshot: Snapshot) -> List[float]:
+        version, bounds = self._bounds
+        if version != snapshot.version:
+            arrays = snapshot.arrays
+            if len(arrays.lat):
+                bounds = [float(arrays.lon.min()), float(arrays.lat.min()),
+                          float(arrays.lon.max()), float(arrays.lat.max())]
+            else:
+                bounds = [-180.0, -MAX_LAT, 180.0, MAX_LAT]
+            self._bounds = (snapshot.version, bounds)
+        return bounds
+
+    def tilejson(self, snapshot: Snapshot, url_template: str) -> Dict[str, Any]:
+        return {
+            "tilejson": "3.0.0",
+            "name": "ampora-stations",
+            "version": snapshot.version,
+            "tiles": [url_template],
+            "minzoom": 0,
+            "maxzoom": MAX_ZOOM,
+            "bounds": self._bounds_for(snapshot),
+            "cluster_max_zoom": CLUSTER_MAX_ZOOM,
+            "stations": len(snapshot.stations),
+        }
+
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison is fine for If-None-Match (RFC 9110 13.1.2)
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
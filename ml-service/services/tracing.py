@@ -0,0 +1,293 @@
+"""
+W3C trace-context propagation and span export for both services.
+
+- incoming `traceparent` headers are continued (server span per request),
+- outbound calls carry `traceparent` (requests sessions via traced_session(),
+  Groq via extra_headers=inject()), each as a client span,
+- SQLAlchemy statements and explicit DB blocks get client spans,
+- finished spans are exported in batches by a background thread.
+
+    TRACE_EXPORTER=file  TRACE_FILE=traces.jsonl            one OTLP/JSON span per line
+    TRACE_EXPORTER=otlp  TRACE_OTLP_ENDPOINT=http://127.0.0.1:4318/v1/traces
+    TRACE_SAMPLE_RATIO=0.1                                   for new traces only; parents decide otherwise
+
+With TRACE_EXPORTER unset ("none") spans are still created so trace ids keep
+flowing between the services, but nothing is recorded.
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+
+TRACEPARENT = "traceparent"
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("trace_span", default=None)
+_service_name = os.getenv("TRACE_SERVICE_NAME", "ampora-ml-service")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "sampled", "name", "kind",
+                 "attributes", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, name: str, kind: int, trace_id: str, parent_id: Optional[str], sampled: bool,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.name = name
+        self.kind = kind
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        out = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attr(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        return out
+
+
+def _attr(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+# -----------------------
+# Export
+# -----------------------
+class _Exporter:
+    """Batches finished spans on a daemon thread so request threads never block on I/O."""
+
+    def __init__(self, kind: str, batch_size: int = 256, interval: float = 2.0):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=10_000)
+        self.dropped = 0
+        threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def submit(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"⚠️ Trace export failed ({len(batch)} spans): {e}")
+
+    def _payload(self, spans: List[Span]) -> Dict[str, Any]:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_attr("service.name", _service_name)]},
+            "scopeSpans": [{"scope": {"name": "ampora.tracing"}, "spans": [s.to_otlp() for s in spans]}],
+        }]}
+
+    def _write(self, spans: List[Span]):
+        if self.kind == "file":
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                for s in spans:
+                    f.write(json.dumps({"service": _service_name, **s.to_otlp()}) + "\n")
+        elif self.kind == "otlp":
+            requests.post(TRACE_OTLP_ENDPOINT, json=self._payload(spans), timeout=5)
+
+
+_exporter: Optional[_Exporter] = None
+
+
+def configure(service_name: str):
+    """Call once per process with the service name spans are reported under."""
+    global _service_name, _exporter
+    _service_name = os.getenv("TRACE_SERVICE_NAME", service_name)
+    if TRACE_EXPORTER in ("file", "otlp") and _exporter is None:
+        _exporter = _Exporter(TRACE_EXPORTER)
+
+
+# -----------------------
+# Spans
+# -----------------------
+def parse_traceparent(value: Optional[str]):
+    m = _TRACEPARENT_RE.match((value or "").strip().lower())
+    if not m or m.group(1) == "0" * 32 or m.group(2) == "0" * 16:
+        return None
+    return m.group(1), m.group(2), bool(int(m.group(3), 16) & 1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def start_span(name: str, kind: int = INTERNAL, traceparent: Optional[str] = None,
+               attributes: Optional[Dict[str, Any]] = None) -> Span:
+    """Start a span as child of `traceparent` (server side) or of the current span, and make it current."""
+    remote = parse_traceparent(traceparent) if traceparent else None
+    parent = _current.get()
+    if remote:
+        trace_id, parent_id, sampled = remote
+    elif parent:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        sampled = random.random() < TRACE_SAMPLE_RATIO
+    span = Span(name, kind, trace_id, parent_id, sampled, attributes)
+    span._token = _current.set(span)
+    return span
+
+
+def end_span(span: Span, error: Optional[BaseException] = None):
+    span.end_ns = time.time_ns()
+    if error is not None and span.error is None:
+        span.error = f"{type(error).__name__}: {error}"
+    try:
+        _current.reset(span._token)
+    except ValueError:
+        # ended from another context (Starlette middleware task); just drop it as current
+        _current.set(None)
+    if span.sampled and _exporter is not None:
+        _exporter.submit(span)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, attributes: Optional[Dict[str, Any]] = None):
+    s = start_span(name, kind, attributes=attributes)
+    try:
+        yield s
+    except BaseException as ex:
+        end_span(s, ex)
+        raise
+    else:
+        end_span(s)
+
+
+def inject(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Headers for an outbound call made inside the current span."""
+    headers = dict(headers or {})
+    s = _current.get()
+    if s is not None:
+        headers[TRACEPARENT] = s.traceparent
+    return headers
+
+
+# -----------------------
+# Outbound HTTP (requests)
+# -----------------------
+class _TracingAdapter(HTTPAdapter):
+    def __init__(self, peer: str, **kwargs):
+        self.peer = peer
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        # never record query strings: Google URLs carry the API key
+        attrs = {"http.method": request.method, "http.url": f"{url.scheme}://{url.netloc}{url.path}",
+                 "peer.service": self.peer}
+        with span(f"{self.peer} {request.method}", CLIENT, attrs) as s:
+            request.headers[TRACEPARENT] = s.traceparent
+            response = super().send(request, **kwargs)
+            s.set("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                s.error = f"HTTP {response.status_code}"
+            return response
+
+
+def traced_session(peer: str, session: Optional[requests.Session] = None) -> requests.Session:
+    """requests.Session whose calls propagate traceparent and are recorded as client spans."""
+    session = session or requests.Session()
+    adapter = _TracingAdapter(peer)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# -----------------------
+# Databases
+# -----------------------
+_SQL_VERB = re.compile(r"^\s*(\w+)")
+
+
+def instrument_sqlalchemy():
+    """Client span for every SQLAlchemy statement, on all engines in this process."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        m = _SQL_VERB.match(statement or "")
+        conn.info.setdefault("trace_spans", []).append(start_span(
+            f"db {m.group(1).upper() if m else 'query'}", CLIENT,
+            attributes={"db.system": conn.engine.dialect.name, "db.statement": statement[:500]},
+        ))
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            end_span(spans.pop())
+
+    @event.listens_for(Engine, "handle_error")
+    def _error(ctx):
+        spans = ctx.connection.info.get("trace_spans") if ctx.connection is not None else None
+        if spans:
+            end_span(spans.pop(), ctx.original_exception)
+
+
+def db_span(statement: str, system: str = "postgresql"):
+    """Span for a DB call made through a raw driver (psycopg2)."""
+    m = _SQL_VERB.match(statement or "")
+    return span(f"db {m.group(1).upper() if m else 'query'}", CLIENT,
+                {"db.system": system, "db.statement": statement.strip()[:500]})
@@ -0,0 +1,38 @@
+import os
+import random
+import sys
+
+import pytest
+
+ML_SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ML_SERVICE_ROOT, os.path.join(ML_SERVICE_ROOT, "model", "new_model")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from services.stations import build_stations  # noqa: E402
+
+CONNECTOR_TYPES = ["CCS2", "CHAdeMO", "Type 2"]
+POWER_LEVELS = [7.4, 22.0, 50.0, 60.0, 120.0]
+STATUSES = ["Available", "Occupied", "Out of service"]
+
+
+def make_stations(n, seed=7):
+    """Snapshot records over Sri Lanka, built the way the services build them."""
+    rng = random.Random(seed)
+    station_rows, charger_rows = [], []
+    for i in range(n):
+        station_rows.append({
+            "station_id": f"st-{i}",
+            "name": f"Station {i}",
+            "address": f"{i} Main Street",
+            "lat": rng.uniform(5.95, 9.80),
+            "lon": rng.uniform(79.70, 81.85),
+        })
+        for _ in range(rng.randint(1, 4)):
+            charger_rows.append((f"st-{i}", rng.choice(CONNECTOR_TYPES), rng.choice(POWER_LEVELS), rng.choice(STATUSES)))
+    return build_stations(station_rows, charger_rows)
+
+
+@pytest.fixture
+def stations():
+    return make_stations(500)
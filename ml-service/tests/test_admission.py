@@ -0,0 +1,171 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from services import admission, resilience
+
+
+def _hold(limiter, priority="interactive"):
+    """A slot taken on another thread (tickets don't belong to threads)."""
+    held = {}
+    t = threading.Thread(target=lambda: held.setdefault("ticket", limiter.acquire(priority)))
+    t.start()
+    t.join()
+    return held["ticket"]
+
+
+def _queue(limiter, priority, out, release=False):
+    """Queue an acquire on a thread; (priority, Ticket or Shed) lands in `out`."""
+    def run():
+        try:
+            ticket = limiter.acquire(priority)
+        except admission.Shed as e:
+            out.append((priority, e))
+            return
+        out.append((priority, ticket))
+        if release:
+            ticket.release()
+
+    t = threading.Thread(target=run)
+    t.start()
+    time.sleep(0.05)  # queued in submission order
+    return t
+
+
+def test_parse_limits():
+    assert admission.parse_limits("/api/route=4, /chat=0", {"/api/route": 16, "/chat": 8}) == {"/api/route": 4}
+    assert admission.priority_name(" Fleet ") == "fleet"
+    assert admission.priority_name("vip") == "interactive"
+
+
+def test_slot_goes_to_the_best_waiter():
+    limiter = admission.EndpointLimiter("/api/route", limit=1, queue_size=4, max_wait=2.0)
+    ticket = _hold(limiter)
+    order = []
+    threads = [_queue(limiter, p, order, release=True) for p in ("operator", "batch", "interactive")]
+
+    ticket.release()
+    for t in threads:
+        t.join()
+    assert [p for p, _ in order] == ["interactive", "batch", "operator"]
+    assert limiter.stats()["active"] == 0
+
+
+def test_full_queue_evicts_lower_priority():
+    limiter = admission.EndpointLimiter("/api/route", limit=1, queue_size=1, max_wait=1.0)
+    ticket = _hold(limiter)
+    out = []
+    threads = [_queue(limiter, "operator", out), _queue(limiter, "interactive", out)]
+    assert out and out[0][0] == "operator" and out[0][1].reason == "evicted"
+
+    with pytest.raises(admission.Shed) as shed:
+        limiter.acquire("batch")
+    assert shed.value.reason == "queue_full"
+
+    ticket.release()
+    for t in threads:
+        t.join()
+    assert isinstance(out[1][1], admission.Ticket)
+    out[1][1].release()
+
+
+def test_sheds_on_predicted_wait_and_queue_timeout():
+    limiter = admission.EndpointLimiter("/api/route", limit=1, queue_size=8, max_wait=0.1)
+    ticket = _hold(limiter)
+    started = time.monotonic()
+    with pytest.raises(admission.Shed) as shed:
+        limiter.acquire("interactive")
+    assert shed.value.reason == "queue_timeout" and time.monotonic() - started < 0.5
+
+    limiter._service_seconds = 5.0  # recent requests took 5 s each
+    with pytest.raises(admission.Shed) as shed:
+        limiter.acquire("interactive")
+    assert shed.value.reason == "predicted_wait" and shed.value.retry_after == 5.0
+    ticket.release()
+    assert limiter.stats()["shed"] == 2
+
+
+def test_unlimited_endpoints_are_always_admitted():
+    control = admission.AdmissionControl({"/api/route": 1})
+    assert control.acquire("/api/health") is None
+    ticket = control.acquire("/api/route")
+    ticket.release()
+    ticket.release()  # later calls are no-ops
+    assert control.stats()["/api/route"]["active"] == 0
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = admission.TokenBucket("test", rate=20.0, burst=2)
+    assert bucket.take(0) and bucket.take(0)
+    assert not bucket.take(0)  # empty, and no time to wait
+    started = time.monotonic()
+    assert bucket.take(1.0)  # the next token is 50 ms away
+    assert 0.02 < time.monotonic() - started < 0.5
+
+
+@pytest.mark.parametrize("rate, burst, admitted", [(0, 2, 2), (0, 0, 0), (-1, 1, 1)])
+def test_token_bucket_without_refill(rate, burst, admitted):
+    bucket = admission.TokenBucket("test", rate=rate, burst=burst)
+    assert sum(bucket.take(0.05) for _ in range(burst + 2)) == admitted
+
+
+def test_token_bucket_async():
+    bucket = admission.TokenBucket("test", rate=0, burst=1)
+    assert asyncio.run(bucket.take_async(0.1)) is True
+    assert asyncio.run(bucket.take_async(0.1)) is False
+
+
+# -----------------------
+# /chat: shed and refused requests get 503 + Retry-After, never a 200 "Done."
+# -----------------------
+CHAT_TURN = {
+    "conversation_id": "trip-1", "user_text": "Where should I charge?", "start_city": "Colombo",
+    "end_city": "Kandy", "stations": [{"name": "Kandy City Charge", "lat": 7.2906, "lng": 80.6337}],
+}
+
+
+@pytest.fixture
+def chat_service(monkeypatch):
+    os.environ.setdefault("GMAPS_API_KEY", "AIzaTESTKEY")  # googlemaps checks the prefix at import
+    os.environ.setdefault("GROQ_API_KEY", "test")
+    main = pytest.importorskip("main")
+    testclient = pytest.importorskip("fastapi.testclient")
+    monkeypatch.setattr(main, "SESSIONS", main.SessionStore())
+    monkeypatch.setattr(main, "REPLY_CACHE", main.ChatResponseCache())
+    monkeypatch.setattr(main, "ADMISSION", admission.AdmissionControl({"/chat": 1}, queue_size=0))
+    monkeypatch.setattr(main, "predict_activities", lambda user_type, minutes: "Temple of the Tooth")
+    monkeypatch.setattr(main, "analyze_stations_logic", lambda origin, stations, **kw: (stations[0], stations))
+    # an empty bucket that never refills: every Groq call is refused before it's sent
+    empty = admission.TokenBucket("groq-test", rate=0, burst=0)
+    monkeypatch.setattr(main, "GROQ", resilience.Upstream("groq-test", timeout=1.0, retries=0, bucket=empty))
+    monkeypatch.setattr(main, "groq_client", None)  # reaching the client would fail the test with an AttributeError
+    return main, testclient.TestClient(main.app)
+
+
+def test_chat_answers_503_when_admission_sheds(chat_service):
+    main, client = chat_service
+    ticket = _hold(main.ADMISSION.limiters["/chat"])
+    resp = client.post("/chat", json=CHAT_TURN)
+    ticket.release()
+
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert "queue_full" in resp.json()["detail"]
+
+
+@pytest.mark.parametrize("user_type", [None, "Tourist"])
+def test_chat_answers_503_when_the_groq_bucket_refuses(chat_service, monkeypatch, user_type):
+    main, client = chat_service
+    if user_type:  # past user-type inference, refused on the reply itself
+        monkeypatch.setattr(main, "infer_user_type_llm", lambda *a, **kw: user_type)
+    resp = client.post("/chat", json=CHAT_TURN)
+
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert "rate limit" in resp.json()["detail"]
+    session = main.SESSIONS.get_or_create("trip-1")
+    assert session.messages == []  # the turn is dropped; the client resends it
+    assert session.user_type == user_type
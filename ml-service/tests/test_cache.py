@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+from services import resilience
+from services.cache import AsyncSingleFlight, SingleFlight
+
+
+class Boom(resilience.UpstreamError):
+    pass
+
+
+def _concurrently(n, fn):
+    results = [None] * n
+
+    def run(i):
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_followers_share_the_leaders_result():
+    flight, calls = SingleFlight("test"), []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"routes": 2}
+
+    results = _concurrently(4, lambda i: flight.do("k", fetch))
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert flight.stats() == {"in_flight": 0, "waiting": 0}
+
+
+def test_each_follower_gets_its_own_copy_of_the_error():
+    flight = SingleFlight("test")
+
+    def fetch():
+        time.sleep(0.2)
+        raise Boom("osrm", "HTTP 500")
+
+    errors = _concurrently(4, lambda i: flight.do("k", fetch))
+    assert all(isinstance(e, Boom) and e.upstream == "osrm" and str(e) == "osrm: HTTP 500" for e in errors)
+    assert len({id(e) for e in errors}) == 4
+    assert all(e.__cause__ is errors[0] for e in errors[1:])
+
+
+def test_follower_times_out_but_the_call_finishes():
+    flight = SingleFlight("test")
+    results = _concurrently(2, lambda i: flight.do("k", lambda: time.sleep(0.3) or "done", timeout=0.05))
+    assert results[0] == "done"
+    assert isinstance(results[1], TimeoutError)
+
+
+def test_short_caller_deadline_does_not_fail_the_shared_call():
+    flight = SingleFlight("test")
+
+    def fetch():
+        time.sleep(0.2)
+        if resilience.remaining() <= 0:
+            raise resilience.DeadlineExceeded("osrm", "out of time")
+        return "ok"
+
+    def caller(i):
+        # the leader asked for 50 ms with X-Request-Deadline-Ms
+        token = resilience.start_deadline(15, "50" if i == 0 else None)
+        try:
+            return flight.do("k", fetch)
+        finally:
+            resilience.end_deadline(token)
+
+    assert _concurrently(2, caller) == ["ok", "ok"]
+
+
+def test_deadline_errors_are_run_again_for_followers():
+    flight, calls = SingleFlight("test"), []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            raise resilience.DeadlineExceeded("osrm", "out of time")
+        return "ok"
+
+    results = _concurrently(2, lambda i: flight.do("k", fetch))
+    assert isinstance(results[0], resilience.DeadlineExceeded)
+    assert results[1] == "ok" and len(calls) == 2
+
+
+def test_async_flight_shares_one_task():
+    async def main():
+        flight, calls = AsyncSingleFlight("test"), []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "ok"
+
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+        return results, calls, flight.stats()
+
+    results, calls, stats = asyncio.run(main())
+    assert results == ["ok"] * 5 and len(calls) == 1 and stats == {"in_flight": 0}
+
+
+def test_async_flight_errors_and_cancellation():
+    async def main():
+        flight = AsyncSingleFlight("test")
+
+        async def failing():
+            await asyncio.sleep(0.05)
+            raise Boom("google", "HTTP 503")
+
+        errors = await asyncio.gather(*(flight.do("e", failing) for _ in range(3)), return_exceptions=True)
+
+        runs = []
+
+        async def slow():
+            runs.append(1)
+            await asyncio.sleep(0.1)
+            return len(runs)
+
+        waiter = asyncio.ensure_future(flight.do("c", slow))
+        await asyncio.sleep(0.01)
+        flight._tasks["c"].cancel()  # the shared call is cancelled, not the waiter
+        return errors, await waiter
+
+    errors, rerun = asyncio.run(main())
+    assert all(isinstance(e, Boom) for e in errors) and len({id(e) for e in errors}) == 3
+    assert rerun == 2
+
+
+def test_async_caller_timeout_leaves_the_call_running():
+    async def main():
+        flight = AsyncSingleFlight("test")
+
+        async def fetch():
+            await asyncio.sleep(0.2)
+            return "ok"
+
+        impatient = flight.do("k", fetch, timeout=0.05)
+        patient = flight.do("k", fetch)
+        return await asyncio.gather(impatient, patient, return_exceptions=True)
+
+    impatient, patient = asyncio.run(main())
+    assert isinstance(impatient, TimeoutError) and patient == "ok"
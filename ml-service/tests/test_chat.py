@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+os.environ.setdefault("GMAPS_API_KEY", "AIzaTESTKEY")  # googlemaps checks the prefix at import
+os.environ.setdefault("GROQ_API_KEY", "test")
+
+main = pytest.importorskip("main")
+
+STATIONS = [
+    {"name": "Kandy City Charge", "lat": 7.2906, "lng": 80.6337, "address": "Kandy"},
+    {"name": "Peradeniya Hub", "lat": 7.2690, "lng": 80.5950, "address": "Peradeniya"},
+]
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    replies = []
+    monkeypatch.setattr(main, "SESSIONS", main.SessionStore())
+    monkeypatch.setattr(main, "REPLY_CACHE", main.ChatResponseCache())
+    monkeypatch.setattr(main, "infer_user_type_llm", lambda *a, **kw: "Tourist")
+    monkeypatch.setattr(main, "predict_activities", lambda user_type, minutes: "Temple of the Tooth")
+    monkeypatch.setattr(main, "analyze_stations_logic", lambda origin, stations, **kw: (stations[0], stations))
+
+    def reply(**kw):
+        replies.append(kw["charging_minutes"])
+        return f"{kw['user_text']} Charge at {kw['best']['name']} for {kw['charging_minutes']} minutes."
+
+    monkeypatch.setattr(main, "generate_chatbot_reply_llm", reply)
+
+    def send(text, **fields):
+        return main._chat(main.ChatRequest(conversation_id="trip-1", user_text=text, **fields))
+
+    send.replies = replies
+    return send
+
+
+def test_identical_turns_in_a_session_hit_the_reply_cache(chat):
+    first = chat("Where should I charge?", start_city="Colombo", end_city="Kandy", stations=STATIONS)
+    chat("What is there to do?")
+    again = chat("Where should I charge?")
+
+    assert again.assistant_text == first.assistant_text
+    assert len(chat.replies) == 2 and len(set(chat.replies)) == 1
+    assert main.REPLY_CACHE.stats()["hits"] == 1
+
+
+def test_client_charging_time_is_kept_for_the_session(chat):
+    chat("Where should I charge?", start_city="Colombo", end_city="Kandy", stations=STATIONS, charging_minutes=45)
+    chat("And after that?")
+    chat("Where should I charge?", charging_minutes=90)
+    assert chat.replies == [45, 45, 90]
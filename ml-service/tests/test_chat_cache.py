@@ -0,0 +1,60 @@
+from chat_cache import ChatResponseCache, build_context_key, normalize_text
+
+BEST = {"name": "Kandy City Charge"}
+SORTED = [BEST, {"name": "Peradeniya Hub"}, {"name": "Katugastota EV"}, {"name": "Far Away"}]
+
+
+def _key(**overrides):
+    args = dict(user_type="Tourist", best=BEST, sorted_list=SORTED, activities="Temple of the Tooth",
+                start_city="Colombo", end_city="Kandy", charging_minutes=45)
+    args.update(overrides)
+    return build_context_key(**args)
+
+
+def test_normalize_text():
+    assert normalize_text("  Which STATION, café?! 🚗 ") == "which station cafe"
+
+
+def test_context_key():
+    assert _key() == _key(start_city="colombo ", end_city="KANDY")
+    assert _key()[4] == ("Peradeniya Hub", "Katugastota EV")
+    # the reply quotes the charging time
+    assert _key(charging_minutes=45) != _key(charging_minutes=90)
+    assert _key(best=SORTED[1]) != _key()
+
+
+def test_exact_and_similar_hits_within_a_context():
+    cache = ChatResponseCache(min_similarity=0.5)
+    cache.store(_key(), "Which station should I charge at?", "Kandy City Charge.")
+
+    assert cache.lookup(_key(), "which station should i charge at") == "Kandy City Charge."
+    assert cache.lookup(_key(), "Which station should I charge at near Kandy?") == "Kandy City Charge."
+    assert cache.lookup(_key(charging_minutes=90), "Which station should I charge at?") is None
+    assert cache.lookup(_key(), "Tell me about the weather") is None
+    # not served again right after the same reply
+    assert cache.lookup(_key(), "Which station should I charge at?", last_reply="Kandy City Charge.") is None
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["similar_hits"], stats["repeat_skips"]) == (1, 1, 1)
+
+
+def test_eviction_keeps_document_frequencies_exact():
+    cache = ChatResponseCache(max_entries=3, max_per_context=2)
+    texts = ["where to charge", "where to eat", "what to see", "how long to charge", "best food nearby"]
+    for i, text in enumerate(texts):
+        cache.store(_key(charging_minutes=i % 2), text, f"reply {i}")
+
+    stats = cache.stats()
+    assert stats["entries"] == 3 and stats["evictions"] == 2
+    live = [e for bucket in cache._contexts.values() for e in bucket.values()]
+    expected = {}
+    for entry in live:
+        for term in entry.tf:
+            expected[term] = expected.get(term, 0) + 1
+    assert dict(cache._df) == expected
+
+
+def test_expired_entries_are_dropped():
+    cache = ChatResponseCache(ttl_seconds=-1)
+    cache.store(_key(), "where to charge", "reply")
+    assert cache.lookup(_key(), "where to charge") is None
+    assert cache.stats()["expirations"] == 1 and not cache._df
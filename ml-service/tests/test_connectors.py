@@ -0,0 +1,36 @@
+import pytest
+
+from services.connectors import StationArrays, StationFilter
+from services.stations import build_stations
+
+# (station, type, power_kw, status) charger rows
+CHARGERS = [
+    ("slow-free-fast-busy", "Type 2", 7.4, "Available"),
+    ("slow-free-fast-busy", "CCS2", 120.0, "Occupied"),
+    ("fast-free", "CCS2", 60.0, "Available"),
+    ("all-busy", "CHAdeMO", 50.0, "Occupied"),
+    ("unknown-type-free", "Schuko", 3.0, "Available"),
+]
+
+
+@pytest.fixture
+def chargers():
+    rows = [{"station_id": sid, "name": sid, "address": "", "lat": 7.0, "lon": 80.0}
+            for sid in dict.fromkeys(row[0] for row in CHARGERS)]
+    return build_stations(rows, CHARGERS)
+
+
+@pytest.mark.parametrize("connectors, min_power_kw, available_only, names", [
+    # a free charger has to be the fast one, whether or not connectors are given
+    (None, 50, True, ["fast-free"]),
+    ("CCS2,Type 2", 50, True, ["fast-free"]),
+    (None, 7, True, ["slow-free-fast-busy", "fast-free"]),
+    (None, 50, False, ["slow-free-fast-busy", "fast-free", "all-busy"]),
+    (None, 0, True, ["slow-free-fast-busy", "fast-free", "unknown-type-free"]),
+    ("CCS2", 0, True, ["fast-free"]),
+])
+def test_power_and_availability_come_from_one_charger(chargers, connectors, min_power_kw, available_only, names):
+    station_filter = StationFilter.from_params(connectors, min_power_kw, available_only)
+    keep = station_filter.mask(StationArrays(chargers))
+    assert [s["name"] for s, k in zip(chargers, keep) if k] == names
+    assert [s["name"] for s in station_filter.apply(chargers)] == names
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.multioutput import MultiOutputClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+import fast_predictor
+import features
+
+
+def _labels(records):
+    # a few outputs that depend on the features, so the fitted models aren't constant
+    return np.array([
+        [int(charging >= 60), int(user_type == "Tourist" or weekend), int(time < "12:00")]
+        for user_type, charging, time, _, _, _, weekend in records
+    ])
+
+
+def _fit(transform, model):
+    records = fast_predictor.random_records(1500, seed=1)
+    pipeline = Pipeline([("transformer", FunctionTransformer(transform)), ("model", MultiOutputClassifier(model))])
+    return pipeline.fit(fast_predictor._frame(records), _labels(records))
+
+
+@pytest.mark.parametrize("transform, model, kind", [
+    (features.transform_features, RandomForestClassifier(n_estimators=15, max_depth=8, random_state=0),
+     "tree_ensemble"),
+    (features.encode_features, SGDClassifier(loss="log_loss", random_state=0), "hashed_linear"),
+])
+def test_compiled_matches_sklearn(transform, model, kind):
+    pipeline = _fit(transform, model)
+    compiled = fast_predictor.compile_pipeline(pipeline)
+
+    assert compiled is not None and compiled.kind == kind
+    assert fast_predictor.verify_parity(pipeline, compiled, fast_predictor.random_records(500, seed=2)) == 0
+
+
+def test_memoized_predictions_are_read_only():
+    pipeline = _fit(features.transform_features, RandomForestClassifier(n_estimators=5, random_state=0))
+    compiled = fast_predictor.compile_pipeline(pipeline)
+    record = fast_predictor.random_records(1, seed=3)[0]
+
+    first = compiled.predict(record)
+    assert compiled.predict(record) is first
+    assert not first.flags.writeable
+
+
+def test_unsupported_pipeline_is_not_compiled():
+    pipeline = Pipeline([("model", RandomForestClassifier(n_estimators=2))])
+    assert fast_predictor.compile_pipeline(pipeline) is None
@@ -0,0 +1,78 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from services import routing
+
+
+def _matrix(n_stops, seed):
+    rng = np.random.default_rng(seed)
+    pts = rng.uniform(0, 100, size=(n_stops + 2, 2))
+    m = np.linalg.norm(pts[:, None] - pts[None, :], axis=2) * 60
+    # asymmetric, like real drive times
+    return m * rng.uniform(0.8, 1.2, size=m.shape)
+
+
+def _brute_force(m):
+    n = len(m) - 2
+    return min(routing.path_seconds(m, order) for order in itertools.permutations(range(n)))
+
+
+@pytest.mark.parametrize("n_stops", [2, 3, 5, 7])
+@pytest.mark.parametrize("seed", range(5))
+def test_held_karp_is_optimal(n_stops, seed):
+    m = _matrix(n_stops, seed)
+    order, method = routing.solve_order(m)
+
+    assert method == "exact"
+    assert sorted(order) == list(range(n_stops))
+    assert routing.path_seconds(m, order) == pytest.approx(_brute_force(m))
+
+
+def test_heuristic_beyond_exact_limit(monkeypatch):
+    monkeypatch.setattr(routing, "ROUTE_EXACT_MAX_STOPS", 4)
+    m = _matrix(7, seed=3)
+    order, method = routing.solve_order(m)
+
+    assert method == "heuristic"
+    assert sorted(order) == list(range(7))
+    assert routing.path_seconds(m, order) <= routing.path_seconds(m, routing._nearest_neighbour(m))
+
+
+def test_unreachable_legs_are_avoided():
+    m = _matrix(3, seed=0)
+    m[0, 1] = np.nan  # start -> first stop has no route
+    order, _ = routing.solve_order(m)
+    assert order[0] != 0
+
+
+def test_order_stops_keeps_the_given_order_on_ties():
+    stops = [(7.0, 80.0), (7.1, 80.1)]
+    m = np.ones((4, 4))
+    ordered, info = routing.order_stops(stops, m)
+    assert ordered == stops and info["order"] == [0, 1]
+
+
+def test_matrix_cache_reorders_for_any_point_order():
+    cache = routing.DurationMatrixCache()
+    points = [(6.9, 79.8), (7.3, 80.6), (6.0, 80.2), (9.6, 80.0)]
+    m = _matrix(2, seed=4)
+    fetched = []
+
+    def fetch(pts):
+        fetched.append(pts)
+        return m
+
+    got, cached = cache.get_or_fetch("osrm", points, fetch)
+    assert not cached
+    np.testing.assert_array_equal(got, m)
+
+    perm = [2, 0, 3, 1]
+    shuffled = [points[i] for i in perm]
+    got, cached = cache.get_or_fetch("osrm", shuffled, fetch)
+    assert cached and len(fetched) == 1
+    np.testing.assert_array_equal(got, m[np.ix_(perm, perm)])
+    # ~1 m rounding: the same stops sent with noise in the 6th decimal hit too
+    assert cache.get("osrm", [(lat + 1e-7, lon) for lat, lon in points]) is not None
+    assert cache.get("google", points) is None
@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+import pytest
+
+from services import shared_stations, tiles
+from services.connectors import StationFilter
+from services.nearest import NearestStations
+from services.stations import Snapshot, StationSnapshot
+
+ROUTE_PATH = [(6.9271, 79.8612), (7.05, 80.1), (7.2906, 80.6337), (8.3, 80.4), (9.6615, 80.0255)]
+
+
+def _shared(stations, directory):
+    return shared_stations.SharedStationSnapshot(lambda: stations, shared_stations.StationStore(str(directory)))
+
+
+def test_generation_round_trip(stations, tmp_path):
+    private = Snapshot(stations)
+    shared = _shared(stations, tmp_path).get()
+
+    assert isinstance(shared.stations, shared_stations.StationRecords)
+    assert shared.version == private.version
+    assert shared.coords_key == private.coords_key
+    assert list(shared.stations) == stations
+    assert shared.stations[-1] == stations[-1]
+    assert json.dumps(list(shared.stations)) == json.dumps(stations)
+    for name in shared_stations.ARRAY_COLUMNS:
+        np.testing.assert_array_equal(getattr(shared.arrays, name), getattr(private.arrays, name))
+    np.testing.assert_array_equal(shared.ids, private.ids)
+    s = stations[123]
+    assert shared.index_of(s["lat"], s["lon"]) == private.index_of(s["lat"], s["lon"]) == 123
+
+
+def test_full_scans_read_columns_not_records(stations, tmp_path, monkeypatch):
+    shared = _shared(stations, tmp_path).get()
+    decoded = []
+    decode = shared_stations.StationRecords._decode
+    monkeypatch.setattr(shared_stations.StationRecords, "_decode", lambda self, i: decoded.append(i) or decode(self, i))
+
+    shared.index_of(0.0, 0.0)
+    assert len(shared.ids) == len(stations)
+    tile_cache = tiles.StationTiles()
+    tile_cache.tilejson(shared, "/t/{z}/{x}/{y}")
+    tile_cache.tile(shared, 0, 0, 0)
+    assert decoded == []
+
+
+@pytest.fixture
+def route_service(monkeypatch):
+    app = pytest.importorskip("app")
+    routes = [{"distance_km": 390.0, "duration_min": 420.0, "path": ROUTE_PATH}]
+    monkeypatch.setattr(app.planner, "get_routes_from_osrm", lambda *a, **kw: routes)
+
+    def serve(source):
+        station_tiles, nearest = tiles.StationTiles(), NearestStations()
+        source.on_change(station_tiles.rebuild)
+        source.on_change(nearest.rebuild)
+        monkeypatch.setattr(app, "STATIONS", source)
+        monkeypatch.setattr(app, "STATION_TILES", station_tiles)
+        monkeypatch.setattr(app, "NEAREST", nearest)
+        return app.app.test_client()
+
+    return serve
+
+
+def _responses(client, stations):
+    s = stations[0]
+    out = [client.get("/api/stations/tiles.json").get_data()]
+    for z in (0, 6, 9, 12, 15):
+        x, y = tiles.lonlat_to_tile(s["lon"], s["lat"], z)
+        out.append(client.get(f"/api/stations/tiles/{z}/{x}/{y}.geojson").get_data())
+    for query in ("lat=7.0&lng=80.0&k=15", "lat=7.0&lng=80.0&radius_km=40&connectors=CCS2&available_only=1"):
+        out.append(client.get(f"/api/stations/nearest?{query}").get_data())
+    for body in ({}, {"connectors": ["CHAdeMO"], "min_power_kw": 50}):
+        route = {"start": {"lat": 6.9271, "lng": 79.8612}, "end": {"lat": 9.6615, "lng": 80.0255}, **body}
+        out.append(client.post("/api/route", json=route).get_data())
+    return out
+
+
+def test_shared_and_private_endpoints_agree(stations, tmp_path, route_service):
+    private = _responses(route_service(StationSnapshot(lambda: stations)), stations)
+    shared = _responses(route_service(_shared(stations, tmp_path)), stations)
+
+    assert [json.loads(body).get("success", True) for body in private] == [True] * len(private)
+    assert json.loads(private[-2])["nearby_stations"]
+    assert shared == private
+
+
+def test_filtered_masks_match(stations, tmp_path):
+    private, shared = Snapshot(stations), _shared(stations, tmp_path).get()
+    station_filter = StationFilter.from_params("CCS2,Type 2", 22, True)
+    np.testing.assert_array_equal(shared.mask(station_filter), private.mask(station_filter))
+    assert shared.filtered(station_filter) == private.filtered(station_filter)
+
+
+@pytest.mark.parametrize("precision", ["x", None, [5], {"p": 5}])
+def test_bad_route_precision_is_a_400(stations, route_service, precision):
+    client = route_service(StationSnapshot(lambda: stations))
+    route = {"start": {"lat": 6.9271, "lng": 79.8612}, "end": {"lat": 9.6615, "lng": 80.0255}, "precision": precision}
+    resp = client.post("/api/route", json=route)
+
+    assert resp.status_code == 400
+    assert resp.get_json()["success"] is False
+
+
+def test_route_precision_is_clamped(stations, route_service):
+    client = route_service(StationSnapshot(lambda: stations))
+    route = {"start": {"lat": 6.9271, "lng": 79.8612}, "end": {"lat": 9.6615, "lng": 80.0255}, "precision": "9"}
+    resp = client.post("/api/route", json=route)
+
+    assert resp.status_code == 200
+    assert resp.get_json()["routes"][0]["path"][0] == [6.9271, 79.8612]